@@ -0,0 +1,102 @@
+import collections
+import logging
+
+import weekcalendar
+
+"""The snippet server's configuration.
+
+An instance serves several requests at once, each in its own thread,
+so the configuration is read once, when the first request needs it,
+into a Config that nothing changes afterwards.  Anything that varies from
+request to request -- like the clock, which tests set -- travels with
+the request instead; see snippets._config().
+
+Besides the HipChat token and proxy in hipchat.cfg (see hipchatlib),
+settings can go in an optional snippets.cfg, in the same 'name = value'
+format:
+   multitenant = true
+      Give every email domain its own separate snippet server; see
+      tenants.py.  The default is one server for everybody.
+   hipchat_room = Khan Academy
+      The HipChat room the cron jobs send to.
+   hipchat_room:example.com = Example Eng
+      In multi-tenant mode, the room for the example.com tenant.
+      Tenants without a room don't get HipChat messages.
+   seal_after_weeks = 4
+      Seal weeks this many weeks older than the one the weekly page
+      shows by default; see sealedweeks.py.  0 turns sealing off.
+"""
+
+
+_DEFAULT_HIPCHAT_ROOM = 'Khan Academy'
+
+_DEFAULT_SEAL_AFTER_WEEKS = 4
+
+# Config is a namedtuple, so it's immutable.  Use _replace() to make
+# a modified copy.
+#   send_to_hipchat: have the cron jobs send to HipChat, in addition
+#      to email?
+#   hipchat_token: the token for talking to HipChat; see hipchatlib.
+#   hipchat_proxy_server, hipchat_proxy_type: the proxy to reach
+#      HipChat through, or None.
+#   hipchat_room: the room to send to when we're not multi-tenant.
+#   tenant_hipchat_rooms: a frozenset of (tenant, room) pairs, for
+#      when we are.
+#   multitenant: partition users and snippets by email domain?
+#   seal_after_weeks: how old a week must be to get sealed, or 0.
+#   now_fn: returns the current time; see weekcalendar.now().
+Config = collections.namedtuple('Config',
+                                ('send_to_hipchat', 'hipchat_token',
+                                 'hipchat_proxy_server', 'hipchat_proxy_type',
+                                 'hipchat_room', 'tenant_hipchat_rooms',
+                                 'multitenant', 'seal_after_weeks',
+                                 'now_fn'))
+
+
+def _read_cfg(path, required):
+    """Return the name -> value map in a cfg file, or None if it's missing.
+
+    If required is True, log a warning when the file's missing.
+    """
+    try:
+        cfglines = open(path).read().splitlines()
+    except IOError:
+        if required:
+            logging.warning('Unable to open %s' % path)
+        return None
+    return dict(l.split(' = ', 1) for l in cfglines if ' = ' in l)
+
+
+def load(hipchat_cfg_path, snippets_cfg_path):
+    """Return the Config, reading secrets and settings from these files."""
+    hipchat_cfg = _read_cfg(hipchat_cfg_path, required=True) or {}
+    hipchat_token = hipchat_cfg.get('token') or None
+    if hipchat_token is None:
+        logging.warning('No HipChat token; not sending msgs there')
+
+    settings = _read_cfg(snippets_cfg_path, required=False) or {}
+    tenant_hipchat_rooms = frozenset(
+        (name.split(':', 1)[1], room)
+        for (name, room) in settings.iteritems()
+        if name.startswith('hipchat_room:'))
+    return Config(send_to_hipchat=hipchat_token is not None,
+                  hipchat_token=hipchat_token,
+                  hipchat_proxy_server=hipchat_cfg.get('proxy_server') or None,
+                  hipchat_proxy_type=hipchat_cfg.get('proxy_type') or None,
+                  hipchat_room=settings.get('hipchat_room',
+                                            _DEFAULT_HIPCHAT_ROOM),
+                  tenant_hipchat_rooms=tenant_hipchat_rooms,
+                  multitenant=settings.get('multitenant') == 'true',
+                  seal_after_weeks=int(settings.get(
+                      'seal_after_weeks', _DEFAULT_SEAL_AFTER_WEEKS)),
+                  now_fn=weekcalendar.now)
+
+
+def hipchat_room(config, tenant):
+    """Return the room for the tenant's cron-job messages, or None.
+
+    tenant is None if we're not multi-tenant.
+    """
+    if tenant is None:
+        return config.hipchat_room
+    return dict(config.tenant_hipchat_rooms).get(tenant)
@@ -0,0 +1,8 @@
+"""Settings the python2.7 runtime reads before running the app.
+
+c.f. https://developers.google.com/appengine/docs/python/tools/appengineconfig
+"""
+
+# webapp's templates use django 0.96 unless we say otherwise.  This
+# must agree with the django version in app.yaml.
+webapp_django_version = '1.2'
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""Build the javascript the pages load: minified, with fingerprinted names.
+
+Run this before every deploy:
+   ./assets.py
+It minifies each file in SOURCES and writes it to assets/, with the
+md5 of its contents in the name, e.g. assets/snippets.1a2b3c4d5e6f.js.
+app.yaml serves assets/ with a one-year, immutable Cache-Control:
+since a new version gets a new name, browsers never need to check
+for one.  The previous build's files are kept for one more deploy,
+so pages people loaded before a deploy can still fetch their
+scripts.  It also writes asset_manifest.json, which says which built
+file goes with each source, and which snippets.py reads at startup
+(see load_urls()) so templates can refer to {{assets.<name>}}.
+
+Without a manifest -- say, in a dev_appserver where nobody ran the
+build -- templates get the unminified files in javascript/.
+
+We minify with rjsmin if it's installed ('pip install rjsmin'), and
+otherwise just strip indentation, blank lines and whole-line
+comments.  That's fine for our javascript, but not for all: it
+would mangle a string literal continued with a backslash, and a
+line starting with // inside a /* */ comment.  Use rjsmin for
+anything fancier.
+"""
+
+
+import glob
+import hashlib
+import os
+import sys
+
+try:
+    import json
+except ImportError:      # python 2.5
+    from django.utils import simplejson as json
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+
+# The name templates use for each asset, and its source, relative to
+# this directory.
+SOURCES = {
+    'jquery': 'javascript/jquery-1.8.2.js',
+    'snippets': 'javascript/snippets.js',
+    }
+
+# Where the build puts the built assets and the manifest, relative to
+# this directory.  app.yaml knows about _BUILD_DIR, too.
+_BUILD_DIR = 'assets'
+MANIFEST_NAME = 'asset_manifest.json'
+
+# How many hex digits of the md5 go into a built file's name.
+_HASH_LENGTH = 12
+
+
+def minify_js(text):
+    """Return a smaller version of the javascript in text."""
+    if rjsmin is not None:
+        return rjsmin.jsmin(text)
+    # Keeping every newline means we needn't worry about javascript's
+    # automatic semicolon insertion.
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith('//'):
+            lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+def _fingerprinted_name(source_path, contents):
+    """Return source_path's basename with the md5 of contents in it."""
+    (base, ext) = os.path.splitext(os.path.basename(source_path))
+    return '%s.%s%s' % (base, hashlib.md5(contents).hexdigest()[:_HASH_LENGTH],
+                        ext)
+
+
+def _read_manifest(root_dir):
+    """Return the manifest under root_dir, or None if there isn't one."""
+    try:
+        f = open(os.path.join(root_dir, MANIFEST_NAME))
+    except IOError:
+        return None
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def build(root_dir):
+    """Build every asset in SOURCES, and the manifest, under root_dir.
+
+    The files of the previous build are kept, since pages cached
+    before this deploy still refer to them; older ones are removed.
+    Returns the manifest: a map from each asset's name to its built
+    file, relative to root_dir.
+    """
+    build_dir = os.path.join(root_dir, _BUILD_DIR)
+    if not os.path.isdir(build_dir):
+        os.makedirs(build_dir)
+    previous_manifest = _read_manifest(root_dir) or {}
+
+    manifest = {}
+    for (name, source_path) in sorted(SOURCES.iteritems()):
+        f = open(os.path.join(root_dir, source_path))
+        try:
+            minified = minify_js(f.read())
+        finally:
+            f.close()
+        built_path = '%s/%s' % (_BUILD_DIR,
+                                _fingerprinted_name(source_path, minified))
+        f = open(os.path.join(root_dir, built_path), 'w')
+        try:
+            f.write(minified)
+        finally:
+            f.close()
+        manifest[name] = built_path
+
+    keep = set(os.path.join(root_dir, path) for path in
+               manifest.values() + previous_manifest.values())
+    for old_path in glob.glob(os.path.join(build_dir, '*')):
+        if old_path not in keep:
+            os.unlink(old_path)
+
+    f = open(os.path.join(root_dir, MANIFEST_NAME), 'w')
+    try:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    return manifest
+
+
+def load_urls(root_dir):
+    """Return a map from each asset's name to the path to serve it from.
+
+    The paths are relative to the site root.  We use the built files
+    if the manifest under root_dir lists them, and the sources if not.
+    """
+    urls = dict(SOURCES)
+    urls.update(_read_manifest(root_dir) or {})
+    return urls
+
+
+def main():
+    root_dir = os.path.dirname(os.path.abspath(__file__))
+    for (name, built_path) in sorted(build(root_dir).iteritems()):
+        source_size = os.path.getsize(os.path.join(root_dir, SOURCES[name]))
+        built_size = os.path.getsize(os.path.join(root_dir, built_path))
+        print '%s: %s (%d bytes, from %d)' % (name, built_path, built_size,
+                                              source_size)
+    if rjsmin is None:
+        print >>sys.stderr, ('rjsmin is not installed; only stripped'
+                             ' whitespace and comments')
+
+
+if __name__ == '__main__':
+    main()
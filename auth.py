@@ -0,0 +1,115 @@
+import threading
+import urllib
+
+"""Who's logged in.
+
+The request handlers in snippets.py don't call the appengine users
+API directly; they ask an AuthProvider.  AppEngineAuth, the default,
+uses the users API.  TrustedHeaderAuth is for running the snippet
+server outside of appengine (see standalone.py), behind a proxy that
+does the login and passes along who's logged in in a request header.
+"""
+
+
+class AuthProvider(object):
+    """The interface to something that knows who's logged in."""
+
+    def get_current_user_email(self):
+        """Return the logged-in user's email address, or None."""
+        raise NotImplementedError()
+
+    def is_current_user_admin(self):
+        """True if the logged-in user is an administrator of the app."""
+        raise NotImplementedError()
+
+    def create_login_url(self, dest_url):
+        """Return a url that logs the user in, then sends them to dest_url."""
+        raise NotImplementedError()
+
+    def create_logout_url(self, dest_url):
+        """Return a url that logs the user out, then sends them to dest_url."""
+        raise NotImplementedError()
+
+
+class AppEngineAuth(AuthProvider):
+    """Uses the appengine users API, and so google accounts."""
+
+    def get_current_user_email(self):
+        # Imported lazily so this module doesn't need appengine.
+        from google.appengine.api import users
+        user = users.get_current_user()
+        return user and user.email() or None
+
+    def is_current_user_admin(self):
+        from google.appengine.api import users
+        return users.is_current_user_admin()
+
+    def create_login_url(self, dest_url):
+        from google.appengine.api import users
+        return users.create_login_url(dest_url)
+
+    def create_logout_url(self, dest_url):
+        from google.appengine.api import users
+        return users.create_logout_url(dest_url)
+
+
+class TrustedHeaderAuth(AuthProvider):
+    """Believes whatever email address a request header says.
+
+    This is only safe behind a proxy that logs users in, sets the
+    header, and strips it from the requests it gets from outside --
+    as, for instance, oauth2_proxy does with X-Forwarded-Email.
+
+    The provider needs the current request, which it gets from the
+    WSGI environ: wrap the application with wsgi_middleware(), which
+    remembers each request's environ for the thread that handles it.
+    """
+
+    def __init__(self, header='X-Forwarded-Email', admins=(),
+                 login_url='/oauth2/sign_in', logout_url='/oauth2/sign_out'):
+        """Constructor.
+
+        Arguments:
+          header: the request header holding the logged-in user's email.
+          admins: the email addresses of the app's administrators.
+          login_url, logout_url: the proxy's urls for logging in and
+            out.  We add an 'rd' parameter saying where to go after.
+        """
+        self._environ_key = 'HTTP_' + header.upper().replace('-', '_')
+        self._admins = frozenset(email.lower() for email in admins)
+        self._login_url = login_url
+        self._logout_url = logout_url
+        self._local = threading.local()
+
+    def wsgi_middleware(self, application):
+        """Return a WSGI application that serves application using us.
+
+        application may produce its response lazily, asking us who's
+        logged in along the way, so we keep the request's environ
+        until the response is all sent.
+        """
+        def wrapped_application(environ, start_response):
+            self._local.environ = environ
+            try:
+                for chunk in application(environ, start_response):
+                    yield chunk
+            finally:
+                self._local.environ = None
+        return wrapped_application
+
+    def get_current_user_email(self):
+        environ = getattr(self._local, 'environ', None) or {}
+        return environ.get(self._environ_key) or None
+
+    def is_current_user_admin(self):
+        email = self.get_current_user_email()
+        return email is not None and email.lower() in self._admins
+
+    def _url(self, url, dest_url):
+        return '%s?%s' % (url, urllib.urlencode({'rd': dest_url}))
+
+    def create_login_url(self, dest_url):
+        return self._url(self._login_url, dest_url)
+
+    def create_logout_url(self, dest_url):
+        return self._url(self._logout_url, dest_url)
@@ -0,0 +1,202 @@
+import hashlib
+import logging
+
+from google.appengine.ext import db
+
+"""Running a cron job over every user, in parallel shards.
+
+A cron job that has to visit every user can't do it in one request
+once there are enough users.  Instead the cron handler calls start(),
+which splits the users into shards by a hash of their email, and
+queues one task per shard.  Each shard task calls process(), which
+handles one batch of users, records how far it got (its cursor) in
+the shard's CronShard entity, and queues a task to do the next batch.
+So shards run independently, and if a task fails the task queue
+retries just that batch of that shard, starting from its last
+checkpoint.
+
+Entities are assigned to shards by their 'hash_bucket', a number in
+[0, NUM_HASH_BUCKETS) that must be stored on the entity (see
+hash_bucket()) so we can query by it.  Each shard covers a range of
+buckets, so we can change the number of shards without rewriting
+any entities.
+
+Entities written before their kind had a hash_bucket have none, and
+no query on it can find them.  So until every entity of a kind has
+been rewritten with one, and the migration has called mark_ready()
+to say so, start() runs the job in a single shard that visits every
+entity, bucket or no.
+"""
+
+
+NUM_HASH_BUCKETS = 1024
+
+# How many shards a job is split into, by default.
+NUM_SHARDS = 8
+
+
+def hash_bucket(email):
+    """Return the hash bucket, in [0, NUM_HASH_BUCKETS), for this email."""
+    digest = hashlib.md5(email.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % NUM_HASH_BUCKETS
+
+
+class CronShard(db.Model):
+    """The progress of one shard of one run of a cron job.
+
+    The key-name is job:run:shard (see _shard_key_name()).
+    """
+    job = db.StringProperty(required=True)
+    # Identifies this run of the job; all its shards share it.
+    run = db.StringProperty(required=True)
+    shard = db.IntegerProperty(required=True)
+    # This shard handles entities with bucket_start <= hash_bucket < bucket_end
+    bucket_start = db.IntegerProperty(required=True)
+    bucket_end = db.IntegerProperty(required=True)
+    # The 'current time' for the job, as of when the cron job started.
+    # Every shard uses this, no matter when its tasks actually run.
+    now = db.DateTimeProperty(required=True)
+    # If True, this shard visits every entity, whatever its bucket;
+    # see start().
+    unsharded = db.BooleanProperty(default=False)
+    cursor = db.TextProperty()          # where the next batch starts
+    processed = db.IntegerProperty(default=0)   # entities looked at
+    sent = db.IntegerProperty(default=0)        # entities acted on
+    batches = db.IntegerProperty(default=0)
+    done = db.BooleanProperty(default=False)
+    started = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+
+
+class ShardingReady(db.Model):
+    """Exists once every entity of a kind has its hash_bucket stored.
+
+    The key-name is the kind.  See mark_ready().
+    """
+    marked = db.DateTimeProperty(auto_now_add=True)
+
+
+def _sharding_ready_key(kind):
+    # This lives in the default namespace whatever namespace we're
+    # in: entities that predate hash_bucket predate tenants (see
+    # tenants.py), too, so they're all in the default namespace.
+    return db.Key.from_path('ShardingReady', kind, namespace='')
+
+
+def mark_ready(kind):
+    """Say every entity of kind has a hash_bucket, so start() can shard.
+
+    Call this when a migration that rewrites every entity of the kind
+    -- and so stores its hash_bucket -- has finished.
+    """
+    ShardingReady(key=_sharding_ready_key(kind)).put()
+
+
+def is_ready(kind):
+    """True if mark_ready() has been called for kind."""
+    return db.get(_sharding_ready_key(kind)) is not None
+
+
+def _shard_key_name(job, run, shard):
+    return '%s:%s:%d' % (job, run, shard)
+
+
+def start(job, now, url, num_shards=NUM_SHARDS, kind='User'):
+    """Create the shards for a new run of job, and queue a task for each.
+
+    Arguments:
+      job: the name of the job, e.g. 'view_email'.
+      now: the current time, as a datetime.datetime.  It's saved with
+        the shards and passed to the job as the time it's running at.
+      url: the url of the handler that calls process() for a shard.
+        Each task is a POST to it with the shard's key-name as 'shard'.
+      num_shards: how many shards to split the job into.
+      kind: the kind of entity the job visits.  If it isn't
+        is_ready(), we ignore num_shards and use one unsharded shard.
+
+    Returns:
+      The list of new CronShard entities.
+    """
+    from google.appengine.api import taskqueue
+    run = now.strftime('%Y-%m-%d-%H%M')
+    unsharded = not is_ready(kind)
+    if unsharded:
+        logging.warning('Some %s entities may have no hash_bucket; running'
+                        ' %s unsharded until their migration finishes'
+                        % (kind, job))
+        num_shards = 1
+    shards = []
+    for i in xrange(num_shards):
+        shards.append(CronShard(
+            key_name=_shard_key_name(job, run, i),
+            job=job, run=run, shard=i, now=now, unsharded=unsharded,
+            bucket_start=i * NUM_HASH_BUCKETS // num_shards,
+            bucket_end=(i + 1) * NUM_HASH_BUCKETS // num_shards))
+    db.put(shards)
+    taskqueue.Queue().add([taskqueue.Task(url=url,
+                                          params={'shard': s.key().name()})
+                           for s in shards])
+    logging.info('Started %d shards of %s (run %s)' % (num_shards, job, run))
+    return shards
+
+
+def process(shard_key_name, make_query, process_batch, batch_size, url):
+    """Process the next batch of entities for a shard, and queue the rest.
+
+    Arguments:
+      shard_key_name: the key-name of the CronShard, as passed to url.
+      make_query: a function taking the shard's 'now' and returning a
+        db.Query over the entities the job visits (which must have a
+        hash_bucket property).  We add the shard's filters, unless
+        it's unsharded.
+      process_batch: a function taking a list of entities and the
+        shard's 'now', and returning how many it acted on.
+      batch_size: how many entities to process in this request.
+      url: the url to queue the next batch at (the same one start() used).
+
+    Returns:
+      The CronShard, or None if there is no such shard.
+    """
+    shard = CronShard.get_by_key_name(shard_key_name)
+    if shard is None or shard.done:
+        return shard
+
+    query = make_query(shard.now)
+    if not shard.unsharded:
+        query.filter('hash_bucket >=', shard.bucket_start)
+        query.filter('hash_bucket <', shard.bucket_end)
+    if shard.cursor:
+        query.with_cursor(shard.cursor)
+    entities = query.fetch(batch_size)
+
+    # If this raises, the task is retried from the last checkpoint.
+    shard.sent += process_batch(entities, shard.now)
+    shard.processed += len(entities)
+    shard.batches += 1
+    shard.cursor = query.cursor()
+    shard.done = len(entities) < batch_size
+    shard.put()      # our checkpoint
+
+    if not shard.done:
+        from google.appengine.api import taskqueue
+        taskqueue.add(url=url, params={'shard': shard_key_name})
+    return shard
+
+
+def get_recent_shards(limit=200):
+    """Return the most recently started CronShards, grouped by run.
+
+    Returns:
+      A list of (job, run, shards) triples, most recent run first,
+      with each run's shards in shard order.
+    """
+    shards = CronShard.all().order('-started').fetch(limit)
+    runs = {}
+    for shard in shards:
+        runs.setdefault((shard.job, shard.run), []).append(shard)
+    retval = []
+    for ((job, run), run_shards) in runs.iteritems():
+        run_shards.sort(key=lambda s: s.shard)
+        retval.append((job, run, run_shards))
+    retval.sort(key=lambda (job, run, run_shards): run, reverse=True)
+    return retval
@@ -0,0 +1,285 @@
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+
+"""A read-through cache for datastore reads, in the instance and memcache.
+
+Most requests re-read the same few things: the logged-in user, the
+list of all users, and this week's snippets.  get() looks for the
+result of such a read first in a small LRU cache local to this
+instance, then in memcache, and only then runs the read, saving the
+result in both.
+
+Values are cached as serialized entities, so every caller gets its
+own copy to modify.
+
+Invalidation is by 'generation'.  Each kind of entity we cache has a
+generation number, kept in memcache, that's part of the cache key of
+everything we cache for that kind.  Whenever an entity of that kind
+is written, the writer calls invalidate(), which increments the
+generation, so every cached value for the kind becomes unreachable
+at once, in every instance.  Instances re-read the generation from
+memcache at most every _GENERATION_CHECK_SECONDS, so that's how long
+another instance's write can take to show up here.  (Writes made by
+this instance show up right away.)
+
+The reads we cache are queries, which in the HR datastore are only
+eventually consistent: a query run just after a write may not see
+it yet.  Caching such a result would keep it stale for as long as it
+stays cached, so for _CONSISTENCY_SECONDS after we see a new
+generation, we don't cache what reads return.
+"""
+
+
+# How much this instance caches locally, in bytes of serialized entities.
+_MAX_LOCAL_BYTES = 4 * 1024 * 1024
+
+# How long a value stays in the local cache.
+_LOCAL_TTL_SECONDS = 60
+
+# How long a value stays in memcache (if memcache doesn't evict it first).
+_MEMCACHE_TTL_SECONDS = 10 * 60
+
+# Memcache won't store values bigger than this; we don't try.
+_MAX_MEMCACHE_BYTES = 1000 * 1000
+
+# How stale our idea of another instance's writes can get.
+_GENERATION_CHECK_SECONDS = 2
+
+# How long after a write we expect queries to keep missing it.  We
+# don't cache what we read in that time.
+_CONSISTENCY_SECONDS = 5
+
+_GENERATION_KEY = 'entitycache:generation:%s'
+
+
+class LRUCache(object):
+    """A cache that holds at most max_bytes, and values for at most ttl.
+
+    When it's full, the least recently used values are dropped.  It's
+    a dict plus a circular doubly-linked list of [prev, next, key,
+    value, size, expires] nodes, most recently used at the end.
+
+    Concurrent requests share the cache, so a lock guards the list.
+    """
+
+    def __init__(self, max_bytes, ttl_seconds):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._nodes = {}
+            self._root = [None, None, None, None, 0, 0]
+            self._root[0] = self._root[1] = self._root
+            self.num_bytes = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _unlink(self, node):
+        (prev, next) = (node[0], node[1])
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, node):
+        last = self._root[0]
+        node[0] = last
+        node[1] = self._root
+        last[1] = self._root[0] = node
+
+    def _remove(self, node):
+        self._unlink(node)
+        del self._nodes[node[2]]
+        self.num_bytes -= node[4]
+
+    def get(self, key):
+        """Return the value for key, or None if it's missing or expired."""
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(key)
+            if node is None:
+                return None
+            if node[5] < time.time():
+                self._remove(node)
+                return None
+            self._unlink(node)
+            self._append(node)
+            return node[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size):
+        """Cache value, which takes size bytes, under key."""
+        self._lock.acquire()
+        try:
+            if key in self._nodes:
+                self._remove(self._nodes[key])
+            if size > self.max_bytes:
+                return
+            while self.num_bytes + size > self.max_bytes:
+                self._remove(self._root[1])       # the least recently used
+            node = [None, None, key, value, size,
+                    time.time() + self.ttl_seconds]
+            self._append(node)
+            self._nodes[key] = node
+            self.num_bytes += size
+        finally:
+            self._lock.release()
+
+
+_LOCAL_CACHE = LRUCache(_MAX_LOCAL_BYTES, _LOCAL_TTL_SECONDS)
+
+# Map from (namespace, kind) to (generation, when we last read it
+# from memcache, when we first saw it).  Memcache keeps each
+# namespace's values separate (see tenants.py); in this instance, we
+# include the namespace in our keys.
+_GENERATIONS = {}
+
+
+def clear():
+    """Forget everything cached in this instance.  Useful for tests."""
+    _LOCAL_CACHE.clear()
+    _GENERATIONS.clear()
+
+
+def _generation(kind):
+    """Return (the current generation for kind, when we first saw it).
+
+    The generation is None if memcache is down.
+    """
+    generation_key = (namespace_manager.get_namespace(), kind)
+    (generation, checked, seen) = _GENERATIONS.get(generation_key,
+                                                   (None, 0, 0))
+    if generation is None or time.time() - checked > _GENERATION_CHECK_SECONDS:
+        key = _GENERATION_KEY % kind
+        old_generation = generation
+        generation = memcache.get(key)
+        if generation is None:
+            # Memcache lost it (or it never had it).  We start the new
+            # generation at the current time, so it's past any value
+            # the old one could have reached, and old cached values
+            # stay unreachable.
+            memcache.add(key, int(time.time()))
+            generation = memcache.get(key)
+        if generation != old_generation:
+            seen = time.time()
+        _GENERATIONS[generation_key] = (generation, time.time(), seen)
+    return (generation, seen)
+
+
+def invalidate(kind):
+    """Call after writing entities of the given kind to the datastore."""
+    generation = memcache.incr(_GENERATION_KEY % kind,
+                               initial_value=int(time.time()))
+    if generation is None:
+        logging.error('Unable to invalidate the %s cache' % kind)
+        clear()
+    else:
+        _GENERATIONS[(namespace_manager.get_namespace(), kind)] = (
+            generation, time.time(), time.time())
+
+
+def _serialize(value):
+    """Serialize an entity, or a list of entities, for caching."""
+    if isinstance(value, list):
+        return ('list', [db.model_to_protobuf(e).Encode() for e in value])
+    return ('entity', db.model_to_protobuf(value).Encode())
+
+
+def _size(serialized):
+    """The size, in bytes, of a value returned by _serialize()."""
+    (value_type, data) = serialized
+    if value_type == 'list':
+        return sum(len(d) for d in data)
+    return len(data)
+
+
+def _deserialize(serialized):
+    (value_type, data) = serialized
+    if value_type == 'list':
+        return [db.model_from_protobuf(entity_pb.EntityProto(d))
+                for d in data]
+    return db.model_from_protobuf(entity_pb.EntityProto(data))
+
+
+def get_async(kind, key, start_read_fn,
+              memcache_ttl_seconds=_MEMCACHE_TTL_SECONDS):
+    """Start getting a value, from the cache if possible, and return a future.
+
+    This is like get(), but lets the caller overlap several reads: if
+    the value isn't cached, we start reading it right away, but don't
+    wait for the read to finish until the future is called.
+
+    Arguments:
+      kind: the kind of entities read, e.g. 'User'.  See get().
+      key: a string identifying what's read, unique for kind.
+      start_read_fn: a function that starts an asynchronous read and
+        returns a function that waits for it and returns its value: a
+        db.Model instance, a list of them, or None.
+      memcache_ttl_seconds: how long memcache should keep the value,
+        or 0 to keep it until it's evicted.  Use 0 only for values
+        that rarely change, since invalidate() orphans the old value
+        rather than deleting it.
+
+    Returns:
+      A function taking no arguments that returns the value, or a
+      copy of it.
+    """
+    (generation, seen) = _generation(kind)
+    if generation is None:            # memcache is down; don't risk it
+        return start_read_fn()
+    cache_key = 'entitycache:%s:%s:%s:%s' % (
+        namespace_manager.get_namespace(), kind, generation, key)
+
+    serialized = _LOCAL_CACHE.get(cache_key)
+    if serialized is None:
+        serialized = memcache.get(cache_key)
+        if serialized is not None:
+            _LOCAL_CACHE.set(cache_key, serialized, _size(serialized))
+    if serialized is not None:
+        return lambda: _deserialize(serialized)
+
+    finish_read_fn = start_read_fn()
+    # If someone just wrote, the read may not reflect it yet, and we'd
+    # cache what it returns until the next write.
+    cache_result = time.time() - seen >= _CONSISTENCY_SECONDS
+
+    def future():
+        value = finish_read_fn()
+        if value is not None and cache_result:
+            serialized = _serialize(value)
+            size = _size(serialized)
+            _LOCAL_CACHE.set(cache_key, serialized, size)
+            if size < _MAX_MEMCACHE_BYTES:
+                memcache.set(cache_key, serialized,
+                             time=memcache_ttl_seconds)
+        return value
+    return future
+
+
+def get(kind, key, read_fn):
+    """Return read_fn(), from the cache if possible.
+
+    Arguments:
+      kind: the kind of entities read_fn returns, e.g. 'User'.  Call
+        invalidate(kind) whenever entities of that kind are written.
+      key: a string identifying what read_fn reads, unique for kind.
+      read_fn: a function that reads from the datastore and returns a
+        db.Model instance, a list of them, or None.  None is not
+        cached.
+
+    Returns:
+      What read_fn returned, or a copy of it.
+    """
+    return get_async(kind, key, lambda: read_fn)()
@@ -1,8 +1,6 @@
-import hipchat.config
-import hipchat.room
-
-from google.appengine.ext import db
-from google.appengine.ext import webapp
+import json
+import urllib
+import urllib2
 
 """Snippets server -> HipChat integration.
 
@@ -18,36 +16,53 @@ token = 01234567890abcdef
 except instead of '01234567890abcdef', it should have the token value.
 For Khan Academy, this is stored in secrets.py.
 
+If HipChat must be reached through a proxy, add its address and type:
+   proxy_server = proxy.example.com:3128
+   proxy_type = https
+
 Note that there are no quotes, and there must be spaces around the =,
 or this won't work.
 
 Do not commit hipchat.cfg into git!  It's a secret.
+
+The snippet server reads hipchat.cfg once, into its Config; see
+appconfig.  We pass the token and proxy along with each call, rather
+than through python-hipchat's module-level hipchat.config, since
+concurrent requests share that.
 """
 
-def hipchat_init():
-    """Initializes hipchat, returns true if it worked ok."""
-    hipchat.config.init_cfg('hipchat.cfg')
-    return bool(hipchat.config.token)
-
-
-def send_to_hipchat_room(room_name, message):
-    """For this to work, the hipchat token must be in hipchat.cfg."""
-    for room in hipchat.room.Room.list():
-        if room.name == room_name:
-            # Have to go through hoops since 'from' is reserved in python.
-            msg_dict = {
-                'room_id': room.room_id,
-                'from': 'snippet-server',
-                'notify': 1,
-                'message': message,
-            }
-            hipchat.room.Room.message(**msg_dict)
-            return
-    raise RuntimeError('Unable to send message to hipchat room %s' % room_name)
+
+_ROOMS_API_URL = 'https://api.hipchat.com/v1/rooms/'
 
 
-class TestSendToHipchat(webapp.RequestHandler):
-    """Send a (fixed) message to the hipchat room."""
-    def get(self):
-        send_to_hipchat_room('1s and 0s', 'Test of snippets-to-hipchat')
-        self.response.out.write('OK')
+def _call_rooms_api(config, method, params, post):
+    """Call a method of the HipChat rooms API; return the decoded reply.
+
+    This builds the request just as python-hipchat's call_hipchat()
+    does.  params is a list of (name, value) pairs; we POST them if
+    post is True, and put them in the url otherwise.
+    """
+    url_params = [('format', 'json'), ('auth_token', config.hipchat_token)]
+    if not post:
+        url_params.extend(params)
+    req = urllib2.Request(url=_ROOMS_API_URL + method + '?' +
+                          urllib.urlencode(url_params))
+    if post:
+        req.add_data(urllib.urlencode(params))
+    if config.hipchat_proxy_server and config.hipchat_proxy_type:
+        req.set_proxy(config.hipchat_proxy_server, config.hipchat_proxy_type)
+    return json.load(urllib2.urlopen(req))
+
+
+def send_to_hipchat_room(config, room_name, message):
+    """Send message to the named room, using the token in config."""
+    for room in _call_rooms_api(config, 'list', [], post=False)['rooms']:
+        if room['name'] == room_name:
+            _call_rooms_api(config, 'message',
+                            [('room_id', room['room_id']),
+                             ('from', 'snippet-server'),
+                             ('notify', 1),
+                             ('message', message)],
+                            post=True)
+            return
+    raise RuntimeError('Unable to send message to hipchat room %s' % room_name)
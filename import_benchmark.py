@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""Measure the cold-start (import-time) cost of the snippets server.
+
+Every new appengine instance has to import snippets.py before it can
+serve its first request, so the work done at import time is paid on
+every cold start.  This script imports snippets in a fresh python
+process several times and reports how long that takes, along with the
+cost of the setup (reading the configuration with appconfig.load(),
+and importing hipchatlib and mail) that snippets.py does lazily, on
+first use, rather than at import.
+
+To compare with an older version of the server, give its git
+revision with --before: we export that revision to a temporary
+directory and time its 'import snippets' the same way.  Without
+--before, we only estimate the 'before' figure, as the import plus
+each deferred bit of setup, as though it were all done at import.
+
+Run it from this directory, with the google_appengine directory on
+$PATH (the same setup snippets_test.py needs):
+   python import_benchmark.py [--before <git revision>] [num_runs]
+"""
+
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+# Each snippet of code is timed in its own python process, so that
+# nothing it imports has been cached by a previous measurement.
+_SETUP = ('import os, sys, time;'
+          ' sys.path.extend(os.environ["PATH"].split(":"));'
+          ' import dev_appserver; dev_appserver.fix_sys_path();')
+
+_IMPORT_SNIPPETS = ('start = time.time(); import snippets;'
+                    ' print time.time() - start')
+
+# These assume snippets has already been imported (and not timed).
+_DEFERRED_SUBSYSTEMS = (
+    ('appconfig', ('import snippets; start = time.time();'
+                   ' snippets._default_config();'
+                   ' print time.time() - start')),
+    ('hipchatlib', ('import snippets; start = time.time();'
+                    ' import hipchatlib;'
+                    ' print time.time() - start')),
+    ('mail', ('import snippets; start = time.time();'
+              ' from google.appengine.api import mail;'
+              ' print time.time() - start')),
+    )
+
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _time_in_subprocess(code, cwd=_HERE):
+    """Run the given python code in a new process, return what it prints.
+
+    The process runs in cwd, so that's the snippets it imports.
+    """
+    output = subprocess.Popen([sys.executable, '-c', _SETUP + code],
+                              stdout=subprocess.PIPE, cwd=cwd
+                              ).communicate()[0]
+    return float(output.strip().splitlines()[-1])
+
+
+def _export_revision(revision, dest_dir):
+    """Write the files of this git revision of the server into dest_dir."""
+    archive = subprocess.Popen(['git', 'archive', revision],
+                               stdout=subprocess.PIPE, cwd=_HERE)
+    subprocess.check_call(['tar', '-x', '-C', dest_dir],
+                          stdin=archive.stdout)
+    if archive.wait() != 0:
+        raise RuntimeError('Unable to export revision %s' % revision)
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(num_runs, before_revision):
+    import_time = _median([_time_in_subprocess(_IMPORT_SNIPPETS)
+                           for _ in xrange(num_runs)])
+    deferred_times = []
+    for (name, code) in _DEFERRED_SUBSYSTEMS:
+        deferred_times.append((name, _median([_time_in_subprocess(code)
+                                              for _ in xrange(num_runs)])))
+    if before_revision:
+        before_dir = tempfile.mkdtemp()
+        try:
+            _export_revision(before_revision, before_dir)
+            before_time = _median([_time_in_subprocess(_IMPORT_SNIPPETS,
+                                                       cwd=before_dir)
+                                   for _ in xrange(num_runs)])
+        finally:
+            shutil.rmtree(before_dir)
+
+    print 'Median of %d runs, in milliseconds:' % num_runs
+    print '  import snippets:         %8.1f' % (import_time * 1000)
+    for (name, deferred_time) in deferred_times:
+        print '  deferred: %-14s %8.1f' % (name, deferred_time * 1000)
+    if before_revision:
+        print '  cold start at %-10s %8.1f' % (before_revision[:10] + ':',
+                                                before_time * 1000)
+    else:
+        estimate = import_time + sum(t for (_, t) in deferred_times)
+        print '  cold start before (est.): %7.1f' % (estimate * 1000)
+        print '    (the import plus the deferred setup; use --before to'
+        print '    time an older revision instead)'
+    print '  cold start now:          %8.1f' % (import_time * 1000)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(
+        usage='%prog [--before <git revision>] [num_runs]')
+    parser.add_option('--before', default=None,
+                      help='A git revision to compare with, e.g. the'
+                      ' commit before the imports were made lazy.')
+    (options, args) = parser.parse_args()
+    main(int(args[0]) if args else 5, options.before)
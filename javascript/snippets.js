@@ -3,7 +3,9 @@ $(function() {
     // save save the state of the snippet in .data and disable buttons
     var saveLocalSnippet = function(textarea) {
         var $parentForm = $(textarea).closest("form");
+        var $private = $parentForm.find("input[name=private]");
         $(textarea).data("orig", $(textarea).val());
+        $private.data("orig", $private.is(":checked"));
         $parentForm.removeClass("dirty").
             find(".undo-button, .save-button").
             prop("disabled", true);
@@ -14,39 +16,186 @@ $(function() {
         saveLocalSnippet(v);
     })
 
-    // measure dirtiness on keyup
-    $(".snippet textarea").on("keyup blur", function() {
+    // measure dirtiness on keyup, or when the private checkbox changes
+    $(".snippet textarea, .snippet input[name=private]").on(
+            "keyup blur change", function() {
         var $parentForm = $(this).closest("form");
+        var $textarea = $parentForm.find("textarea");
+        var $private = $parentForm.find("input[name=private]");
 
-        var dirty = $(this).val() !== $(this).data("orig");
+        var dirty = ($textarea.val() !== $textarea.data("orig") ||
+                     $private.is(":checked") !== $private.data("orig"));
         $parentForm.toggleClass("dirty", dirty);
 
         $parentForm.find(".undo-button, .save-button").
             prop("disabled", !dirty);
     })
 
+    // merge our edits with a version of the snippet someone else saved.
+    // Lines we added that the other version doesn't have are appended
+    // to it; this does the right thing for the common case of people
+    // adding bullet points to their snippet from two places.
+    var mergeSnippetText = function(base, local, remote) {
+        if (local === base) {
+            return remote;
+        }
+        var remoteLines = remote.split("\n");
+        var merged = remoteLines.slice(0);
+        $.each(local.split("\n"), function(i, line) {
+            if ($.inArray(line, remoteLines) === -1) {
+                merged.push(line);
+            }
+        });
+        return merged.join("\n");
+    }
+
+    var formForWeek = function(week) {
+        return $(".snippet form").filter(function() {
+            return $(this).find("input[name=week]").val() === week;
+        });
+    }
+
+    // send every dirty snippet to the server in a single request
+    var saveInFlight = false;
+    var saveDirtySnippets = function() {
+        var $dirtyForms = $(".snippet form.dirty");
+        if (saveInFlight || !$dirtyForms.length) {
+            return;
+        }
+        var edits = [];
+        $dirtyForms.each(function(i, form) {
+            var $form = $(form);
+            edits.push({
+                "week": $form.find("input[name=week]").val(),
+                "text": $form.find("textarea").val(),
+                "private": $form.find("input[name=private]").is(":checked"),
+                "version": parseInt($form.find("input[name=version]").val(),
+                                    10)
+            });
+        });
+        var vals = {
+            "u": $dirtyForms.first().find("input[name=u]").val(),
+            "edits": JSON.stringify(edits)
+        };
+        var handleResponse = function(response) {
+            $.each(response.versions || {}, function(week, version) {
+                formForWeek(week).find("input[name=version]").val(version);
+            });
+            var conflictWeeks = $.map(response.conflicts || [],
+                                      function(c) { return c.week; });
+            $dirtyForms.each(function(i, form) {
+                var $textarea = $(form).find("textarea");
+                var $private = $(form).find("input[name=private]");
+                // don't lose edits that were made while we were saving
+                if ($.inArray(edits[i]["week"], conflictWeeks) === -1 &&
+                    $textarea.val() === edits[i]["text"] &&
+                    $private.is(":checked") === edits[i]["private"]) {
+                    saveLocalSnippet($textarea);
+                }
+            });
+            // someone else saved these snippets since we loaded them:
+            // merge in their changes, and leave the form dirty so the
+            // merged text is saved (against the new version) next time.
+            $.each(response.conflicts || [], function(i, conflict) {
+                var $form = formForWeek(conflict.week);
+                var $textarea = $form.find("textarea");
+                $textarea.val(mergeSnippetText($textarea.data("orig"),
+                                               $textarea.val(),
+                                               conflict.text));
+                $textarea.data("orig", conflict.text);
+                $form.find("input[name=version]").val(conflict.version);
+                $form.addClass("dirty");
+            });
+        };
+        var handleError = function(jqx) {
+            if (jqx.status === 409) {
+                handleResponse($.parseJSON(jqx.responseText));
+            }
+        };
+        saveInFlight = true;
+        $.post("/update_snippets", vals, handleResponse, "json").
+            fail(handleError).
+            always(function() { saveInFlight = false; });
+    }
+
     // catch form submissions, submit and disable buttons
     $(".snippet form").on("submit", function(e) {
         e.preventDefault();
-        var vals = $(this).serialize();
-        var $textarea = $(this).find("textarea");
-        var disableUndoOnUpdate = function(d, ts, jqx) {
-            saveLocalSnippet($textarea);
-        };
-        $.post($(this).attr("action"), vals, disableUndoOnUpdate);
+        saveDirtySnippets();
     })
 
+    // autosave every so often
+    var AUTOSAVE_INTERVAL_MS = 30 * 1000;
+    setInterval(saveDirtySnippets, AUTOSAVE_INTERVAL_MS);
+
     // undo button behavior
     $(".snippet .undo-button").on("click", function(e) {
         e.preventDefault();
         var $parentForm = $(this).closest("form");
         var $textarea = $parentForm.find("textarea");
+        var $private = $parentForm.find("input[name=private]");
         $textarea.val($textarea.data("orig"));
+        $private.prop("checked", $private.data("orig"));
         $parentForm.removeClass("dirty").
             find(".undo-button, .save-button").
             prop("disabled", true);
     })
 
+    // on big weekly pages, fetch each category's snippets once it's
+    // expanded and scrolled into view
+    var loadCategory = function($category) {
+        if ($category.data("loading")) {
+            return;
+        }
+        $category.data("loading", true);
+        $.getJSON("/api/weekly", {
+            week: $category.data("week"),
+            category: $category.data("category")
+        }, function(response) {
+            var $snippets = $category.find(".category-snippets").empty();
+            $.each(response.categories, function(i, category) {
+                $.each(category.snippets, function(j, snippet) {
+                    var $snippet = $("<div class='snippet'>");
+                    if (snippet["private"]) {
+                        $snippet.css("color", "#888888");
+                    }
+                    $("<p>").text(snippet.email + ":").appendTo($snippet);
+                    $("<blockquote>").append($("<pre>").text(snippet.text)).
+                        appendTo($snippet);
+                    $snippets.append($snippet);
+                });
+            });
+        }).fail(function() {
+            // try again the next time it's in view
+            $category.data("loading", false);
+        });
+    }
+
+    var isInView = function($elt) {
+        var top = $elt.offset().top;
+        var windowTop = $(window).scrollTop();
+        return (top < windowTop + $(window).height() &&
+                top + $elt.outerHeight() > windowTop);
+    }
+
+    var loadCategoriesInView = function() {
+        $(".lazy-category").each(function(i, v) {
+            var $snippets = $(v).find(".category-snippets");
+            if ($snippets.is(":visible") && isInView($snippets)) {
+                loadCategory($(v));
+            }
+        });
+    }
+
+    $(".lazy-category .category-toggle").on("click", function(e) {
+        e.preventDefault();
+        $(this).closest(".lazy-category").find(".category-snippets").toggle();
+        loadCategoriesInView();
+    })
+
+    $(window).on("scroll resize", loadCategoriesInView);
+    loadCategoriesInView();
+
     // confirm window closings :)
     $(window).on("beforeunload", function() {
         var dirtySnippets = $(".dirty").length;
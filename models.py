@@ -0,0 +1,172 @@
+import zlib
+
+from google.appengine.ext import db
+
+import cronshard
+
+"""The datastore models for users and snippets.
+
+These are used by the datastore storage backend (see storage.py),
+and, as plain objects, by every other backend: handlers only ever
+see User and Snippet instances, wherever they're stored.
+"""
+
+
+# Note: I use email address rather than a UserProperty to uniquely
+# identify a user.  As per
+# http://code.google.com/appengine/docs/python/users/userobjects.html
+# a UserProperty is an email+unique id, so if a person changes their
+# email the UserProperty also changes; it's not a persistent
+# identifier across email changes the way the unique-id alone is.  But
+# non-google users can't have a unique id, so if I want to expand the
+# snippet server later that won't scale.  So might as well use email
+# as our unique identifier.  If someone changes email address and
+# wants to take their snippets with them, we can add functionality to
+# support that later.
+
+class _EmailHashBucketProperty(db.IntegerProperty):
+    """The cronshard.hash_bucket() of the entity's email, for sharding.
+
+    This is computed from the email, so it can't be set; we just store
+    it so cron shards can query on it.
+    """
+
+    def __get__(self, model_instance, model_class):
+        if model_instance is None:
+            return self
+        return cronshard.hash_bucket(model_instance.email)
+
+    def __set__(self, model_instance, value):
+        pass
+
+
+class User(db.Model):
+    """User preferences."""
+    email = db.StringProperty(required=True)           # The key to this record
+    category = db.StringProperty(default='(unknown)')  # used to group snippets
+    wants_email = db.BooleanProperty(default=True)     # get nag emails?
+    # TODO(csilvers): make a ListProperty instead.
+    wants_to_view = db.TextProperty(default='all')     # comma-separated list
+    timezone = db.StringProperty()     # e.g. 'US/Eastern'; None for default
+    hash_bucket = _EmailHashBucketProperty()           # which cron shard
+
+
+# Texts at least this long are stored compressed.
+_COMPRESS_TEXT_THRESHOLD = 1024
+
+# Compressed texts are stored as a Blob starting with this marker.
+_COMPRESSED_TEXT_MARKER = 'zlib:'
+
+# How much of a snippet's text we keep in Snippet.summary.
+SUMMARY_LENGTH = 200
+
+
+class CompressedTextProperty(db.TextProperty):
+    """A TextProperty that is stored compressed when it is long.
+
+    Short values are stored as a plain db.Text, just as TextProperty
+    stores them.  Long ones are stored as a db.Blob holding
+    _COMPRESSED_TEXT_MARKER followed by the zlib-compressed utf-8.
+    Reading accepts either, so entities written before we started
+    compressing (or by the migration job, halfway done) read fine.
+    """
+
+    def get_value_for_datastore(self, model_instance):
+        value = super(CompressedTextProperty,
+                      self).get_value_for_datastore(model_instance)
+        if value is not None and len(value) >= _COMPRESS_TEXT_THRESHOLD:
+            return db.Blob(_COMPRESSED_TEXT_MARKER +
+                           zlib.compress(value.encode('utf-8')))
+        return value
+
+    def make_value_from_datastore(self, value):
+        if (isinstance(value, db.Blob) and
+                value.startswith(_COMPRESSED_TEXT_MARKER)):
+            compressed = value[len(_COMPRESSED_TEXT_MARKER):]
+            value = db.Text(zlib.decompress(compressed).decode('utf-8'))
+        return super(CompressedTextProperty,
+                     self).make_value_from_datastore(value)
+
+
+def summarize(text):
+    """Return the value of Snippet.summary for a snippet with this text."""
+    return text[:SUMMARY_LENGTH]
+
+
+def email_domain(email):
+    """Return everything after the last @ in email, lowercased, or None."""
+    at = email.rfind('@')
+    if at == -1:
+        return None
+    return email[at + 1:].lower()
+
+
+class Snippet(db.Model):
+    """Every snippet is identified by the monday of the week it goes with."""
+    email = db.StringProperty(required=True)  # week+email: key to this record
+    week = db.DateProperty(required=True)     # the monday of the week
+    text = CompressedTextProperty(default='(No snippet for this week)')
+    # The start of text, so list views can use a projection query
+    # rather than fetching every snippet's full text.  See summarize().
+    # Snippets saved before we had this lack it until the migration
+    # (SNIPPETS_MIGRATION) fills it in.
+    summary = db.StringProperty(multiline=True)
+    # email_domain(email), so privacy checks needn't parse every email.
+    # Snippets saved before we had this may lack it; see domain_of().
+    domain = db.StringProperty()
+    # The author's User.category, so we can query a category's
+    # snippets.  The storage backend keeps it up to date when the
+    # author changes category.
+    category = db.StringProperty()
+    private = db.BooleanProperty(default=False)
+    # When the snippet was first saved, in weekcalendar.DEFAULT_TIMEZONE.
+    # Snippets saved before we had this lack it; see reminderplans.py.
+    submitted = db.DateTimeProperty()
+    # Incremented on every save; used to detect conflicting edits.
+    version = db.IntegerProperty(default=0)
+
+
+class FinishedMigration(db.Model):
+    """Exists once a migration job has rewritten every entity it needs to.
+
+    The key-name names the migration; see mark_migrated().
+    """
+    finished = db.DateTimeProperty(auto_now_add=True)
+
+
+# The migration that fills in Snippet.summary, among other things.
+SNIPPETS_MIGRATION = 'snippets'
+
+
+def _finished_migration_key(name):
+    # This lives in the default namespace whatever namespace we're
+    # in: entities that need migrating predate tenants (see
+    # tenants.py), too, so they're all in the default namespace.
+    return db.Key.from_path('FinishedMigration', name, namespace='')
+
+
+def mark_migrated(name):
+    """Record that the migration with this name has finished."""
+    FinishedMigration(key=_finished_migration_key(name)).put()
+
+
+def is_migrated_async(name):
+    """Start checking if mark_migrated(name) was called; return a future."""
+    rpc = db.get_async(_finished_migration_key(name))
+    return lambda: rpc.get_result() is not None
+
+
+class SentEmail(db.Model):
+    """A record that a cron job's email for a week was sent to someone.
+
+    The key-name is job:week:email; see storage.DatastoreStorage.
+    We keep the week as a property too, so old records can be found
+    and deleted; see Storage.forget_sent().
+    """
+    week = db.DateProperty()
+    sent = db.DateTimeProperty(auto_now_add=True)
+
+
+def domain_of(snippet):
+    """Return the domain of the snippet's author."""
+    return snippet.domain or email_domain(snippet.email)
@@ -0,0 +1,215 @@
+import datetime
+
+from google.appengine.ext import db
+
+import cronshard
+import models
+import weekcalendar
+
+"""When to send each user their reminder email, from their history.
+
+By default everyone is reminded at 11pm Sunday, their time (see
+weekcalendar.REMINDER_*).  But people who write their snippets on
+Friday afternoon would rather be reminded before then, and people
+who always write on Monday morning don't need a reminder Sunday
+night.  And people who are away -- who haven't written a snippet in
+a while, though they used to -- don't need reminding at all.
+
+So once a week, after the deadline, a sharded cron job (see
+cronshard.py) looks at when each batch of users saved their snippets
+over the last few weeks (plan_batch()), and saves a ReminderPlan for
+each user: how many hours before the deadline to remind them (a
+little before their usual time), and whether they're on leave.
+
+The reminder job runs hourly, so each plan also says which hour of
+the week, by the server clock, its reminder is due in (remind_hour).
+Each run visits just the plans due that hour; see plans_due_query().
+Users get a plan as soon as they're created, and it's re-timed when
+they change timezone (see set_remind_hours()), so a new user needn't
+wait for the weekly job to be reminded.
+
+We only know when snippets saved since Snippet.submitted was added
+were written; older ones are ignored.
+"""
+
+
+# How many weeks of snippets we look at.
+_HISTORY_WEEKS = 8
+
+# Someone who wrote snippets before, but not for this many weeks in a
+# row (up through the last one), is on leave.
+_LEAVE_STREAK_WEEKS = 2
+
+# How long before someone usually writes their snippet we remind them.
+_LEAD_MARGIN_HOURS = 2
+
+# How long before the deadline we remind people we know nothing
+# about: it's 11pm Sunday.
+DEFAULT_LEAD_HOURS = 18
+
+# The earliest (5pm Friday) and latest (1pm Monday) we remind anyone.
+_MAX_LEAD_HOURS = 72
+_MIN_LEAD_HOURS = 4
+
+class _KeyNameHashBucketProperty(db.IntegerProperty):
+    """The cronshard.hash_bucket() of the entity's key-name, an email.
+
+    Like models.User.hash_bucket, this can't be set; we store it so
+    cron shards can query on it.
+    """
+
+    def __get__(self, model_instance, model_class):
+        if model_instance is None:
+            return self
+        return cronshard.hash_bucket(model_instance.key().name())
+
+    def __set__(self, model_instance, value):
+        pass
+
+
+class ReminderPlan(db.Model):
+    """When to remind one user.  The key-name is the user's email."""
+    # How many hours before the deadline to send the reminder.
+    lead_hours = db.IntegerProperty(required=True)
+    on_leave = db.BooleanProperty(default=False)   # if so, no reminder
+    # The hour_of_week() the reminder is due in, or None if on leave.
+    remind_hour = db.IntegerProperty()
+    hash_bucket = _KeyNameHashBucketProperty()     # which cron shard
+    computed = db.DateTimeProperty(auto_now=True)
+
+
+def hour_of_week(now):
+    """Return how many whole hours now, a naive datetime, is after Monday."""
+    return now.weekday() * 24 + now.hour
+
+
+def new_plan(user, lead_hours, on_leave, week):
+    """Return a ReminderPlan for user, timed for week's deadline.
+
+    week is the monday of the next week we'll remind user about.
+    The plan is for every week, but its remind_hour, which is by the
+    server clock, is only exact for weeks with the same daylight
+    savings as this one.
+    """
+    if on_leave:
+        remind_hour = None
+    else:
+        calendar = weekcalendar.get_calendar(user.timezone)
+        reminder = calendar.deadline(week) - datetime.timedelta(
+            hours=lead_hours)
+        remind_hour = hour_of_week(calendar.server_time(reminder))
+    return ReminderPlan(key_name=user.email, lead_hours=lead_hours,
+                        on_leave=on_leave, remind_hour=remind_hour)
+
+
+def plan_for(calendar, week_to_submitted, last_week):
+    """Work out when to remind one user.
+
+    Arguments:
+      calendar: the user's weekcalendar.WeekCalendar.
+      week_to_submitted: a map from the monday of every week in the
+        _HISTORY_WEEKS up through last_week that the user wrote a
+        snippet for, to when they first saved it (a datetime in
+        weekcalendar.DEFAULT_TIMEZONE), or None if we don't know.
+      last_week: the monday of the most recent week whose deadline
+        has passed.
+
+    Returns:
+      A pair (lead_hours, on_leave), for a ReminderPlan.
+    """
+    hours_before_deadline = sorted(
+        (calendar.deadline(week) -
+         calendar.local_time(submitted)).total_seconds() / 3600
+        for (week, submitted) in week_to_submitted.iteritems()
+        if submitted is not None)
+    if hours_before_deadline:
+        median = hours_before_deadline[len(hours_before_deadline) // 2]
+        lead_hours = max(_MIN_LEAD_HOURS,
+                         min(_MAX_LEAD_HOURS,
+                             int(median) + _LEAD_MARGIN_HOURS))
+    else:
+        lead_hours = DEFAULT_LEAD_HOURS
+
+    first_leave_week = last_week - datetime.timedelta(
+        7 * (_LEAVE_STREAK_WEEKS - 1))
+    on_leave = (bool(week_to_submitted) and
+                max(week_to_submitted) < first_leave_week)
+    return (lead_hours, on_leave)
+
+
+def _start_history_query(email, last_week):
+    """Start reading when email saved their recent snippets; return a future.
+
+    The future returns the week_to_submitted map plan_for() wants.
+    """
+    # A projection query reads just these fields from the index.
+    snippets_q = db.Query(models.Snippet, projection=('week', 'submitted'))
+    snippets_q.filter('email = ', email)
+    snippets_q.filter('week >= ', last_week - datetime.timedelta(
+        7 * (_HISTORY_WEEKS - 1)))
+    snippets_q.filter('week <= ', last_week)
+    results = snippets_q.run(limit=_HISTORY_WEEKS, batch_size=_HISTORY_WEEKS)
+    return lambda: dict((s.week, s.submitted) for s in results)
+
+
+def plan_batch(users, now):
+    """Recompute and save the ReminderPlan of each of users; return how many.
+
+    This handles one batch of a cron shard (see cronshard.py): it
+    reads the users' recent snippets with one query per user, all run
+    at once, and saves their plans with a single put.
+
+    now is the current time, in weekcalendar.DEFAULT_TIMEZONE.  Run
+    this after the week's deadline, so that week counts.
+    """
+    last_week = weekcalendar.get_calendar().existingsnippet_monday(now)
+    futures = [_start_history_query(user.email, last_week) for user in users]
+    plans = []
+    for (user, future) in zip(users, futures):
+        (lead_hours, on_leave) = plan_for(
+            weekcalendar.get_calendar(user.timezone), future(), last_week)
+        plans.append(new_plan(user, lead_hours, on_leave,
+                              last_week + datetime.timedelta(7)))
+    db.put(plans)
+    return len(plans)
+
+
+def set_remind_hours(users, now):
+    """Re-time the ReminderPlans of users, for their current timezones.
+
+    Users without a plan get the default one.  Call this for new
+    users, and when a user changes timezone.  now is the current
+    time, in weekcalendar.DEFAULT_TIMEZONE.
+    """
+    next_week = (weekcalendar.get_calendar().existingsnippet_monday(now) +
+                 datetime.timedelta(7))
+    email_to_plan = get_plans([user.email for user in users])
+    plans = []
+    for user in users:
+        plan = email_to_plan.get(user.email)
+        if plan is None:
+            plans.append(new_plan(user, DEFAULT_LEAD_HOURS, False, next_week))
+        else:
+            plans.append(new_plan(user, plan.lead_hours, plan.on_leave,
+                                  next_week))
+    db.put(plans)
+
+
+def plans_due_query(now):
+    """Return a query for the ReminderPlans whose reminder is due now.
+
+    now is the current time, in weekcalendar.DEFAULT_TIMEZONE.
+    """
+    q = ReminderPlan.all()
+    q.filter('remind_hour = ', hour_of_week(now))
+    return q
+
+
+def get_plans(emails):
+    """Return a map from each of emails to its ReminderPlan, if it has one.
+
+    This is a single batch get.
+    """
+    keys = [db.Key.from_path('ReminderPlan', email) for email in emails]
+    return dict((email, plan) for (email, plan) in zip(emails, db.get(keys))
+                if plan is not None)
@@ -0,0 +1,217 @@
+import difflib
+import zlib
+
+from google.appengine.ext import db
+
+try:
+    import json
+except ImportError:      # python 2.5
+    from django.utils import simplejson as json
+
+"""Snippet revision history.
+
+Every time a snippet is saved, we record a revision: a child entity
+of the snippet holding what the text looked like at that version.  To
+keep storage small, most revisions hold only a (compressed) line diff
+against the previous revision.  Every so often we store a 'checkpoint'
+instead: the full compressed text.  To reconstruct any version we
+fetch its checkpoint and the diffs after it -- at most
+_MAX_CHAIN_LENGTH revisions, in one batch get.
+
+We take a checkpoint when the chain of diffs since the last one gets
+either too long or, in bytes, a good deal bigger than the compressed
+text itself.  The second rule is what keeps storage close to the size
+of the final text: many small edits produce many small diffs and few
+checkpoints, while big rewrites checkpoint (almost) every time, which
+is little worse than storing the diff would have been.
+"""
+
+
+# The most diffs we'll apply to reconstruct a revision.
+_MAX_CHAIN_LENGTH = 10
+
+# We checkpoint once the diffs since the last checkpoint add up to
+# more than this many times the size of the (compressed) text.
+_MAX_CHAIN_SIZE_RATIO = 2
+
+
+class SnippetRevision(db.Model):
+    """One saved version of a snippet.  Its parent is the Snippet.
+
+    The key-name is derived from the version number (see
+    revision_key()), so we can fetch any run of revisions by key.
+    """
+    version = db.IntegerProperty(required=True)
+    # The version of the checkpoint this revision is reconstructed from.
+    # If it's equal to version, data holds the full (compressed) text.
+    checkpoint = db.IntegerProperty(required=True)
+    # Total size of the diffs between the checkpoint and this revision.
+    chain_size = db.IntegerProperty(default=0)
+    data = db.BlobProperty(required=True)   # _pack()ed text or diff
+    private = db.BooleanProperty(default=False)
+    saved = db.DateTimeProperty(auto_now_add=True)
+
+
+def revision_key(snippet_key, version):
+    """Return the key of the given version of the snippet with snippet_key."""
+    return db.Key.from_path('SnippetRevision', 'v%d' % version,
+                            parent=snippet_key)
+
+
+def make_delta(old_text, new_text):
+    """Return a diff that turns old_text into new_text.
+
+    We find the changed lines, then trim the parts of each change
+    that are the same in the old and new text, so that (say) adding
+    a bullet point to the end of a snippet costs just that bullet.
+
+    The diff is a list of [start, end, replacement] triples, meaning
+    'replace characters start through end-1 of old_text with the
+    string replacement', in increasing order of start.
+    """
+    old_lines = old_text.splitlines(True)
+    new_lines = new_text.splitlines(True)
+    # Character offsets of the beginning of each line (plus the end).
+    old_offsets = [0]
+    for line in old_lines:
+        old_offsets.append(old_offsets[-1] + len(line))
+    new_offsets = [0]
+    for line in new_lines:
+        new_offsets.append(new_offsets[-1] + len(line))
+
+    delta = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    for (tag, i1, i2, j1, j2) in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        (start, end) = (old_offsets[i1], old_offsets[i2])
+        (new_start, new_end) = (new_offsets[j1], new_offsets[j2])
+        while (start < end and new_start < new_end and
+               old_text[start] == new_text[new_start]):
+            start += 1
+            new_start += 1
+        while (start < end and new_start < new_end and
+               old_text[end - 1] == new_text[new_end - 1]):
+            end -= 1
+            new_end -= 1
+        delta.append([start, end, new_text[new_start:new_end]])
+    return delta
+
+
+def apply_delta(old_text, delta):
+    """Apply a diff from make_delta() to old_text; return the new text."""
+    pieces = []
+    pos = 0
+    for (start, end, replacement) in delta:
+        pieces.append(old_text[pos:start])
+        pieces.append(replacement)
+        pos = end
+    pieces.append(old_text[pos:])
+    return ''.join(pieces)
+
+
+def _pack(data):
+    """Compress data (a str) if that makes it smaller, and mark which."""
+    compressed = zlib.compress(data)
+    if len(compressed) < len(data):
+        return db.Blob('z' + compressed)
+    return db.Blob('r' + data)
+
+
+def _unpack(blob):
+    """The inverse of _pack()."""
+    if blob[0] == 'z':
+        return zlib.decompress(blob[1:])
+    return blob[1:]
+
+
+def new_revision(snippet_key, version, old_text, new_text, private,
+                 previous_revision):
+    """Return (but don't put) the SnippetRevision for a newly saved text.
+
+    Arguments:
+      snippet_key: the key of the snippet that was saved.
+      version: the snippet's new version number.
+      old_text: the snippet's text before this save.
+      new_text: the snippet's text after this save.
+      private: whether the snippet is private after this save.
+      previous_revision: the SnippetRevision for version - 1, or None
+        if there isn't one (e.g. the snippet predates revision history).
+
+    Returns:
+      A SnippetRevision, which is either a checkpoint or a diff
+      against previous_revision.
+    """
+    full_data = _pack(new_text.encode('utf-8'))
+    if previous_revision is not None:
+        delta = make_delta(old_text, new_text)
+        delta_data = _pack(json.dumps(delta, separators=(',', ':')))
+        chain_size = previous_revision.chain_size + len(delta_data)
+        chain_length = version - previous_revision.checkpoint
+        if (chain_length <= _MAX_CHAIN_LENGTH and
+                chain_size <= _MAX_CHAIN_SIZE_RATIO * len(full_data)):
+            return SnippetRevision(key=revision_key(snippet_key, version),
+                                   version=version,
+                                   checkpoint=previous_revision.checkpoint,
+                                   chain_size=chain_size,
+                                   data=delta_data,
+                                   private=private)
+
+    return SnippetRevision(key=revision_key(snippet_key, version),
+                           version=version,
+                           checkpoint=version,
+                           chain_size=0,
+                           data=full_data,
+                           private=private)
+
+
+def _apply_revision(text, revision):
+    """Return the text at revision, given the text at the revision before."""
+    if revision.checkpoint == revision.version:
+        return _unpack(revision.data).decode('utf-8')
+    return apply_delta(text, json.loads(_unpack(revision.data)))
+
+
+def get_revision_text(snippet_key, version):
+    """Return the snippet's text as of the given version, or None.
+
+    This costs two batch gets and at most _MAX_CHAIN_LENGTH diff
+    applications, no matter how many revisions the snippet has.
+    """
+    revision = db.get(revision_key(snippet_key, version))
+    if revision is None:
+        return None
+    chain = db.get([revision_key(snippet_key, v)
+                    for v in xrange(revision.checkpoint, version)])
+    if None in chain:
+        return None
+    text = ''
+    for r in chain + [revision]:
+        text = _apply_revision(text, r)
+    return text
+
+
+def get_history(snippet_key, latest_version):
+    """Return every revision of the snippet, with its text, oldest first.
+
+    Arguments:
+      snippet_key: the key of the snippet whose history we want.
+      latest_version: the snippet's current version.
+
+    Returns:
+      A list of (SnippetRevision, text) pairs.  Versions we have no
+      revision for (those saved before we kept history) are omitted.
+    """
+    revisions = db.get([revision_key(snippet_key, v)
+                        for v in xrange(1, latest_version + 1)])
+    history = []
+    text = None
+    for revision in revisions:
+        if revision is None:
+            text = None
+            continue
+        if revision.checkpoint != revision.version and text is None:
+            continue       # we're missing the start of this chain
+        text = _apply_revision(text, revision)
+        history.append((revision, text))
+    return history
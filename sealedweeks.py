@@ -0,0 +1,87 @@
+import zlib
+
+from google.appengine.ext import db
+
+import models
+
+try:
+    import json
+except ImportError:      # python 2.5
+    from django.utils import simplejson as json
+
+"""Sealed weeks: old weeks whose snippets we keep ready-made.
+
+Once a week is older than the editing window, its snippets hardly
+ever change, but the weekly page for it would still query every
+snippet and user each time.  So the first time someone looks at such
+a week we 'seal' it: pack its snippets, and the users with their
+categories, into a single compressed blob that the storage backend
+keeps (see Storage.get_sealed_week_async()).  After that, looking at
+the week reads just the blob.
+
+Any edit to a snippet for the week unseals it, and the next view
+seals it again.  Nothing else does, so a sealed week keeps the users
+and categories it had when it was sealed; that's a feature, since
+people who joined later never wrote snippets for it anyway.
+
+A view that read the week just before an edit mustn't seal what it
+read after the edit has unsealed the week, or the edit would be lost
+for good.  So in the datastore a SealedWeek, once it exists, also
+counts how many times the week has been unsealed, and a view only
+seals if that count didn't change while it read the week.  See
+storage.DatastoreStorage.seal_week().
+
+Which weeks get sealed is up to the caller; see snippets.py.
+"""
+
+
+# The most pack()ed data we seal.  An entity can be at most 1MB, and
+# we leave room for the rest of it.
+MAX_PACKED_SIZE = 1000 * 1000
+
+
+class SealedWeek(db.Model):
+    """The pack()ed snippets and users for a week.
+
+    The key-name is the week's monday, as YYYY-MM-DD; see sealed_week_key().
+    """
+    data = db.BlobProperty()      # None if the week isn't sealed (yet)
+    # How many times the week has been unsealed.
+    generation = db.IntegerProperty(default=0)
+
+
+def sealed_week_key(week):
+    """Return the key of the SealedWeek for the week with this monday."""
+    return db.Key.from_path('SealedWeek', week.strftime('%Y-%m-%d'))
+
+
+def pack(snippets, users):
+    """Return a str holding everything the weekly page needs of these.
+
+    Arguments:
+      snippets: every Snippet for the week.
+      users: every User.
+    """
+    return zlib.compress(json.dumps({
+        'users': [[user.email, user.category] for user in users],
+        'snippets': [[snippet.email, snippet.text, snippet.private,
+                      snippet.domain, snippet.version]
+                     for snippet in snippets],
+        }))
+
+
+def unpack(data, week):
+    """Return the (snippets, users) that pack() packed into data.
+
+    The Snippets and Users have only the fields the weekly page uses.
+    """
+    unpacked = json.loads(zlib.decompress(data))
+    snippets = [models.Snippet(email=email, week=week, text=text,
+                               summary=models.summarize(text),
+                               private=private, domain=domain,
+                               version=version)
+                for (email, text, private, domain, version)
+                in unpacked['snippets']]
+    users = [models.User(email=email, category=category)
+             for (email, category) in unpacked['users']]
+    return (snippets, users)
@@ -1,20 +1,38 @@
+import collections
 import datetime
+import hashlib
 import logging
 import os
-import time
 import urllib
 
 # Before importing anything from appengine, set the django version we want.
 # Taken from http://stackoverflow.com/questions/4994913/app-engine-default-django-version-change
-from google.appengine.dist import use_library
-use_library('django', '1.2')
+# On the python2.7 runtime, app.yaml and appengine_config.py do this.
+if os.environ.get('APPENGINE_RUNTIME') != 'python27':
+    from google.appengine.dist import use_library
+    use_library('django', '1.2')
 
-from google.appengine.api import mail
-from google.appengine.api import users
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
-from google.appengine.ext import db
+
+import appconfig
+import assets
+import auth
+import cronshard
+import models
+from models import Snippet, User
+import reminderplans
+import sealedweeks
+import storage
+import tenants
+import weekcalendar
+import weeklystats
+
+try:
+    import json
+except ImportError:      # python 2.5
+    from django.utils import simplejson as json
 
 """Snippets server.
 
@@ -27,132 +45,250 @@ everyone's snippets in them.
 __author__ = 'Craig Silverstein <csilvers@khanacademy.org>'
 
 
-# Have the cron jobs send to HipChat in addition to email?
-_SEND_TO_HIPCHAT = True
+# Read once, by the first request that needs it, and never modified;
+# see appconfig.py and _default_config().
+_CONFIG = None
+
+# A request can carry its own Config in this WSGI environ variable.
+# Tests use it to set the clock without touching anything that
+# concurrent requests share.
+_CONFIG_ENVIRON_KEY = 'snippets.config'
+
+
+def _default_config():
+    """Return the Config from our cfg files, reading them if need be.
+
+    We read them on first use, rather than at import, so they don't
+    slow down an instance's startup (see import_benchmark.py).  If
+    concurrent requests both get here first, both read the files, and
+    get the same Config.
+    """
+    global _CONFIG
+    if _CONFIG is None:
+        _CONFIG = appconfig.load(
+            os.path.join(os.path.dirname(__file__), 'hipchat.cfg'),
+            os.path.join(os.path.dirname(__file__), 'snippets.cfg'))
+    return _CONFIG
+
+
+def _config_for_environ(environ):
+    """Return the Config to use for the request with this WSGI environ."""
+    config = environ.get(_CONFIG_ENVIRON_KEY)
+    if config is None:
+        config = _default_config()
+    return config
+
+
+def _config(request):
+    """Return the Config to use for request."""
+    return _config_for_environ(request.environ)
+
 
-if _SEND_TO_HIPCHAT:
+def _now(request):
+    """Return the current time, for request.  See weekcalendar.now()."""
+    return _config(request).now_fn()
+
+
+def _send_to_hipchat_room(config, room_name, message):
+    """Send a message to HipChat.  Call only if config.send_to_hipchat."""
     import hipchatlib
-    if not hipchatlib.hipchat_init():
-        _SEND_TO_HIPCHAT = False
-        logging.error('Unable to initialize HipChat; not sending msgs there')
+    hipchatlib.send_to_hipchat_room(config, room_name, message)
+
+
+def _send_to_tenant_hipchat_room(config, tenant, message):
+    """Send a message to the tenant's HipChat room, if it has one.
+
+    tenant is None if we're not multi-tenant.  See _for_each_tenant().
+    """
+    room_name = appconfig.hipchat_room(config, tenant)
+    if config.send_to_hipchat and room_name:
+        _send_to_hipchat_room(config, room_name, message)
+
 
+def _for_each_tenant(config, fn):
+    """Call fn(tenant) in each tenant's namespace; see tenants.py.
 
-# This allows mocking in a different day, for testing.
-_TODAY_FN = datetime.datetime.now
+    If we're not multi-tenant, we just call fn(None).
+    """
+    if config.multitenant:
+        tenants.for_each_tenant(fn)
+    else:
+        fn(None)
+
+
+# Every template we render, keyed by filename.  We load and compile
+# them all once, at import time (or from the warmup handler), so
+# individual requests never pay the django parsing cost -- including
+# the cost of parsing header.html, which most pages include.
+_TEMPLATE_NAMES = ('user_snippets.html',
+                   'weekly_snippets.html',
+                   'weekly_category.html',
+                   'weekly_category_lazy.html',
+                   'weekly_snippets_end.html',
+                   'category_timeline.html',
+                   'settings.html',
+                   'new_user.html',
+                   'snippet_history.html',
+                   'cron_status.html',
+                   'stats.html',
+                   'reminder_email',
+                   'view_email',
+                   )
+_TEMPLATES = {}
+
+
+def _load_templates():
+    """Compile every template in _TEMPLATE_NAMES into _TEMPLATES.
+
+    This is idempotent: templates that are already loaded are skipped.
+    """
+    for template_name in _TEMPLATE_NAMES:
+        if template_name not in _TEMPLATES:
+            path = os.path.join(os.path.dirname(__file__), template_name)
+            _TEMPLATES[template_name] = template.load(path)
 
 
-# Note: I use email address rather than a UserProperty to uniquely
-# identify a user.  As per
-# http://code.google.com/appengine/docs/python/users/userobjects.html
-# a UserProperty is an email+unique id, so if a person changes their
-# email the UserProperty also changes; it's not a persistent
-# identifier across email changes the way the unique-id alone is.  But
-# non-google users can't have a unique id, so if I want to expand the
-# snippet server later that won't scale.  So might as well use email
-# as our unique identifier.  If someone changes email address and
-# wants to take their snippets with them, we can add functionality to
-# support that later.
+# Where pages load their javascript from; see assets.py.  Every
+# template can use these as {{assets.<name>}}.
+_ASSET_URLS = assets.load_urls(os.path.dirname(__file__))
 
-class User(db.Model):
-    """User preferences."""
-    email = db.StringProperty(required=True)           # The key to this record
-    category = db.StringProperty(default='(unknown)')  # used to group snippets
-    wants_email = db.BooleanProperty(default=True)     # get nag emails?
-    # TODO(csilvers): make a ListProperty instead.
-    wants_to_view = db.TextProperty(default='all')     # comma-separated list
 
+def _render_template(template_name, template_values):
+    """Render the (precompiled) template with the given name to a string."""
+    if template_name not in _TEMPLATES:
+        _load_templates()
+    return _TEMPLATES[template_name].render(
+        template.Context(dict(template_values, assets=_ASSET_URLS)))
 
-class Snippet(db.Model):
-    """Every snippet is identified by the monday of the week it goes with."""
-    email = db.StringProperty(required=True)  # week+email: key to this record
-    week = db.DateProperty(required=True)     # the monday of the week
-    text = db.TextProperty(default='(No snippet for this week)')
-    private = db.BooleanProperty(default=False)
+
+_load_templates()
+
+
+# Where we keep users and snippets (see storage.py), and who tells us
+# who's logged in (see auth.py).
+_Backends = collections.namedtuple('_Backends', ('storage', 'auth'))
+
+# Unless the request says otherwise, we use appengine's.
+_DEFAULT_BACKENDS = _Backends(storage=storage.DatastoreStorage(),
+                              auth=auth.AppEngineAuth())
+
+# A request can carry other _Backends in this WSGI environ variable;
+# see with_backends().
+_BACKENDS_ENVIRON_KEY = 'snippets.backends'
+
+
+def _backends(request):
+    """Return the _Backends to use for request."""
+    return request.environ.get(_BACKENDS_ENVIRON_KEY, _DEFAULT_BACKENDS)
+
+
+def _storage(request):
+    """Return the storage.Storage to use for request."""
+    return _backends(request).storage
+
+
+def _auth(request):
+    """Return the auth.AuthProvider to use for request."""
+    return _backends(request).auth
+
+
+def with_backends(application, storage_backend, auth_provider):
+    """Return a WSGI application that serves application with these backends.
+
+    application keeps data in storage_backend, and asks auth_provider
+    who's logged in, rather than using appengine's datastore and users
+    API.  This is for running outside of appengine; see standalone.py.
+    """
+    backends = _Backends(storage=storage_backend, auth=auth_provider)
+
+    def wrapped_application(environ, start_response):
+        environ[_BACKENDS_ENVIRON_KEY] = backends
+        return application(environ, start_response)
+    return wrapped_application
 
 
 def _login_page(request, redirector):
     """Redirect the user to a page where they can log in."""
-    redirector.redirect(users.create_login_url(request.uri))
+    redirector.redirect(_auth(request).create_login_url(request.uri))
+
 
+def _current_user_email(request):
+    """Return the logged-in user's email address, converted into lowercase.
 
-def _current_user_email():
-    """Return the logged-in user's email address, converted into lowercase."""
-    return users.get_current_user().email().lower()
+    Returns None if nobody is logged in.
+    """
+    email = _auth(request).get_current_user_email()
+    return email and email.lower()
 
 
-def _get_user(email):
+def _get_user_async(request, email):
+    """Start looking up the user with the given email; return a future.
+
+    The future is a function that returns the user object, or None
+    if not found.
+    """
+    return _storage(request).get_user_async(email)
+
+
+def _get_user(request, email):
     """Return the user object with the given email, or None if not found."""
-    q = User.all()
-    q.filter('email = ', email)
-    return q.get()
+    return _get_user_async(request, email)()
+
 
+def _get_or_create_user(request, email, now):
+    """Return the user object with the given email, creating if if needed.
 
-def _get_or_create_user(email):
-    """Return the user object with the given email, creating if if needed."""
-    user = _get_user(email)
+    now is the current time, e.g. from _now().
+    """
+    user = _get_user(request, email)
     if user:
         pass
-    elif not _logged_in_user_has_permission_for(email):
+    elif not _logged_in_user_has_permission_for(request, email):
         raise IndexError('User "%s" not found; did you specify'
                          ' the full email address?' % email)
     else:
         user = User(email=email)
-        db.put(user)
-        db.get(user.key())    # ensure db consistency for HRD
+        _storage(request).save_user(user, now)
     return user
 
 
-def _newsnippet_monday(today):
+def _newsnippet_monday(today, timezone_name=None):
     """Return a datetime.date object: the monday for new snippets.
 
-    The rule is that up through wednesday, all snippets are assumed to
-    be for the previous week.  Starting on thursday, by default you
-    start putting in snippets for this week.
-
     Arguments:
        today: the current day as a datetime.datetime object, used to
           calculate the best monday.
+       timezone_name: the timezone of the user the snippets are for,
+          or None for the default; see weekcalendar.
 
     Returns:
        The Monday that we are accepting new snippets for, by default,
        as a datetime.date (not datetime.datetime) object.
     """
-    today_weekday = today.weekday()   # monday == 0, sunday == 6
-    if today_weekday <= 2:            # wed or before
-        end_monday = today - datetime.timedelta(today_weekday + 7)
-    else:
-        end_monday = today - datetime.timedelta(today_weekday)
-    return end_monday.date()
+    return weekcalendar.get_calendar(timezone_name).newsnippet_monday(today)
 
 
-def _existingsnippet_monday(today):
+def _existingsnippet_monday(today, timezone_name=None):
     """Return a datetime.date object: the monday for existing snippets.
 
-    The rule is that we show the snippets for the previous week.  We
-    declare a week starts on Monday...well, actually, Sunday at 11pm.
-    The reason for this is that (for quota reasons) we sent out a
-    reminder email Sunday at 11:50pm rather than Monday morning, and
-    we want that to count as 'Monday' anyway...
-
     Arguments:
        today: the current day as a datetime.datetime object, used to
           calculate the best monday.
+       timezone_name: the timezone of the user viewing the snippets,
+          or None for the default; see weekcalendar.
 
     Returns:
-       The Monday that we are accepting new snippets for, by default,
+       The Monday of the week whose snippets we show, by default,
        as a datetime.date (not datetime.datetime) object.
     """
-    today_weekday = today.weekday()   # monday == 0, sunday == 6
-    if today_weekday == 6 and today.hour >= 23:
-        end_monday = today - datetime.timedelta(today_weekday)
-    else:
-        end_monday = today - datetime.timedelta(today_weekday + 7)
-    return end_monday.date()
+    return weekcalendar.get_calendar(
+        timezone_name).existingsnippet_monday(today)
 
 
-def _logged_in_user_has_permission_for(email):
+def _logged_in_user_has_permission_for(request, email):
     """True if the current logged-in appengine user can edit this user."""
-    return (email == _current_user_email()) or users.is_current_user_admin()
+    return (email == _current_user_email(request) or
+            _auth(request).is_current_user_admin())
 
 
 def _can_view_private_snippets(my_email, snippet_email):
@@ -170,14 +306,27 @@ def _can_view_private_snippets(my_email, snippet_email):
       True if my_email has permission to view snippet_email's private
       emails, or False else.
     """
-    my_at = my_email.rfind('@')
-    snippet_at = snippet_email.rfind('@')
-    if my_at == -1 or snippet_at == -1:
-        return False    # be safe
-    return my_email[my_at:] == snippet_email[snippet_at:]
+    my_domain = models.email_domain(my_email)
+    return (my_domain is not None and
+            my_domain == models.email_domain(snippet_email))
+
+
+def _visible_snippets(my_email, snippets):
+    """Return those of snippets that my_email may see.
+
+    This is _can_view_private_snippets() for a whole list: we work out
+    my_email's domain just once, and compare it to each private
+    snippet's precomputed Snippet.domain.
+    """
+    my_domain = models.email_domain(my_email)
+    if my_domain is None:
+        return [snippet for snippet in snippets if not snippet.private]
+    return [snippet for snippet in snippets
+            if not snippet.private or models.domain_of(snippet) == my_domain]
 
 
-def fill_in_missing_snippets(existing_snippets, user_email, today):
+def fill_in_missing_snippets(existing_snippets, user_email, today,
+                             timezone_name=None):
     """Make sure that the snippets array has a Snippet entry for every week.
 
     The db may have holes in it -- weeks where the user didn't write a
@@ -195,11 +344,13 @@ def fill_in_missing_snippets(existing_snippets, user_email, today):
          We fill up to then.  If today is wed or before, then we
          fill up to the previous week.  If it's thurs or after, we
          fill up to the current week.
+       timezone_name: the user's timezone, which determines what
+         day 'today' is for them, or None for the default.
 
     Returns:
       A new list of Snippet objects, without any holes.
     """
-    end_monday = _newsnippet_monday(today)
+    end_monday = _newsnippet_monday(today, timezone_name)
     if not existing_snippets:         # no snippets at all?  Just do this week
         return [Snippet(email=user_email, week=end_monday)]
 
@@ -221,116 +372,507 @@ def fill_in_missing_snippets(existing_snippets, user_email, today):
     return all_snippets
 
 
+def _get_snippets_for_user_async(request, my_email, user_email):
+    """Start fetching user_email's snippets; return a future for them.
+
+    The future is a function that returns what _get_snippets_for_user()
+    would.
+    """
+    snippets_future = _storage(request).get_snippets_for_user_async(
+        user_email)
+
+    def future():
+        snippets = snippets_future()
+        if not _can_view_private_snippets(my_email, user_email):
+            snippets = [snippet for snippet in snippets
+                        if not snippet.private]
+        return snippets
+    return future
+
+
+def _get_snippets_for_user(request, my_email, user_email):
+    """Return all of user_email's snippets that my_email may see.
+
+    Arguments:
+      my_email: the email address of the currently logged in user
+      user_email: the email address of the person whose snippets we want.
+
+    Returns:
+      A list of Snippet objects, oldest first.  Weeks without a
+      snippet are not filled in; see fill_in_missing_snippets().
+    """
+    return _get_snippets_for_user_async(request, my_email, user_email)()
+
+
+def _get_categories_and_snippets_async(request, my_email, week,
+                                       summary_only=False, sealable=False):
+    """Start getting the snippets for the given week; return a future.
+
+    The future is a function that returns what
+    _get_categories_and_snippets() would.
+    """
+    if sealable:
+        sealed_week_future = _storage(request).get_sealed_week_async(week)
+
+        def future():
+            data = sealed_week_future()
+            if data is None:
+                (snippets, users) = _storage(request).seal_week(week)
+            else:
+                (snippets, users) = sealedweeks.unpack(data, week)
+            return _categorize_snippets(my_email, week, snippets, users)
+        return future
+
+    # We start both the snippets query and the users query (which we
+    # need to categorize the snippets) before waiting for either.
+    snippets_future = _storage(request).get_snippets_for_week_async(
+        week, summary_only)
+    users_future = _storage(request).get_all_users_async()
+    return lambda: _categorize_snippets(my_email, week, snippets_future(),
+                                        users_future())
+
+
+def _get_categories_and_snippets(request, my_email, week,
+                                 summary_only=False, sealable=False):
+    """Return the snippets for the given week, grouped by category.
+
+    Every registered user gets an entry: people who did not write a
+    snippet this week get a placeholder snippet saying so.  Private
+    snippets that my_email does not have permission to see are
+    treated as missing.
+
+    Arguments:
+      my_email: the email address of the currently logged in user
+      week: the monday of the week we want, as a datetime.date.
+      summary_only: if True, we fetch only the email, private and
+        summary fields of each snippet.  This is much cheaper, but the
+        snippets that are returned have *only* those fields.
+      sealable: if True, the week is old enough to seal (see
+        _is_sealable()), so we read it from its sealed copy, sealing
+        it first if need be.  summary_only doesn't matter then.
+
+    Returns:
+      A sorted list of (category, [snippet, ...]) pairs, categories in
+      alphabetical order and the snippets in each category sorted by
+      author.
+    """
+    return _get_categories_and_snippets_async(request, my_email, week,
+                                              summary_only, sealable)()
+
+
+def _categorize_snippets(my_email, week, snippets, users):
+    """The guts of _get_categories_and_snippets(), once the reads finish."""
+    # TODO(csilvers): filter based on wants_to_view
+    email_to_category = {}
+    for user in users:
+        email_to_category[user.email] = user.category
+
+    # Collect the snippets by category.  As we see each email,
+    # delete it from email_to_category.  At the end of this,
+    # email_to_category will hold people who did not give
+    # snippets this week.
+    snippets_by_category = {}
+    # Ignore snippets we don't have permission to view.
+    for snippet in _visible_snippets(my_email, snippets):
+        category = email_to_category.get(snippet.email, '(unknown)')
+        snippets_by_category.setdefault(category, []).append(snippet)
+        if snippet.email in email_to_category:
+            del email_to_category[snippet.email]
+
+    # Add in empty snippets for the people who didn't have any.
+    for (email, category) in email_to_category.iteritems():
+        snippet = Snippet(email=email, week=week,
+                          text='(no snippet this week)',
+                          summary='(no snippet this week)')
+        snippets_by_category.setdefault(category, []).append(snippet)
+
+    # Now get a sorted list, categories in alphabetical order and
+    # each snippet-author within the category in alphabetical
+    # order.  The data structure is ((category, (snippet, ...)), ...)
+    categories_and_snippets = []
+    for category in snippets_by_category:
+        snippets = snippets_by_category[category]
+        snippets.sort(key=lambda snippet: snippet.email)
+        categories_and_snippets.append((category, snippets))
+    categories_and_snippets.sort()
+    return categories_and_snippets
+
+
 class UserPage(webapp.RequestHandler):
     """Show all the snippets for a single user."""
 
     def get(self):
-        if not users.get_current_user():
+        if not _current_user_email(self.request):
             return _login_page(self.request, self)
 
-        user_email = self.request.get('u', _current_user_email())
+        user_email = self.request.get('u', _current_user_email(self.request))
+        # Start fetching the snippets while we look up the user.
+        user_future = _get_user_async(self.request, user_email)
+        snippets_future = _get_snippets_for_user_async(
+            self.request, _current_user_email(self.request), user_email)
+        user = user_future()
 
-        if not _get_user(user_email):
+        if not user:
             template_values = {
-                'login_url': users.create_login_url(self.request.uri),
-                'logout_url': users.create_logout_url('/'),
+                'login_url': _auth(self.request).create_login_url(
+                    self.request.uri),
+                'logout_url': _auth(self.request).create_logout_url('/'),
                 'username': user_email,
                 }
-            path = os.path.join(os.path.dirname(__file__), 'new_user.html')
-            self.response.out.write(template.render(path, template_values))
+            self.response.out.write(_render_template('new_user.html',
+                                                     template_values))
             return
 
-        snippets_q = Snippet.all()
-        snippets_q.filter('email = ', user_email)
-        snippets_q.order('week')            # this puts oldest snippet first
-        snippets = snippets_q.fetch(1000)   # good for many years...
-
-        if not _can_view_private_snippets(_current_user_email(), user_email):
-            snippets = [snippet for snippet in snippets if not snippet.private]
-        snippets = fill_in_missing_snippets(snippets, user_email, _TODAY_FN())
+        snippets = snippets_future()
+        snippets = fill_in_missing_snippets(snippets, user_email,
+                                            _now(self.request), user.timezone)
         snippets.reverse()                  # get to newest snippet first
 
         template_values = {
-            'logout_url': users.create_logout_url('/'),
+            'logout_url': _auth(self.request).create_logout_url('/'),
             'message': self.request.get('msg'),
             'username': user_email,
             'domain': user_email.split('@')[-1],
-            'view_week': _existingsnippet_monday(_TODAY_FN()),
-            'editable': _logged_in_user_has_permission_for(user_email),
+            'view_week': _existingsnippet_monday(_now(self.request)),
+            'editable': _logged_in_user_has_permission_for(self.request,
+                                                           user_email),
             'snippets': snippets,
             }
-        path = os.path.join(os.path.dirname(__file__), 'user_snippets.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(_render_template('user_snippets.html',
+                                                 template_values))
+
+
+# The Cache-Control header for pages showing a sealed week.  They
+# differ by viewer, so only browsers may cache them.
+_SEALED_WEEK_CACHE_CONTROL = 'private, max-age=%d' % (7 * 24 * 60 * 60)
+
+
+def _requested_week(request):
+    """Return the monday of the week request asks to see."""
+    week_string = request.get('week')
+    if week_string:
+        return datetime.datetime.strptime(week_string, '%m-%d-%Y').date()
+    return _existingsnippet_monday(_now(request))
+
+
+def _is_sealable(request, week):
+    """True if week is old enough that request may see it sealed.
+
+    That's when it's at least the configured number of weeks older
+    than the week the weekly page shows by default.  See sealedweeks.py.
+    """
+    seal_after_weeks = _config(request).seal_after_weeks
+    if not seal_after_weeks:
+        return False
+    return week <= (_existingsnippet_monday(_now(request)) -
+                    datetime.timedelta(7 * seal_after_weeks))
+
+
+# Weeks with at least this many snippets (counting the placeholders
+# for people who didn't write one) get a weekly page whose categories
+# load as they're needed.
+_LAZY_WEEKLY_PAGE_MIN_SNIPPETS = 100
+
+
+def _weekly_page_chunks(request, week, sealable):
+    """Yield the html of the /weekly page for request, a piece at a time.
+
+    We yield the top of the page before waiting for any snippets, and
+    then each category as we render it, so that (where the server
+    doesn't buffer the response) browsers can start drawing the page
+    before it's all ready.  The caller must make sure someone is
+    logged in, and pass the week to show -- _requested_week() -- and
+    whether it's _is_sealable().
+    """
+    categories_and_snippets_future = _get_categories_and_snippets_async(
+        request, _current_user_email(request), week, sealable=sealable)
+
+    template_values = {
+        'logout_url': _auth(request).create_logout_url('/'),
+        'message': request.get('msg'),
+        # Used only to switch to 'username' mode and to modify settings.
+        'username': _current_user_email(request),
+        'prev_week': week - datetime.timedelta(7),
+        'view_week': week,
+        'next_week': week + datetime.timedelta(7),
+        }
+    yield _render_template('weekly_snippets.html', template_values)
+
+    categories_and_snippets = categories_and_snippets_future()
+    num_snippets = sum(len(snippets)
+                       for (_, snippets) in categories_and_snippets)
+    if num_snippets < _LAZY_WEEKLY_PAGE_MIN_SNIPPETS:
+        for (category, snippets) in categories_and_snippets:
+            yield _render_template('weekly_category.html',
+                                   {'category': category,
+                                    'snippets': snippets})
+    else:
+        # Too many to send at once: we send just the categories, and
+        # the page fetches each one's snippets (from JsonSummary) when
+        # it comes into view.  Only the viewer's own category starts
+        # out expanded.
+        my_email = _current_user_email(request)
+        for (category, snippets) in categories_and_snippets:
+            yield _render_template('weekly_category_lazy.html', {
+                'category': category,
+                'week': week,
+                'num_snippets': len(snippets),
+                'collapsed': my_email not in [s.email for s in snippets],
+                })
+
+    yield _render_template('weekly_snippets_end.html', {})
 
 
 class SummaryPage(webapp.RequestHandler):
-    """Show all the snippets for a single week."""
+    """Show all the snippets for a single week.
+
+    Appengine sends the response only once it's complete, so we don't
+    gain anything by streaming it here; see stream_weekly_page().
+    """
 
     def get(self):
-        if not users.get_current_user():
+        if not _current_user_email(self.request):
             return _login_page(self.request, self)
 
-        week_string = self.request.get('week')
-        if week_string:
-            week = datetime.datetime.strptime(week_string, '%m-%d-%Y').date()
+        week = _requested_week(self.request)
+        sealable = _is_sealable(self.request, week)
+        if sealable:
+            self.response.headers['Cache-Control'] = (
+                _SEALED_WEEK_CACHE_CONTROL)
+        for chunk in _weekly_page_chunks(self.request, week, sealable):
+            self.response.out.write(chunk)
+
+
+def stream_weekly_page(environ, start_response):
+    """A WSGI application that serves /weekly a piece at a time.
+
+    This does what SummaryPage does, but sends each piece of the page
+    as soon as it's ready, for servers that pass them on as they come
+    (see standalone.py).
+    """
+    request = webapp.Request(environ)
+    if not _current_user_email(request):
+        start_response('302 Found',
+                       [('Location',
+                         _auth(request).create_login_url(request.uri))])
+        return []
+    week = _requested_week(request)
+    sealable = _is_sealable(request, week)
+    headers = [('Content-Type', 'text/html; charset=utf-8')]
+    if sealable:
+        headers.append(('Cache-Control', _SEALED_WEEK_CACHE_CONTROL))
+    start_response('200 OK', headers)
+    return (chunk.encode('utf-8')
+            for chunk in _weekly_page_chunks(request, week, sealable))
+
+
+# How many weeks /category shows by default: about a quarter.
+_TIMELINE_DEFAULT_WEEKS = 13
+
+# The most weeks /category will show at once.
+_TIMELINE_MAX_WEEKS = 53
+
+
+class CategoryTimeline(webapp.RequestHandler):
+    """Show a category's snippets for a range of weeks, week by week.
+
+    The url parameters are name (the category; the default is the
+    viewer's own), and from and to (the mondays of the first and last
+    weeks, as mm-dd-yyyy; the default is the last quarter).  We read
+    the whole range with a single query.
+    """
+
+    def get(self):
+        my_email = _current_user_email(self.request)
+        if not my_email:
+            return _login_page(self.request, self)
+
+        category = self.request.get('name')
+        if not category:
+            user = _get_user(self.request, my_email)
+            category = user and user.category or User.category.default
+
+        if self.request.get('to'):
+            last_week = datetime.datetime.strptime(self.request.get('to'),
+                                                   '%m-%d-%Y').date()
         else:
-            week = _existingsnippet_monday(_TODAY_FN())
-
-        snippets_q = Snippet.all()
-        snippets_q.filter('week = ', week)
-        snippets = snippets_q.fetch(1000)   # good for many users...
-        # TODO(csilvers): filter based on wants_to_view
-
-        # Get all the user records so we can categorize snippets.
-        user_q = User.all()
-        results = user_q.fetch(1000)
-        email_to_category = {}
-        for result in results:
-            email_to_category[result.email] = result.category
-
-        # Collect the snippets by category.  As we see each email,
-        # delete it from email_to_category.  At the end of this,
-        # email_to_category will hold people who did not give
-        # snippets this week.
-        snippets_by_category = {}
+            last_week = _existingsnippet_monday(_now(self.request))
+        if self.request.get('from'):
+            first_week = datetime.datetime.strptime(self.request.get('from'),
+                                                    '%m-%d-%Y').date()
+        else:
+            first_week = last_week - datetime.timedelta(
+                7 * (_TIMELINE_DEFAULT_WEEKS - 1))
+        first_week = max(first_week, last_week - datetime.timedelta(
+            7 * (_TIMELINE_MAX_WEEKS - 1)))
+
+        snippets = _visible_snippets(
+            my_email, _storage(self.request).get_snippets_for_category(
+                category, first_week, last_week, _now(self.request)))
+        week_to_snippets = {}
         for snippet in snippets:
-            # Ignore this snippet if we don't have permission to view it.
-            if (not snippet.private or
-                _can_view_private_snippets(_current_user_email(),
-                                           snippet.email)):
-                category = email_to_category.get(snippet.email, '(unknown)')
-                snippets_by_category.setdefault(category, []).append(snippet)
-                if snippet.email in email_to_category:
-                    del email_to_category[snippet.email]
-
-        # Add in empty snippets for the people who didn't have any.
-        for (email, category) in email_to_category.iteritems():
-            snippet = Snippet(email=email, week=week,
-                              text='(no snippet this week)')
-            snippets_by_category.setdefault(category, []).append(snippet)
-
-        # Now get a sorted list, categories in alphabetical order and
-        # each snippet-author within the category in alphabetical
-        # order.  The data structure is ((category, (snippet, ...)), ...)
-        categories_and_snippets = []
-        for category in snippets_by_category:
-            snippets = snippets_by_category[category]
-            snippets.sort(key=lambda snippet: snippet.email)
-            categories_and_snippets.append((category, snippets))
-        categories_and_snippets.sort()
+            week_to_snippets.setdefault(snippet.week, []).append(snippet)
+        weeks = []
+        week = first_week
+        while week <= last_week:
+            weeks.append({'week': week,
+                          'snippets': sorted(week_to_snippets.get(week, []),
+                                             key=lambda s: s.email)})
+            week += datetime.timedelta(7)
 
         template_values = {
-            'logout_url': users.create_logout_url('/'),
+            'logout_url': _auth(self.request).create_logout_url('/'),
             'message': self.request.get('msg'),
-            # Used only to switch to 'username' mode and to modify settings.
-            'username': _current_user_email(),
-            'prev_week': week - datetime.timedelta(7),
-            'view_week': week,
-            'next_week': week + datetime.timedelta(7),
-            'categories_and_snippets': categories_and_snippets,
+            'username': my_email,
+            'view_week': last_week,
+            'category': category,
+            'first_week': first_week,
+            'last_week': last_week,
+            'weeks': weeks,
+            }
+        self.response.out.write(_render_template('category_timeline.html',
+                                                 template_values))
+
+
+def _snippet_to_json_dict(snippet, summary_only=False):
+    """Return a dict holding the parts of a snippet that we export as json.
+
+    If summary_only is True, snippet may come from a summary-only
+    query (see _get_categories_and_snippets), and we export only the
+    fields such a query fetches.  Snippets that predate summaries
+    never come from such a query, so we summarize them here.
+    """
+    if summary_only:
+        summary = snippet.summary
+        if summary is None:
+            summary = models.summarize(snippet.text)
+        return {'email': snippet.email,
+                'summary': summary,
+                'private': snippet.private,
+                }
+    return {'email': snippet.email,
+            'week': snippet.week.strftime('%m-%d-%Y'),
+            'text': snippet.text,
+            'private': snippet.private,
+            'version': snippet.version,
             }
-        path = os.path.join(os.path.dirname(__file__), 'weekly_snippets.html')
-        self.response.out.write(template.render(path, template_values))
+
+
+def _write_json_response(handler, status, obj):
+    """Write obj to the response as json, with support for conditional GET.
+
+    We set an ETag that is a hash of the response content.  If the
+    client tells us (via If-None-Match) that it already has that
+    content, we send back a 304 with no body instead.
+
+    Arguments:
+      handler: the webapp.RequestHandler that is responding.
+      status: the http status code to use.
+      obj: a json-serializable object to write as the response body.
+    """
+    # sort_keys makes the output, and thus the etag, deterministic.
+    body = json.dumps(obj, sort_keys=True)
+    etag = '"%s"' % hashlib.md5(body.encode('utf-8')).hexdigest()
+    handler.response.headers['Content-Type'] = 'application/json'
+    handler.response.headers['ETag'] = etag
+    if_none_match = handler.request.headers.get('If-None-Match', '')
+    if status == 200 and etag in [t.strip() for t in if_none_match.split(',')]:
+        handler.response.set_status(304)
+        return
+    handler.response.set_status(status)
+    handler.response.out.write(body)
+
+
+class JsonUserSnippets(webapp.RequestHandler):
+    """Return all the snippets for a single user, as json."""
+
+    def get(self):
+        if not _current_user_email(self.request):
+            _write_json_response(self, 403, {'status': 403,
+                                             'message': 'not logged in'})
+            return
+
+        user_email = self.request.get('u', _current_user_email(self.request))
+        snippets = _get_snippets_for_user(
+            self.request, _current_user_email(self.request), user_email)
+        _write_json_response(self, 200, {
+            'email': user_email,
+            'snippets': [_snippet_to_json_dict(s) for s in snippets],
+            })
+
+
+class JsonSummary(webapp.RequestHandler):
+    """Return all the snippets for a single week, by category, as json.
+
+    With summary=1, we return only the first part of each snippet's
+    text (and don't fetch the rest from the db).  With category=<name>,
+    we return only that category; this is how big weekly pages load
+    their categories.
+    """
+
+    def get(self):
+        if not _current_user_email(self.request):
+            _write_json_response(self, 403, {'status': 403,
+                                             'message': 'not logged in'})
+            return
+
+        week = _requested_week(self.request)
+        summary_only = self.request.get('summary') == '1'
+        sealable = _is_sealable(self.request, week)
+        categories_and_snippets = _get_categories_and_snippets(
+            self.request, _current_user_email(self.request), week,
+            summary_only=summary_only, sealable=sealable)
+        if sealable:
+            self.response.headers['Cache-Control'] = (
+                _SEALED_WEEK_CACHE_CONTROL)
+        if self.request.get('category'):
+            categories_and_snippets = [
+                (category, snippets)
+                for (category, snippets) in categories_and_snippets
+                if category == self.request.get('category')]
+        _write_json_response(self, 200, {
+            'week': week.strftime('%m-%d-%Y'),
+            'categories': [
+                {'category': category,
+                 'snippets': [_snippet_to_json_dict(s, summary_only)
+                              for s in snippets]}
+                for (category, snippets) in categories_and_snippets],
+            })
+
+
+def _update_snippets(request, email, edits, now):
+    """Save a batch of snippet edits for a single user.
+
+    Edits that would not change anything are skipped entirely, and
+    edits based on an out-of-date version of their snippet are
+    rejected rather than clobbering somebody else's changes.
+
+    Arguments:
+      email: the email address of the user whose snippets these are.
+      edits: a list of (week, text, private, version) tuples, where
+        week is the monday of the snippet's week, as a datetime.date,
+        and version is the version of the snippet the edit is based
+        on (see Snippet.version), or None to save unconditionally.
+      now: the current time; see _now().
+
+    Returns:
+      A pair (saved_snippets, stale_snippets).  saved_snippets holds
+      the snippets we wrote.  stale_snippets holds the current db
+      value of each snippet whose edit we rejected for being based on
+      an old version; the caller should let the user merge.
+    """
+    weeks = [edit[0] for edit in edits]
+    for week in weeks:
+        assert week.weekday() == 0, 'passed-in date must be a Monday'
+
+    (saved, stale) = _storage(request).save_snippets(email, edits, now)
+
+    if saved:
+        # When adding a snippet, make sure we create a user record for
+        # that email as well, if it doesn't already exist.
+        _get_or_create_user(request, email, now)
+
+    return (saved, stale)
 
 
 # TODO(csilvers): would like to move to an ajax model where each
@@ -344,31 +886,21 @@ class UpdateSnippet(webapp.RequestHandler):
     def update_snippet(self, email):
         week_string = self.request.get('week')
         week = datetime.datetime.strptime(week_string, '%m-%d-%Y').date()
-        assert week.weekday() == 0, 'passed-in date must be a Monday'
 
         text = self.request.get('snippet')
 
         private = self.request.get('private') == 'True'
 
-        q = Snippet.all()
-        q.filter('email = ', email)
-        q.filter('week = ', week)
-        snippet = q.get()
+        # The version of the snippet this edit is based on.  If it's
+        # not specified, we save no matter what is in the db.
+        version = None
+        if self.request.get('version'):
+            version = int(self.request.get('version'))
 
-        if snippet:
-            snippet.text = text   # just update the snippet text
-            snippet.private = private
-        else:
-            # add the snippet to the db
-            snippet = Snippet(email=email, week=week,
-                              text=text, private=private)
-        db.put(snippet)
-        db.get(snippet.key())  # ensure db consistency for HRD
-
-        # When adding a snippet, make sure we create a user record for
-        # that email as well, if it doesn't already exist.
-        _get_or_create_user(email)
-        self.response.set_status(200)
+        (_, stale_snippets) = _update_snippets(
+            self.request, email, [(week, text, private, version)],
+            _now(self.request))
+        return stale_snippets
 
     def post(self):
         """handle ajax updates via POST
@@ -381,16 +913,16 @@ class UpdateSnippet(webapp.RequestHandler):
 
         self.response.headers['Content-Type'] = 'application/json'
 
-        if not users.get_current_user():
+        if not _current_user_email(self.request):
             # 403s are the catch-all 'please log in error' here
             self.response.set_status(403)
             self.response.out.write('{"status": 403, '
                                     '"message": "not logged in"}')
             return
 
-        email = self.request.get('u', _current_user_email())
+        email = self.request.get('u', _current_user_email(self.request))
 
-        if not _logged_in_user_has_permission_for(email):
+        if not _logged_in_user_has_permission_for(self.request, email):
             # TODO(marcos): present these messages to the ajax client
             self.response.set_status(403)
             error = 'You do not have permissions to update user' \
@@ -399,67 +931,179 @@ class UpdateSnippet(webapp.RequestHandler):
                                     '"message": "%s"}' % error)
             return
 
-        self.update_snippet(email)
+        stale_snippets = self.update_snippet(email)
+        if stale_snippets:
+            _write_json_response(self, 409, {
+                'status': 409,
+                'message': 'snippet was changed by someone else',
+                'conflicts': [_snippet_to_json_dict(s)
+                              for s in stale_snippets],
+                })
+            return
+        self.response.set_status(200)
         self.response.out.write('{"status": 200, "message": "ok"}')
 
     def get(self):
-        if not users.get_current_user():
+        if not _current_user_email(self.request):
             return _login_page(self.request, self)
 
-        email = self.request.get('u', _current_user_email())
-        if not _logged_in_user_has_permission_for(email):
+        email = self.request.get('u', _current_user_email(self.request))
+        if not _logged_in_user_has_permission_for(self.request, email):
             # TODO(csilvers): return a 403 here instead.
             raise RuntimeError('You do not have permissions to update user'
                                ' snippets for %s' % email)
         
-        self.update_snippet(email)
+        if self.update_snippet(email):
+            self.redirect("/?msg=Snippet+not+saved:+it+was+changed+elsewhere"
+                          "&u=%s" % urllib.quote(email))
+            return
 
-        email = self.request.get('u', _current_user_email())
         self.redirect("/?msg=Snippet+saved&u=%s" % urllib.quote(email))
 
 
+class UpdateSnippets(webapp.RequestHandler):
+    """Save several of a user's snippets at once; used by autosave.
+
+    This takes a single POST parameter, 'edits', holding a json list
+    of {"week": "mm-dd-yyyy", "text": ..., "private": true/false,
+    "version": n} objects, and saves them all in one batch.  The
+    response is json, like UpdateSnippet.post(), and includes the new
+    version of every snippet we saved.  If some edits were based on
+    stale versions, we save the rest and return a 409 whose
+    'conflicts' hold the current contents of the stale snippets.
+    """
+
+    def post(self):
+        if not _current_user_email(self.request):
+            _write_json_response(self, 403, {'status': 403,
+                                             'message': 'not logged in'})
+            return
+
+        email = self.request.get('u', _current_user_email(self.request))
+        if not _logged_in_user_has_permission_for(self.request, email):
+            error = ('You do not have permissions to update user'
+                     ' snippets for %s' % email)
+            _write_json_response(self, 403, {'status': 403,
+                                             'message': error})
+            return
+
+        try:
+            edits = [(datetime.datetime.strptime(edit['week'],
+                                                 '%m-%d-%Y').date(),
+                      edit['text'],
+                      bool(edit.get('private')),
+                      edit.get('version'))
+                     for edit in json.loads(self.request.get('edits'))]
+        except (ValueError, KeyError, TypeError):
+            _write_json_response(self, 400, {'status': 400,
+                                             'message': 'malformed edits'})
+            return
+        if [edit for edit in edits if edit[0].weekday() != 0]:
+            _write_json_response(self, 400, {
+                'status': 400,
+                'message': 'passed-in dates must be Mondays'})
+            return
+
+        if edits:
+            (saved_snippets, stale_snippets) = _update_snippets(
+                self.request, email, edits, _now(self.request))
+        else:
+            (saved_snippets, stale_snippets) = ([], [])
+
+        response = {'status': 200, 'message': 'ok',
+                    'saved': len(saved_snippets),
+                    'versions': dict((s.week.strftime('%m-%d-%Y'), s.version)
+                                     for s in saved_snippets),
+                    }
+        if stale_snippets:
+            response['status'] = 409
+            response['message'] = 'some snippets were changed by someone else'
+            response['conflicts'] = [_snippet_to_json_dict(s)
+                                     for s in stale_snippets]
+        _write_json_response(self, response['status'], response)
+
+
+class SnippetHistory(webapp.RequestHandler):
+    """Show every saved version of one of a user's snippets."""
+
+    def get(self):
+        if not _current_user_email(self.request):
+            return _login_page(self.request, self)
+
+        user_email = self.request.get('u', _current_user_email(self.request))
+        week_string = self.request.get('week')
+        week = datetime.datetime.strptime(week_string, '%m-%d-%Y').date()
+
+        snippet = _storage(self.request).get_snippet(user_email, week)
+
+        history = []
+        if snippet:
+            history = _storage(self.request).get_snippet_history(snippet)
+        can_view_private = _can_view_private_snippets(
+            _current_user_email(self.request), user_email)
+        revision_values = [{'version': revision.version,
+                            'saved': revision.saved,
+                            'private': revision.private,
+                            'text': text}
+                           for (revision, text) in reversed(history)
+                           if can_view_private or not revision.private]
+
+        template_values = {
+            'logout_url': _auth(self.request).create_logout_url('/'),
+            'message': self.request.get('msg'),
+            'username': user_email,
+            'view_week': _existingsnippet_monday(_now(self.request)),
+            'snippet_week': week,
+            'revisions': revision_values,
+            }
+        self.response.out.write(_render_template('snippet_history.html',
+                                                 template_values))
+
+
 class Settings(webapp.RequestHandler):
     """Page to display a user's settings (from class User) for modification."""
 
     def get(self):
-        if not users.get_current_user():
+        if not _current_user_email(self.request):
             return _login_page(self.request, self)
 
-        user_email = self.request.get('u', _current_user_email())
-        if not _logged_in_user_has_permission_for(user_email):
+        user_email = self.request.get('u', _current_user_email(self.request))
+        if not _logged_in_user_has_permission_for(self.request, user_email):
             # TODO(csilvers): return a 403 here instead.
             raise RuntimeError('You do not have permissions to view user'
                                ' settings for %s' % user_email)
-        user = _get_or_create_user(user_email)
+        user = _get_or_create_user(self.request, user_email,
+                                   _now(self.request))
 
         template_values = {
-            'logout_url': users.create_logout_url('/'),
+            'logout_url': _auth(self.request).create_logout_url('/'),
             'message': self.request.get('msg'),
             'username': user.email,
-            'view_week': _existingsnippet_monday(_TODAY_FN()),
+            'view_week': _existingsnippet_monday(_now(self.request)),
             'user': user,
             'redirect_to': self.request.get('redirect_to', ''),
             # We could get this from user, but we want to replace
             # commas with newlines for printing.
             'wants_to_view': user.wants_to_view.replace(',', '\n'),
             }
-        path = os.path.join(os.path.dirname(__file__), 'settings.html')
-        self.response.out.write(template.render(path, template_values))
+        self.response.out.write(_render_template('settings.html',
+                                                 template_values))
 
 
 class UpdateSettings(webapp.RequestHandler):
     """Updates the db with modifications from the Settings page."""
 
     def get(self):
-        if not users.get_current_user():
+        if not _current_user_email(self.request):
             return _login_page(self.request, self)
 
-        user_email = self.request.get('u', _current_user_email())
-        if not _logged_in_user_has_permission_for(user_email):
+        user_email = self.request.get('u', _current_user_email(self.request))
+        if not _logged_in_user_has_permission_for(self.request, user_email):
             # TODO(csilvers): return a 403 here instead.
             raise RuntimeError('You do not have permissions to modify user'
                                ' settings for %s' % user_email)
-        user = _get_or_create_user(user_email)
+        user = _get_or_create_user(self.request, user_email,
+                                   _now(self.request))
 
         category = self.request.get('category')
 
@@ -471,11 +1115,18 @@ class UpdateSettings(webapp.RequestHandler):
         wants_to_view = self.request.get('to_view').replace('\n', ',')
         wants_to_view = wants_to_view.replace(' ', '')
 
+        timezone = self.request.get('timezone').strip() or None
+        if timezone and not weekcalendar.is_valid_timezone(timezone):
+            self.redirect("/settings?msg=Unknown+timezone+%s&u=%s"
+                          % (urllib.quote(timezone),
+                             urllib.quote(user_email)))
+            return
+
         user.category = category or '(unknown)'
         user.wants_email = wants_email
         user.wants_to_view = wants_to_view
-        db.put(user)
-        db.get(user.key())  # ensure db consistency for HRD
+        user.timezone = timezone
+        _storage(self.request).save_user(user, _now(self.request))
 
         redirect_to = self.request.get('redirect_to')
         if redirect_to == 'snippet_entry':   # true for new_user.html
@@ -485,146 +1136,684 @@ class UpdateSettings(webapp.RequestHandler):
                           % urllib.quote(user_email))
 
 
-# The following two classes are called by cron.
+# How many weeks the stats dashboard shows, by default.
+_STATS_NUM_WEEKS = 12
 
-def _get_email_to_current_snippet_map(today):
-    """Return a map from email to True if they've written snippets this week.
 
-    Goes through all users registered on the system, and checks if
-    they have a snippet in the db for the appropriate snippet-week for
-    'today'.  If so, they get entered into the return-map with value
-    True.  If not, they have value False.
+class StatsDashboard(webapp.RequestHandler):
+    """Show participation per category over the last few weeks.
+
+    With the datastore backend, this only reads the totals kept by
+    weeklystats, so it's cheap no matter how many snippets there are.
+    """
+
+    def get(self):
+        last_week = _existingsnippet_monday(_now(self.request))
+        try:
+            num_weeks = int(self.request.get('weeks', _STATS_NUM_WEEKS))
+        except ValueError:
+            num_weeks = _STATS_NUM_WEEKS
+        num_weeks = max(1, min(num_weeks, 104))
+        template_values = {
+            'logout_url': _auth(self.request).create_logout_url('/'),
+            'message': self.request.get('msg'),
+            'username': _current_user_email(self.request),
+            'view_week': last_week,
+            'num_weeks': num_weeks,
+            'categories': _storage(self.request).get_stats_dashboard(last_week,
+                                                       num_weeks),
+            }
+        self.response.out.write(_render_template('stats.html',
+                                                 template_values))
+
+
+class Warmup(webapp.RequestHandler):
+    """Called by appengine before sending a new instance live traffic."""
+
+    def get(self):
+        _load_templates()
+        self.response.out.write('OK')
+
+
+# How many snippets MigrateSnippets rewrites per request.
+_MIGRATION_BATCH_SIZE = 100
+
+
+class MigrateSnippets(webapp.RequestHandler):
+    """Rewrite every snippet in the current storage format.
+
+    This compresses long texts that were stored before we compressed
+    them, and fills in Snippet.summary, Snippet.domain and
+    Snippet.category for snippets that predate them.
+    Each request handles one batch of snippets, then queues a task to
+    handle the next one, so this can get through any number of
+    snippets.  Start it by visiting /admin/migrate_snippets.  It is
+    safe to run more than once.  Until it finishes, pages that only
+    need summaries read the whole snippets; see Storage.
+    """
+
+    def get(self):
+        (num_migrated, cursor) = _storage(self.request).migrate_snippets(
+            self.request.get('cursor') or None, _MIGRATION_BATCH_SIZE)
+        if cursor:    # there may be more
+            from google.appengine.api import taskqueue
+            taskqueue.add(url='/admin/migrate_snippets', method='GET',
+                          params={'cursor': cursor})
+        logging.info('Migrated %d snippets' % num_migrated)
+        self.response.out.write('Migrated %d snippets' % num_migrated)
+
+
+class MigrateUsers(webapp.RequestHandler):
+    """Rewrite every user, so it has a hash_bucket for the cron shards.
+
+    It also gives every user a ReminderPlan with a remind_hour (see
+    reminderplans.py).
+
+    Like MigrateSnippets, each request handles one batch of users and
+    queues a task for the next.  Start it by visiting
+    /admin/migrate_users.  It is safe to run more than once.  Until
+    it finishes, the cron jobs run unsharded, and the reminder job
+    looks at every user; see cronshard.start() and SendReminderEmail.
+    """
+
+    def get(self):
+        (num_migrated, cursor) = _storage(self.request).migrate_users(
+            self.request.get('cursor') or None, _MIGRATION_BATCH_SIZE,
+            _now(self.request))
+        if cursor:    # there may be more
+            from google.appengine.api import taskqueue
+            taskqueue.add(url='/admin/migrate_users', method='GET',
+                          params={'cursor': cursor})
+        logging.info('Migrated %d users' % num_migrated)
+        self.response.out.write('Migrated %d users' % num_migrated)
+
+
+class MigrateToTenants(webapp.RequestHandler):
+    """Copy the users and snippets from before multi-tenant mode to tenants.
+
+    Once multi-tenant mode is on, what was written before it is in
+    the default namespace, where nobody sees it (see tenants.py).
+    This copies each user, with their snippets and snippet history,
+    into their tenant, unless they've already started afresh there.
+    Like MigrateSnippets, each request handles one batch of users and
+    queues a task for the next.  Start it by visiting
+    /admin/migrate_to_tenants once multi-tenant mode is on.  It is
+    safe to run more than once.  When it finishes, it recounts each
+    tenant's stats and plans their reminders, as BackfillStats and
+    MigrateUsers do.
+    """
+
+    def get(self):
+        from google.appengine.api import taskqueue
+        (num_migrated, cursor) = _storage(self.request).migrate_to_tenants(
+            self.request.get('cursor') or None, _MIGRATION_BATCH_SIZE)
+        if cursor:    # there may be more
+            taskqueue.add(url='/admin/migrate_to_tenants', method='GET',
+                          params={'cursor': cursor})
+        else:
+            def recount(tenant):
+                # Tasks run in the tenant they're queued in.
+                taskqueue.add(url='/admin/backfill_stats', method='GET')
+                taskqueue.add(url='/admin/migrate_users', method='GET')
+            tenants.for_each_tenant(recount)
+        logging.info('Copied %d users to their tenants' % num_migrated)
+        self.response.out.write('Copied %d users to their tenants'
+                                % num_migrated)
+
+
+class UpdateStats(webapp.RequestHandler):
+    """Apply a participation-stats update; called from the 'stats' queue.
+
+    See weeklystats.py.
+    """
+
+    def post(self):
+        task_name = self.request.headers.get('X-AppEngine-TaskName')
+        weeklystats.apply_queued_update(self.request.body, task_name)
+
+
+class BackfillStats(webapp.RequestHandler):
+    """Recount the participation stats from every snippet and user.
+
+    The stats only count the changes made since we started keeping
+    them, so run this once to count everything before that, or any
+    time they look off.  Visiting /admin/backfill_stats queues a task
+    for the oldest week with a snippet; each task recounts one week
+    and queues one for the next, and the last recounts the users in
+    each category.  The tasks run on the 'stats' queue, so never at
+    the same time as an update.  It is safe to run more than once,
+    though a snippet saved just before its week is recounted may be
+    counted twice, so best run it when few people are writing.
+    """
+
+    def _queue_week(self, week):
+        from google.appengine.api import taskqueue
+        taskqueue.add(queue_name='stats', url='/admin/backfill_stats',
+                      method='GET', params={'week': week.isoformat()})
+
+    def get(self):
+        this_week = _newsnippet_monday(_now(self.request))
+        if not self.request.get('week'):
+            self._queue_week(_storage(self.request).get_oldest_week()
+                             or this_week)
+            self.response.out.write('Started backfilling the stats')
+            return
+
+        week = datetime.datetime.strptime(self.request.get('week'),
+                                          '%Y-%m-%d').date()
+        users = _storage(self.request).get_all_users()
+        weeklystats.backfill_week(week, dict((user.email, user.category)
+                                             for user in users))
+        if week < this_week:
+            self._queue_week(week + datetime.timedelta(7))
+        else:
+            weeklystats.backfill_categories(users)
+        logging.info('Backfilled the stats for %s' % week)
+        self.response.out.write('Backfilled the stats for %s' % week)
+
+
+# The following classes are called by cron, or by the tasks cron starts.
+
+def _cron_storage():
+    """Return the Storage for cron jobs, which only run on appengine."""
+    return _DEFAULT_BACKENDS.storage
+
+
+# How many users each cron shard task handles before queueing the next.
+_CRON_SHARD_BATCH_SIZE = 100
+
+
+def _get_email_to_current_week_map(today, users):
+    """Return a map from email to the snippet-week that's current for them.
 
     Note that users whose 'wants_email' field is set to False will not
-    be included in either list.
+    be included in the map.
 
     Arguments:
       today: a datetime.datetime object representing the
-        'current' day.  We use the normal algorithm to determine what is
-        the most recent snippet-week for this day.
+        'current' day.  We use the normal algorithm, in each user's
+        timezone, to determine what is the most recent snippet-week
+        for this day.
+      users: the User entities to look at, e.g. one batch of a
+        cron shard.
 
     Returns:
-      a map from email (user.email for each user) to True or False,
-      depending on if they've written snippets for this week or not.
+      a map from email (user.email for each user) to the monday of
+      their current week, as a datetime.date.
     """
-    user_q = User.all()
-    users = user_q.fetch(1000)
     retval = {}
     for user in users:
         if not user.wants_email:         # ignore this user
             continue
-        retval[user.email] = False       # assume the worst, for now
+        calendar = weekcalendar.get_calendar(user.timezone)
+        retval[user.email] = calendar.existingsnippet_monday(today)
+    return retval
 
-    week = _existingsnippet_monday(today)
-    snippets_q = Snippet.all()
-    snippets_q.filter('week = ', week)
-    snippets = snippets_q.fetch(1000)
-    for snippet in snippets:
-        if snippet.email in retval:      # don't introduce new keys here
-            retval[snippet.email] = True
 
+def _get_email_to_reminder_map(today, users, email_to_plan=None):
+    """Return a map from email to what to remind them about, if it's time.
+
+    Only users it's currently reminder time for, by their
+    ReminderPlan (see reminderplans.py) and their timezone, are
+    included; so are users who want email, and aren't on leave.
+
+    Arguments:
+      today: the current time, as a datetime.datetime.
+      users: the User entities to look at, e.g. one batch of a
+        cron shard.
+      email_to_plan: a map from email to ReminderPlan, for the users
+        that have one.  If None, we read all their plans with one
+        batch get.
+
+    Returns:
+      a map from email to a pair (week, lead_hours): the monday of the
+      week to remind them about, and how many hours it is until that
+      week's deadline.
+    """
+    if email_to_plan is None:
+        email_to_plan = reminderplans.get_plans([user.email
+                                                 for user in users])
+    retval = {}
+    for user in users:
+        if not user.wants_email:
+            continue
+        plan = email_to_plan.get(user.email)
+        if plan is not None and plan.on_leave:
+            continue
+        if plan is not None:
+            lead_hours = plan.lead_hours
+        else:
+            lead_hours = reminderplans.DEFAULT_LEAD_HOURS
+        calendar = weekcalendar.get_calendar(user.timezone)
+        week = calendar.reminder_monday(today, lead_hours)
+        if week is not None:
+            retval[user.email] = (week, lead_hours)
     return retval
 
 
-def _send_snippets_mail(to, subject, template_path, template_values):
-    mail.send_mail(sender=('Khan Academy Snippet Server'
-                           ' <csilvers+snippets@khanacademy.org>'),
-                   to=to,
-                   subject=subject,
-                   body=template.render(template_path, template_values))
+def _get_email_to_current_snippet_map(email_to_week):
+    """Return a map from email to True if they've written snippets this week.
+
+    Goes through the given users, and checks if they have a snippet in
+    the db for their week.  If so, they get entered into the
+    return-map with value True.  If not, they have value False.
+
+    Arguments:
+      email_to_week: a map from email to the monday of the week we
+        care about for them, e.g. from _get_email_to_current_week_map().
+
+    Returns:
+      a map from email (each key of email_to_week) to True or False,
+      depending on if they've written snippets for this week or not.
+    """
+    emails_with_snippets = _cron_storage().get_emails_with_snippets(
+        email_to_week)
+    return dict((email, email in emails_with_snippets)
+                for email in email_to_week)
+
+
+# The most recipients we put on one email.  Appengine counts each
+# recipient against the daily quota, but each email -- however many
+# recipients it has -- is one call, and one task on the 'mail' queue.
+_MAX_RECIPIENTS_PER_MAIL = 50
+
+
+def _send_snippets_mail(recipients, subject, body, task_name=None):
+    """Queue an email to recipients, at a rate appengine's quota allows.
+
+    The recipients are bcc'ed, so they don't see each other's address.
+    If task_name is given and we've already queued a task with that
+    name (in the last week or so), we don't queue the email again.
+    """
+    from google.appengine.api import taskqueue
     # Appengine has a quota of 32 emails per minute:
     #    https://developers.google.com/appengine/docs/quotas#Mail
-    # We pause 2 seconds between each email to make sure we
-    # don't go over that.
-    time.sleep(2)
+    # so rather than sending the mail here -- with many cron shards
+    # running at once -- we queue it on the 'mail' queue, which
+    # queue.yaml limits to 30 tasks a minute.
+    try:
+        taskqueue.add(queue_name='mail', url='/admin/send_mail',
+                      name=task_name,
+                      params={'bcc': recipients,
+                              'subject': subject,
+                              'body': body})
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        logging.info('Not re-sending email %s to %s'
+                     % (task_name, ', '.join(recipients)))
+
+
+def _send_grouped_mail(job, email_to_mail):
+    """Send each email once per group of users who get the same one.
+
+    Arguments:
+      job: the name of the job sending the emails, for _mail_task_name().
+      email_to_mail: a map from each user's email to a tuple
+        (week, subject, template_name, template_values) saying what
+        to send them.
+
+    Each distinct template and values is rendered just once, and each
+    distinct email goes out -- bcc'ed, _MAX_RECIPIENTS_PER_MAIL
+    recipients at a time -- to everyone who gets it.
+    """
+    mail_to_emails = {}
+    for (email, (week, subject, template_name, template_values)) in (
+            email_to_mail.iteritems()):
+        key = (week, subject, template_name,
+               tuple(sorted(template_values.iteritems())))
+        mail_to_emails.setdefault(key, []).append(email)
+
+    rendered = {}
+    for ((week, subject, template_name, values), emails) in (
+            sorted(mail_to_emails.iteritems())):
+        if (template_name, values) not in rendered:
+            rendered[(template_name, values)] = _render_template(
+                template_name, dict(values))
+        body = rendered[(template_name, values)]
+        # Sorted, so that a retry makes the same groups, with the
+        # same task names.
+        emails.sort()
+        for i in xrange(0, len(emails), _MAX_RECIPIENTS_PER_MAIL):
+            recipients = emails[i:i + _MAX_RECIPIENTS_PER_MAIL]
+            _send_snippets_mail(recipients, subject, body,
+                                _mail_task_name(job, week, recipients))
+
+
+def _mail_task_name(job, week, emails):
+    """A task name unique to (job, week, emails), for _send_snippets_mail().
+
+    emails is a list of recipients.
+    """
+    # Task names can only have letters, digits, - and _.
+    emails_hash = hashlib.md5(','.join(emails).encode('utf-8')).hexdigest()
+    return '%s-%s-%s' % (job, week.strftime('%Y%m%d'), emails_hash)
+
+
+class SendMail(webapp.RequestHandler):
+    """Send one email; called from the 'mail' task queue."""
+
+    def post(self):
+        # Imported here so instances that never send mail never load it.
+        from google.appengine.api import mail
+        message = mail.EmailMessage(
+            sender=('Khan Academy Snippet Server'
+                    ' <csilvers+snippets@khanacademy.org>'),
+            subject=self.request.get('subject'),
+            body=self.request.get('body'))
+        bcc = self.request.get_all('bcc')
+        if bcc:
+            message.bcc = bcc
+        # Tasks queued before we bcc'ed have a single 'to' instead.
+        if self.request.get('to'):
+            message.to = self.request.get('to')
+        message.send()
 
 
 class SendFridayReminderHipChat(webapp.RequestHandler):
-    """Send a HipChat message to the KA room."""
+    """Send a HipChat message to the KA room (or each tenant's room)."""
 
-    def _send_to_hipchat(self):
+    def _send_to_hipchat(self, config, tenant):
         """Sends a note to the main hipchat room."""
         msg = ('Reminder: Weekly snippets due Monday at 5pm. '
                '<a href="http://weekly-snippets.appspot.com/">'
                'http://weekly-snippets.appspot.com/</a>')
-        hipchatlib.send_to_hipchat_room('Khan Academy', msg)
+        _send_to_tenant_hipchat_room(config, tenant, msg)
+
+    def get(self):
+        config = _config(self.request)
+        _for_each_tenant(
+            config, lambda tenant: self._send_to_hipchat(config, tenant))
+
+
+class TestSendToHipchat(webapp.RequestHandler):
+    """Send a (fixed) message to the hipchat room; see hipchatlib."""
 
     def get(self):
-        if _SEND_TO_HIPCHAT:
-            self._send_to_hipchat()
+        config = _config(self.request)
+        if not config.send_to_hipchat:
+            self.response.out.write('HipChat is not configured')
+            return
+        _send_to_hipchat_room(config, '1s and 0s',
+                              'Test of snippets-to-hipchat')
+        self.response.out.write('OK')
+
+
+def _send_reminder_emails(users, today, email_to_plan=None):
+    """Remind those of users who don't have a snippet for this week.
+
+    email_to_plan is as for _get_email_to_reminder_map().  Returns the
+    number of emails sent.
+    """
+    email_to_reminder = _get_email_to_reminder_map(today, users,
+                                                   email_to_plan)
+    email_to_week = dict((email, week) for (email, (week, _))
+                         in email_to_reminder.iteritems())
+    email_to_week = _cron_storage().get_unsent('reminder_email', email_to_week)
+    email_to_has_snippet = _get_email_to_current_snippet_map(email_to_week)
+    email_to_mail = {}
+    sent = {}
+    for (user_email, has_snippet) in email_to_has_snippet.iteritems():
+        if not has_snippet:
+            week = email_to_week[user_email]
+            # From 11pm Sunday on, the deadline counts as 'today'.
+            if (email_to_reminder[user_email][1] <=
+                    reminderplans.DEFAULT_LEAD_HOURS):
+                due_day = 'today'
+            else:
+                due_day = 'Monday'
+            email_to_mail[user_email] = (
+                week, 'Weekly snippets due %s at 5pm' % due_day,
+                'reminder_email', {'due_day': due_day})
+            sent[user_email] = week
+            logging.debug('sending reminder email to %s' % user_email)
+        else:
+            logging.debug('did not send reminder email to %s: '
+                          'has a snippet already' % user_email)
+    _send_grouped_mail('reminder_email', email_to_mail)
+    _cron_storage().record_sent('reminder_email', sent)
+    return len(sent)
+
+
+def _send_planned_reminder_emails(plans, today):
+    """Remind the users with these ReminderPlans, if they need it.
+
+    Returns the number of emails sent.
+    """
+    emails = [plan.key().name() for plan in plans]
+    user_futures = [_cron_storage().get_user_async(email)
+                    for email in emails]
+    users = [user for user in (future() for future in user_futures)
+             if user is not None]
+    return _send_reminder_emails(users, today, dict(zip(emails, plans)))
+
+
+def _send_view_emails(users, today):
+    """Tell users the week's snippets are ready; return how many we told."""
+    email_to_week = _get_email_to_current_week_map(today, users)
+    email_to_week = _cron_storage().get_unsent('view_email', email_to_week)
+    email_to_has_snippet = _get_email_to_current_snippet_map(email_to_week)
+    email_to_mail = {}
+    for (user_email, has_snippet) in email_to_has_snippet.iteritems():
+        email_to_mail[user_email] = (email_to_week[user_email],
+                                     'Weekly snippets are ready!',
+                                     'view_email',
+                                     {'has_snippets': has_snippet})
+        logging.debug('sending "view" email to %s' % user_email)
+    _send_grouped_mail('view_email', email_to_mail)
+    _cron_storage().record_sent('view_email', email_to_week)
+    return len(email_to_week)
+
+
+def _all_users_query(now):
+    return User.all()
+
+
+# Map from the name of a sharded cron job to a pair: a function
+# returning a query for the entities it visits, given the time the
+# job started; and the function that handles a batch of them.  See
+# ProcessCronShard.
+_CRON_JOBS = {
+    'reminder_email': (_all_users_query, _send_reminder_emails),
+    'planned_reminder_email': (reminderplans.plans_due_query,
+                               _send_planned_reminder_emails),
+    'view_email': (_all_users_query, _send_view_emails),
+    'plan_reminders': (_all_users_query, reminderplans.plan_batch),
+    }
 
 
 class SendReminderEmail(webapp.RequestHandler):
-    """Send an email to everyone who doesn't have a snippet for this week."""
+    """Send an email to everyone who doesn't have a snippet for this week.
 
-    def _send_mail(self, email):
-        template_values = {}
-        path = os.path.join(os.path.dirname(__file__), 'reminder_email')
-        _send_snippets_mail(email, 'Weekly snippets due today at 5pm',
-                            path, template_values)
+    The emails are sent by cron shards; see ProcessCronShard.
+    """
 
-    def _send_to_hipchat(self):
+    def _send_to_hipchat(self, config, tenant):
         """Sends a note to the main hipchat room."""
         msg = ('Reminder: Weekly snippets due today at 5pm. '
                '<a href="http://weekly-snippets.appspot.com/">'
                'http://weekly-snippets.appspot.com/</a>')
-        hipchatlib.send_to_hipchat_room('Khan Academy', msg)
+        _send_to_tenant_hipchat_room(config, tenant, msg)
 
     def get(self):
-        email_to_has_snippet = _get_email_to_current_snippet_map(_TODAY_FN())
-        for (user_email, has_snippet) in email_to_has_snippet.iteritems():
-            if not has_snippet:
-                self._send_mail(user_email)
-                logging.debug('sent reminder email to %s' % user_email)
-            else:
-                logging.debug('did not send reminder email to %s: '
-                              'has a snippet already' % user_email)
+        # This runs every hour; each run only reminds the users for
+        # whom it's currently their reminder time (see reminderplans.py).
+        config = _config(self.request)
+        today = config.now_fn()
+
+        def remind(tenant):
+            # Reminders go out between 5pm Friday and Monday afternoon,
+            # local time.  Anywhere in the world, that's Thursday
+            # through Monday here, so on other days there's nobody to
+            # remind.
+            if today.weekday() in (3, 4, 5, 6, 0):
+                if cronshard.is_ready('ReminderPlan'):
+                    # Everyone has a plan, so we need only visit the
+                    # plans due this hour.
+                    cronshard.start('planned_reminder_email', today,
+                                    '/admin/cron_shard', kind='ReminderPlan')
+                else:
+                    # Until MigrateUsers has given everyone a plan, we
+                    # look at every user.
+                    cronshard.start('reminder_email', today,
+                                    '/admin/cron_shard')
+            # The hipchat room is on the default timezone.
+            if weekcalendar.get_calendar().is_reminder_time(today):
+                self._send_to_hipchat(config, tenant)
+
+        _for_each_tenant(config, remind)
+
+
+class PlanReminders(webapp.RequestHandler):
+    """Work out when to send everyone's next reminder email.
+
+    See reminderplans.py.  This runs weekly, after the deadline.  The
+    plans are made by cron shards; see ProcessCronShard.
+    """
 
-        if _SEND_TO_HIPCHAT:
-            self._send_to_hipchat()
+    def get(self):
+        config = _config(self.request)
+        now = config.now_fn()
+
+        def plan(tenant):
+            cronshard.start('plan_reminders', now, '/admin/cron_shard')
+
+        _for_each_tenant(config, plan)
 
 
 class SendViewEmail(webapp.RequestHandler):
-    """Send an email to everyone to look at the week's snippets."""
+    """Send an email to everyone to look at the week's snippets.
 
-    def _send_mail(self, email, has_snippets):
-        template_values = {'has_snippets': has_snippets}
-        path = os.path.join(os.path.dirname(__file__), 'view_email')
-        _send_snippets_mail(email, 'Weekly snippets are ready!',
-                            path, template_values)
+    The emails are sent by cron shards; see ProcessCronShard.
+    """
 
-    def _send_to_hipchat(self):
+    def _send_to_hipchat(self, config, tenant):
         """Sends a note to the main hipchat room."""
         msg = ('Weekly snippets are ready! '
                '<a href="http://weekly-snippets.appspot.com/weekly">'
                'http://weekly-snippets.appspot.com/weekly</a>')
-        hipchatlib.send_to_hipchat_room('Khan Academy', msg)
+        _send_to_tenant_hipchat_room(config, tenant, msg)
+
+    def get(self):
+        config = _config(self.request)
+        now = config.now_fn()
+
+        def send(tenant):
+            cronshard.start('view_email', now, '/admin/cron_shard')
+            self._send_to_hipchat(config, tenant)
+
+        _for_each_tenant(config, send)
+
+
+# How many weeks of the sent-email ledger we keep, counting this one.
+_SENT_EMAIL_WEEKS_KEPT = 4
+
+
+class ForgetSentEmails(webapp.RequestHandler):
+    """Forget the cron jobs' records of the emails they sent long ago.
+
+    The jobs only look at the records for the week they're emailing
+    about (see Storage.get_unsent()), so older ones just take up
+    space: one per recipient per job per week.  Cron runs this weekly
+    to delete those more than _SENT_EMAIL_WEEKS_KEPT weeks old.
+    """
+
+    def get(self):
+        config = _config(self.request)
+        before = (_newsnippet_monday(config.now_fn()) -
+                  datetime.timedelta(7 * (_SENT_EMAIL_WEEKS_KEPT - 1)))
+
+        def forget(tenant):
+            num_forgotten = _storage(self.request).forget_sent(before)
+            logging.info('Forgot %d sent emails from before %s'
+                         % (num_forgotten, before))
+
+        _for_each_tenant(config, forget)
+        self.response.out.write('OK')
+
+
+class ProcessCronShard(webapp.RequestHandler):
+    """Handle the next batch of users for one shard of a cron job.
+
+    These requests come from the task queue, which retries them if
+    they fail.  See cronshard.py.
+    """
+
+    def post(self):
+        shard_key_name = self.request.get('shard')
+        job = shard_key_name.split(':', 1)[0]
+        if job not in _CRON_JOBS:
+            logging.error('Unknown cron job for shard %s' % shard_key_name)
+            return
+        (make_query, process_batch) = _CRON_JOBS[job]
+        shard = cronshard.process(shard_key_name, make_query, process_batch,
+                                  _CRON_SHARD_BATCH_SIZE, '/admin/cron_shard')
+        if shard is not None:
+            logging.info('Shard %s: processed %d users, sent %d'
+                         % (shard_key_name, shard.processed, shard.sent))
+
+
+class CronStatus(webapp.RequestHandler):
+    """Show the progress of each shard of the recent cron jobs."""
 
     def get(self):
-        email_to_has_snippet = _get_email_to_current_snippet_map(_TODAY_FN())
-        for (user_email, has_snippet) in email_to_has_snippet.iteritems():
-            self._send_mail(user_email, has_snippet)
-            logging.debug('sent "view" email to %s' % user_email)
-
-        if _SEND_TO_HIPCHAT:
-            self._send_to_hipchat()
-
-
-application = webapp.WSGIApplication([('/', UserPage),
-                                      ('/weekly', SummaryPage),
-                                      ('/update_snippet', UpdateSnippet),
-                                      ('/settings', Settings),
-                                      ('/update_settings', UpdateSettings),
-                                      ('/admin/send_friday_reminder_hipchat',
-                                       SendFridayReminderHipChat),
-                                      ('/admin/send_reminder_email',
-                                       SendReminderEmail),
-                                      ('/admin/send_view_email',
-                                       SendViewEmail),
-                                      ('/admin/test_send_to_hipchat',
-                                       hipchatlib.TestSendToHipchat),
-                                      ],
-                                      debug=True)
+        template_values = {
+            'logout_url': _auth(self.request).create_logout_url('/'),
+            'message': self.request.get('msg'),
+            'username': _current_user_email(self.request),
+            'view_week': _existingsnippet_monday(_now(self.request)),
+            'runs': [{'job': job,
+                      'run': run,
+                      'shards': shards,
+                      'num_done': len([s for s in shards if s.done]),
+                      'processed': sum(s.processed for s in shards),
+                      'sent': sum(s.sent for s in shards),
+                      }
+                     for (job, run, shards) in cronshard.get_recent_shards()],
+            }
+        self.response.out.write(_render_template('cron_status.html',
+                                                 template_values))
+
+
+# The pages people use.  These need only a Storage and an AuthProvider,
+# so standalone.py can serve them outside of appengine, too.
+USER_ROUTES = [('/', UserPage),
+               ('/weekly', SummaryPage),
+               ('/category', CategoryTimeline),
+               ('/api/snippets', JsonUserSnippets),
+               ('/api/weekly', JsonSummary),
+               ('/update_snippet', UpdateSnippet),
+               ('/update_snippets', UpdateSnippets),
+               ('/history', SnippetHistory),
+               ('/settings', Settings),
+               ('/update_settings', UpdateSettings),
+               ]
+
+# Cron jobs, task handlers and admin pages.  These use appengine
+# services directly, and rely on app.yaml to restrict them to admins.
+_APPENGINE_ROUTES = [('/admin/send_friday_reminder_hipchat',
+                      SendFridayReminderHipChat),
+                     ('/admin/send_reminder_email', SendReminderEmail),
+                     ('/admin/plan_reminders', PlanReminders),
+                     ('/admin/send_view_email', SendViewEmail),
+                     ('/admin/forget_sent_emails', ForgetSentEmails),
+                     ('/admin/test_send_to_hipchat', TestSendToHipchat),
+                     ('/admin/migrate_snippets', MigrateSnippets),
+                     ('/admin/migrate_users', MigrateUsers),
+                     ('/admin/migrate_to_tenants', MigrateToTenants),
+                     (weeklystats.UPDATE_URL, UpdateStats),
+                     ('/admin/backfill_stats', BackfillStats),
+                     ('/admin/cron_shard', ProcessCronShard),
+                     ('/admin/cron_status', CronStatus),
+                     ('/admin/stats', StatsDashboard),
+                     ('/admin/send_mail', SendMail),
+                     ('/_ah/warmup', Warmup),
+                     ]
+
+# In multi-tenant mode, each request runs in its tenant's namespace.
+application = tenants.wsgi_middleware(
+    webapp.WSGIApplication(USER_ROUTES + _APPENGINE_ROUTES, debug=True),
+    _DEFAULT_BACKENDS.auth,
+    lambda environ: _config_for_environ(environ).multitenant)
 
 
 def main():
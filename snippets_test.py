@@ -11,11 +11,17 @@ c.f. http://webtest.pythonpaste.org/en/latest/index.html
 __author__ = 'Craig Silverstein <csilvers@khanacademy.org>'
 
 
+import base64
 import datetime
 import os
 import re
+import shutil
+import StringIO
 import sys
-import time
+import tempfile
+import threading
+import traceback
+import wsgiref.util
 try:   # Work under either python2.5 or python2.7
     import unittest2 as unittest
 except ImportError:
@@ -28,36 +34,165 @@ sys.path.extend(os.environ['PATH'].split(':'))
 import dev_appserver
 dev_appserver.fix_sys_path()
 
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import namespace_manager
+from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import db
 from google.appengine.ext import testbed
 import webtest   # may need to do 'pip install webtest'
 
+try:
+    import json
+except ImportError:      # python 2.5
+    from django.utils import simplejson as json
+
+import appconfig
+import assets
+import cronshard
+import entitycache
+import hipchatlib
+import models
+import reminderplans
+import revisions
+import sealedweeks
 import snippets
+import sqlitestorage
+import standalone
+import storage
+import tenants
+import weekcalendar
+import weeklystats
 
 
 _TEST_TODAY = datetime.datetime(2012, 2, 23)
 
 
+def _run_in_threads(num_threads, num_calls, fn):
+    """Call fn(thread_number, i) num_calls times in each of num_threads.
+
+    The threads all run at once.  Returns the tracebacks of any
+    exceptions they raised.
+    """
+    errors = []
+
+    def run(thread_number):
+        try:
+            for i in xrange(num_calls):
+                fn(thread_number, i)
+        except Exception:
+            errors.append(traceback.format_exc())
+
+    threads = [threading.Thread(target=run, args=(n,))
+               for n in xrange(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+# The task headers that run_tasks() passes along.  The namespace
+# header is how tasks run in the tenant that queued them.
+_TASK_HEADERS = ('content-type', 'x-appengine-current-namespace',
+                 'x-appengine-taskname')
+
+
+def _test_config(now):
+    """A snippets Config for tests: a fixed clock, and no HipChat."""
+    return snippets._default_config()._replace(send_to_hipchat=False,
+                                     now_fn=lambda: now)
+
+
+def _recipients(message):
+    """Return everyone a mail_stub message went to, as a list."""
+    recipients = []
+    for field in ('to', 'cc', 'bcc'):
+        value = getattr(message, field, None)
+        if isinstance(value, basestring):
+            value = value.split(',')
+        recipients.extend(r.strip() for r in (value or ()))
+    return recipients
+
+
+def _sent_messages_to(mail_stub, email):
+    """Like mail_stub.get_sent_messages(to=email), but counting bcc's."""
+    return [m for m in mail_stub.get_sent_messages()
+            if email in _recipients(m)]
+
+
 class SnippetsTestBase(unittest.TestCase):
     def setUp(self):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
-        self.testbed.init_datastore_v3_stub()
+        # We use cross-group transactions, which need the HR datastore.
+        # probability=1 keeps its queries as consistent as they were.
+        hr_policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=hr_policy)
         self.testbed.init_user_stub()
+        # root_path is where the taskqueue stub finds queue.yaml.
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        self.testbed.init_memcache_stub()
+        # The entity cache lives in the instance, so outlives the testbed.
+        entitycache.clear()
+        # Our queries are consistent (see above), so the cache needn't
+        # wait for them to catch up with writes.
+        self.consistency_seconds = entitycache._CONSISTENCY_SECONDS
+        entitycache._CONSISTENCY_SECONDS = 0
         self.request_fetcher = webtest.TestApp(snippets.application)
-        snippets._TODAY_FN = lambda: _TEST_TODAY
+        self.set_now(_TEST_TODAY)
 
     def tearDown(self):
+        entitycache._CONSISTENCY_SECONDS = self.consistency_seconds
         self.testbed.deactivate()
 
+    def set_now(self, now):
+        """Make the server think it's now, from the next request on."""
+        self.request_fetcher.extra_environ[snippets._CONFIG_ENVIRON_KEY] = (
+            _test_config(now))
+
     def login(self, email):
         self.testbed.setup_env(user_email=email, overwrite=True)
         self.testbed.setup_env(user_id=email, overwrite=True)
         self.testbed.setup_env(user_is_admin='0', overwrite=True)
 
+    def logout(self):
+        self.testbed.setup_env(user_email='', overwrite=True)
+        self.testbed.setup_env(user_id='', overwrite=True)
+        self.testbed.setup_env(user_is_admin='0', overwrite=True)
+
     def set_is_admin(self):
         self.testbed.setup_env(user_is_admin='1', overwrite=True)
 
+    def run_tasks(self, queue_names=('default', 'mail')):
+        """Run queued tasks (and the tasks they queue) until there are none.
+
+        Returns the number of tasks run.
+        """
+        num_run = 0
+        while True:
+            tasks = []
+            for queue_name in queue_names:
+                for task in self.taskqueue_stub.GetTasks(queue_name):
+                    self.taskqueue_stub.DeleteTask(queue_name, task['name'])
+                    tasks.append(task)
+            if not tasks:
+                return num_run
+            for task in tasks:
+                if task['method'] == 'GET':
+                    self.request_fetcher.get(task['url'])
+                else:
+                    headers = dict((k, v) for (k, v) in task['headers']
+                                   if k.lower() in _TASK_HEADERS)
+                    self.request_fetcher.post(
+                        task['url'], base64.b64decode(task['body']),
+                        headers=headers)
+                num_run += 1
+
     def assertNumSnippets(self, body, expected_count):
         """Assert the page 'body' has exactly expected_count snippets in it."""
         # We annotate the div at the beginning of each snippet with
@@ -168,6 +303,1131 @@ class PostTestCase(SnippetsTestBase):
         self.assertNotInSnippet('>my second snippet<', response.body, 1)
         self.assertInSnippet('>my snippet<', response.body, 2)
 
+    def testPostBatchOfSnippets(self):
+        self.login('user@example.com')
+        url = '/update_snippet?week=02-13-2012&snippet=my+snippet'
+        self.request_fetcher.get(url)
+
+        edits = [{'week': '02-13-2012', 'text': 'updated', 'private': True},
+                 {'week': '02-20-2012', 'text': 'brand new'}]
+        response = self.request_fetcher.post('/update_snippets',
+                                             {'edits': json.dumps(edits)},
+                                             status=200)
+        self.assertEqual(2, json.loads(response.body)['saved'])
+
+        response = self.request_fetcher.get('/')
+        self.assertNumSnippets(response.body, 2)
+        self.assertInSnippet('>brand new<', response.body, 0)
+        self.assertInSnippet('>updated<', response.body, 1)
+        self.assertInSnippet('checked', response.body, 1)
+        self.assertEqual(2, snippets.Snippet.all().count())
+
+    def testPostBatchOfSnippetsAsOtherPerson(self):
+        self.login('user@example.com')
+        edits = [{'week': '02-20-2012', 'text': 'fallacious'}]
+        params = {'edits': json.dumps(edits), 'u': 'joeuser@example.com'}
+        response = self.request_fetcher.post('/update_snippets', params,
+                                             status=403)
+        self.assertIn('joeuser@example.com', response)
+
+    def testPostBatchOfSnippetsNotOnMonday(self):
+        self.login('user@example.com')
+        edits = [{'week': '02-21-2012', 'text': 'tuesday'}]
+        self.request_fetcher.post('/update_snippets',
+                                  {'edits': json.dumps(edits)}, status=400)
+        self.request_fetcher.post('/update_snippets',
+                                  {'edits': 'not json'}, status=400)
+
+    def testPostSnippetWithStaleVersion(self):
+        self.login('user@example.com')
+        params = {'week': '02-20-2012', 'snippet': 'first', 'version': '0'}
+        self.request_fetcher.post('/update_snippet', params, status=200)
+        params = {'week': '02-20-2012', 'snippet': 'second', 'version': '1'}
+        self.request_fetcher.post('/update_snippet', params, status=200)
+
+        # This edit is based on version 1, but we're at version 2 now.
+        params = {'week': '02-20-2012', 'snippet': 'stale', 'version': '1'}
+        response = self.request_fetcher.post('/update_snippet', params,
+                                             status=409)
+        conflict = json.loads(response.body)['conflicts'][0]
+        self.assertEqual('second', conflict['text'])
+        self.assertEqual(2, conflict['version'])
+
+        response = self.request_fetcher.get('/')
+        self.assertInSnippet('>second<', response.body, 0)
+
+    def testPostBatchOfSnippetsWithStaleVersion(self):
+        self.login('user@example.com')
+        params = {'week': '02-13-2012', 'snippet': 'first', 'version': '0'}
+        self.request_fetcher.post('/update_snippet', params, status=200)
+
+        # Another tab doesn't know about 'first' yet.
+        edits = [{'week': '02-13-2012', 'text': 'other tab', 'version': 0},
+                 {'week': '02-20-2012', 'text': 'fine', 'version': 0}]
+        response = self.request_fetcher.post('/update_snippets',
+                                             {'edits': json.dumps(edits)},
+                                             status=409)
+        result = json.loads(response.body)
+        self.assertEqual({'02-20-2012': 1}, result['versions'])
+        self.assertEqual(['first'], [c['text'] for c in result['conflicts']])
+
+    def testPostUnchangedSnippetIsANoop(self):
+        self.login('user@example.com')
+        params = {'week': '02-20-2012', 'snippet': 'same old'}
+        self.request_fetcher.post('/update_snippet', params, status=200)
+        self.request_fetcher.post('/update_snippet', params, status=200)
+        snippet = snippets.Snippet.all().get()
+        self.assertEqual(1, snippet.version)
+
+        params['private'] = 'True'
+        self.request_fetcher.post('/update_snippet', params, status=200)
+        snippet = snippets.Snippet.all().get()
+        self.assertEqual(2, snippet.version)
+
+class AssetsTestCase(UserTestBase):
+    """Test building the javascript, and that pages load what was built."""
+
+    def setUp(self):
+        super(AssetsTestCase, self).setUp()
+        self.root_dir = tempfile.mkdtemp()
+        for source_path in assets.SOURCES.itervalues():
+            if not os.path.isdir(os.path.join(self.root_dir,
+                                              os.path.dirname(source_path))):
+                os.makedirs(os.path.join(self.root_dir,
+                                         os.path.dirname(source_path)))
+            shutil.copy(os.path.join(os.path.dirname(__file__), source_path),
+                        os.path.join(self.root_dir, source_path))
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+        super(AssetsTestCase, self).tearDown()
+
+    def testBuild(self):
+        manifest = assets.build(self.root_dir)
+        self.assertEqual(sorted(assets.SOURCES), sorted(manifest))
+        for (name, built_path) in manifest.iteritems():
+            self.assertTrue(re.match(r'^assets/[\w.-]+\.[0-9a-f]{12}\.js$',
+                                     built_path), built_path)
+            self.assertTrue(
+                os.path.getsize(os.path.join(self.root_dir, built_path)) <
+                os.path.getsize(os.path.join(self.root_dir,
+                                             assets.SOURCES[name])))
+        self.assertEqual(manifest, assets.load_urls(self.root_dir))
+
+    def _change_snippets_js(self, line):
+        f = open(os.path.join(self.root_dir, assets.SOURCES['snippets']), 'a')
+        f.write(line)
+        f.close()
+
+    def testRebuildKeepsPreviousFilesForOneDeploy(self):
+        oldest_manifest = assets.build(self.root_dir)
+        self._change_snippets_js('var changed = true;\n')
+        old_manifest = assets.build(self.root_dir)
+        self.assertEqual(oldest_manifest['jquery'], old_manifest['jquery'])
+        self.assertNotEqual(oldest_manifest['snippets'],
+                            old_manifest['snippets'])
+        # Pages cached before the deploy can still load their scripts.
+        self.assertTrue(os.path.exists(
+            os.path.join(self.root_dir, oldest_manifest['snippets'])))
+
+        self._change_snippets_js('var changed_again = true;\n')
+        new_manifest = assets.build(self.root_dir)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.root_dir, old_manifest['snippets'])))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.root_dir, new_manifest['jquery'])))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.root_dir, oldest_manifest['snippets'])))
+
+    def testWithoutManifestWeUseTheSources(self):
+        self.assertEqual(assets.SOURCES, assets.load_urls(self.root_dir))
+
+    def testMinifyKeepsCode(self):
+        text = ('// a comment\n'
+                '    var x = 1;\n'
+                '\n'
+                '    var url = "http://example.com";\n')
+        minified = assets.minify_js(text)
+        self.assertIn('var x', minified)
+        self.assertIn('"http://example.com"', minified)
+        self.assertNotIn('a comment', minified)
+
+    def testPagesLoadTheAssets(self):
+        self.request_fetcher.get('/update_settings?category=eng')
+        for url in ('/', '/weekly'):
+            response = self.request_fetcher.get(url)
+            self.assertIn('src="%s"' % snippets._ASSET_URLS['jquery'],
+                          response.body)
+            self.assertIn('src="%s"' % snippets._ASSET_URLS['snippets'],
+                          response.body)
+
+
+class WarmupTestCase(SnippetsTestBase):
+    def testWarmup(self):
+        snippets._TEMPLATES.clear()
+        response = self.request_fetcher.get('/_ah/warmup')
+        self.assertEqual('OK', response.body)
+        self.assertEqual(sorted(snippets._TEMPLATE_NAMES),
+                         sorted(snippets._TEMPLATES.keys()))
+
+
+class JsonApiTestCase(UserTestBase):
+    """Test the json endpoints, including conditional GET."""
+
+    def setUp(self):
+        super(JsonApiTestCase, self).setUp()
+        url = '/update_snippet?week=02-13-2012&snippet=my+snippet'
+        self.request_fetcher.get(url)
+        url = '/update_snippet?week=02-20-2012&snippet=secret&private=True'
+        self.request_fetcher.get(url)
+        url = '/update_settings?category=a+1st'
+        self.request_fetcher.get(url)
+
+    def testUserSnippets(self):
+        response = self.request_fetcher.get('/api/snippets')
+        self.assertEqual('application/json', response.content_type)
+        result = json.loads(response.body)
+        self.assertEqual('user@example.com', result['email'])
+        self.assertEqual(['02-13-2012', '02-20-2012'],
+                         [s['week'] for s in result['snippets']])
+        self.assertEqual('my snippet', result['snippets'][0]['text'])
+        self.assertTrue(result['snippets'][1]['private'])
+
+    def testUserSnippetsHidesPrivateSnippets(self):
+        self.login('other@some_other_domain.com')
+        response = self.request_fetcher.get('/api/snippets?u=user@example.com')
+        result = json.loads(response.body)
+        self.assertEqual(['my snippet'],
+                         [s['text'] for s in result['snippets']])
+
+    def testSummary(self):
+        self.login('other@example.com')
+        self.request_fetcher.get('/update_settings?category=b+2nd')
+        response = self.request_fetcher.get('/api/weekly?week=02-13-2012')
+        result = json.loads(response.body)
+        self.assertEqual('02-13-2012', result['week'])
+        self.assertEqual(['a 1st', 'b 2nd'],
+                         [c['category'] for c in result['categories']])
+        self.assertEqual('my snippet',
+                         result['categories'][0]['snippets'][0]['text'])
+        self.assertEqual('(no snippet this week)',
+                         result['categories'][1]['snippets'][0]['text'])
+
+    def testSummaryOfOneCategory(self):
+        self.login('other@example.com')
+        self.request_fetcher.get('/update_settings?category=b+2nd')
+        response = self.request_fetcher.get(
+            '/api/weekly?week=02-13-2012&category=b+2nd')
+        result = json.loads(response.body)
+        self.assertEqual(['b 2nd'],
+                         [c['category'] for c in result['categories']])
+        self.assertEqual(['other@example.com'],
+                         [s['email']
+                          for s in result['categories'][0]['snippets']])
+
+    def testBigWeeklyPageLoadsCategoriesLazily(self):
+        self.login('other@example.com')
+        self.request_fetcher.get('/update_settings?category=b+2nd')
+        lazy_min_snippets = snippets._LAZY_WEEKLY_PAGE_MIN_SNIPPETS
+        snippets._LAZY_WEEKLY_PAGE_MIN_SNIPPETS = 2
+        try:
+            response = self.request_fetcher.get('/weekly?week=02-13-2012')
+        finally:
+            snippets._LAZY_WEEKLY_PAGE_MIN_SNIPPETS = lazy_min_snippets
+        self.assertNotIn('my snippet', response.body)
+        self.assertIn('data-category="a 1st"', response.body)
+        self.assertIn('data-category="b 2nd"', response.body)
+        self.assertIn('1 snippet<', response.body)
+        # Only the viewer's own category starts out expanded.
+        self.assertEqual(1, response.body.count('style="display: none"'))
+        self.assertLess(response.body.index('data-category="a 1st"'),
+                        response.body.index('style="display: none"'))
+        self.assertLess(response.body.index('style="display: none"'),
+                        response.body.index('data-category="b 2nd"'))
+
+    def testNotLoggedIn(self):
+        self.logout()
+        response = self.request_fetcher.get('/api/weekly', status=403)
+        self.assertIn('"status": 403', response.body)
+
+    def testConditionalGet(self):
+        response = self.request_fetcher.get('/api/weekly?week=02-13-2012')
+        etag = response.headers['ETag']
+        response = self.request_fetcher.get('/api/weekly?week=02-13-2012',
+                                            headers={'If-None-Match': etag},
+                                            status=304)
+        self.assertEqual('', response.body)
+
+        # Once the content changes, so does the etag.
+        url = '/update_snippet?week=02-13-2012&snippet=new+snippet'
+        self.request_fetcher.get(url)
+        response = self.request_fetcher.get('/api/weekly?week=02-13-2012',
+                                            headers={'If-None-Match': etag},
+                                            status=200)
+        self.assertNotEqual(etag, response.headers['ETag'])
+        self.assertIn('new snippet', response.body)
+
+
+class RevisionHistoryTestCase(UserTestBase):
+    """Test that we keep, and can show, every version of a snippet."""
+
+    def _save(self, text):
+        params = {'week': '02-20-2012', 'snippet': text}
+        self.request_fetcher.post('/update_snippet', params, status=200)
+
+    def testHistoryPage(self):
+        self._save('first version')
+        self._save('second version')
+        response = self.request_fetcher.get('/history?week=02-20-2012')
+        body = response.body
+        self.assertIn('second version', body)
+        self.assertIn('first version', body)
+        # Newest first.
+        self.assertTrue(body.index('second version') <
+                        body.index('first version'))
+
+    def testPrivateRevisionsAreHidden(self):
+        self._save('public version')
+        params = {'week': '02-20-2012', 'snippet': 'secret version',
+                  'private': 'True'}
+        self.request_fetcher.post('/update_snippet', params, status=200)
+
+        self.login('other@some_other_domain.com')
+        url = '/history?u=user@example.com&week=02-20-2012'
+        response = self.request_fetcher.get(url)
+        self.assertIn('public version', response.body)
+        self.assertNotIn('secret version', response.body)
+
+    def testReconstructEveryVersion(self):
+        lines = []
+        for i in xrange(35):
+            lines.append('* did thing number %d' % i)
+            self._save('\n'.join(lines))
+
+        snippet = snippets.Snippet.all().get()
+        self.assertEqual(35, snippet.version)
+        for version in xrange(1, 36):
+            self.assertEqual('\n'.join(lines[:version]),
+                             revisions.get_revision_text(snippet.key(),
+                                                         version))
+
+        # Most revisions should be small diffs, not the full text, so
+        # the whole history isn't much bigger than the final text.
+        all_revisions = revisions.SnippetRevision.all().fetch(100)
+        checkpoints = [r for r in all_revisions if r.checkpoint == r.version]
+        self.assertTrue(len(checkpoints) <= 10, len(checkpoints))
+        total_size = sum(len(r.data) for r in all_revisions)
+        self.assertTrue(total_size <= 3 * len(snippet.text),
+                        '%d <= 3 * %d' % (total_size, len(snippet.text)))
+        for r in all_revisions:
+            self.assertTrue(r.version - r.checkpoint <=
+                            revisions._MAX_CHAIN_LENGTH)
+
+    def testDeltaRoundTrip(self):
+        old = 'a\nb\nc\n'
+        new = 'a\nB\nc\nd'
+        self.assertEqual(new,
+                         revisions.apply_delta(old,
+                                               revisions.make_delta(old, new)))
+
+
+class CategoryTimelineTestCase(UserTestBase):
+    """Test /category, which shows a category's snippets over many weeks."""
+
+    def setUp(self):
+        super(CategoryTimelineTestCase, self).setUp()
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.request_fetcher.get('/update_snippet?week=02-06-2012'
+                                 '&snippet=old+eng+news')
+        self.request_fetcher.get('/update_snippet?week=02-13-2012'
+                                 '&snippet=new+eng+news')
+        self.login('other@example.com')
+        self.request_fetcher.get('/update_settings?category=sales')
+        self.request_fetcher.get('/update_snippet?week=02-13-2012'
+                                 '&snippet=sales+news')
+        self.login('user@example.com')
+
+    def testTimeline(self):
+        response = self.request_fetcher.get(
+            '/category?name=eng&from=02-06-2012&to=02-20-2012')
+        body = response.body
+        self.assertNotIn('sales news', body)
+        self.assertLess(body.index('Week of February 6, 2012'),
+                        body.index('old eng news'))
+        self.assertLess(body.index('old eng news'),
+                        body.index('Week of February 13, 2012'))
+        self.assertLess(body.index('Week of February 13, 2012'),
+                        body.index('new eng news'))
+        self.assertLess(body.index('new eng news'),
+                        body.index('Week of February 20, 2012'))
+        self.assertIn('(no snippets this week)', body)
+
+    def testDefaultsToOwnCategoryAndLastQuarter(self):
+        response = self.request_fetcher.get('/category')
+        self.assertIn('Snippets for eng', response.body)
+        self.assertIn('new eng news', response.body)
+        self.assertNotIn('sales news', response.body)
+        self.assertEqual(13, response.body.count('<h3>'))
+
+    def testCategoryChangeMovesSnippets(self):
+        self.request_fetcher.get('/update_settings?category=sales')
+        response = self.request_fetcher.get(
+            '/category?name=sales&from=02-06-2012&to=02-13-2012')
+        self.assertIn('old eng news', response.body)
+        self.assertIn('sales news', response.body)
+        response = self.request_fetcher.get(
+            '/category?name=eng&from=02-06-2012&to=02-13-2012')
+        self.assertNotIn('old eng news', response.body)
+
+    def testCategoryChangeMovesEverySnippet(self):
+        # More than fit in one transaction.
+        weeks = [datetime.date(2011, 1, 3) + datetime.timedelta(7 * i)
+                 for i in xrange(storage.MAX_SNIPPETS_PER_TRANSACTION + 5)]
+        snippets._DEFAULT_BACKENDS.storage.save_snippets(
+            'user@example.com',
+            [(week, 'news %d' % i, False, None)
+             for (i, week) in enumerate(weeks)], _TEST_TODAY)
+        self.request_fetcher.get('/update_settings?category=sales')
+        user_snippets = snippets.Snippet.all().filter(
+            'email =', 'user@example.com').fetch(100)
+        self.assertEqual(len(weeks) + 2, len(user_snippets))
+        self.assertEqual(['sales'], list(set(s.category
+                                             for s in user_snippets)))
+
+    def testFinishedWeeksFollowTheRequestClock(self):
+        self.assertEqual(datetime.date(2012, 2, 6),
+                         storage._last_finished_week(_TEST_TODAY))
+        self.assertEqual(datetime.date(2012, 2, 13),
+                         storage._last_finished_week(
+                             datetime.datetime(2012, 3, 1)))
+
+    def testEditingAFinishedWeekShowsUp(self):
+        url = '/category?name=eng&from=02-06-2012&to=02-13-2012'
+        self.request_fetcher.get(url)
+        self.request_fetcher.get('/update_snippet?week=02-06-2012'
+                                 '&snippet=revised+eng+news')
+        response = self.request_fetcher.get(url)
+        self.assertIn('revised eng news', response.body)
+        self.assertNotIn('old eng news', response.body)
+
+    def testPrivateSnippetsAreHidden(self):
+        self.request_fetcher.get('/update_snippet?week=02-13-2012'
+                                 '&snippet=secret+eng+news&private=True')
+        self.login('other@some_other_domain.com')
+        response = self.request_fetcher.get(
+            '/category?name=eng&from=02-06-2012&to=02-13-2012')
+        self.assertIn('old eng news', response.body)
+        self.assertNotIn('secret eng news', response.body)
+
+
+class SealedWeekTestCase(UserTestBase):
+    """Test that old weeks are read from, and cached as, a sealed copy."""
+
+    def setUp(self):
+        super(SealedWeekTestCase, self).setUp()
+        self.request_fetcher.get('/update_settings?category=eng')
+        # _TEST_TODAY's weekly page shows 02-13-2012, so with the
+        # default horizon of 4 weeks, 01-16-2012 and before are sealed.
+        self.request_fetcher.get('/update_snippet?week=01-09-2012'
+                                 '&snippet=old+news')
+
+    def testOldWeekIsSealed(self):
+        response = self.request_fetcher.get('/weekly?week=01-09-2012')
+        self.assertIn('old news', response.body)
+        self.assertIn('max-age', response.headers['Cache-Control'])
+        self.assertTrue(response.headers['Cache-Control'].startswith(
+            'private'))
+        self.assertEqual(1, self.num_sealed())
+
+        # Now the snippets themselves aren't even read.
+        db.delete(snippets.Snippet.all().fetch(1000))
+        response = self.request_fetcher.get('/weekly?week=01-09-2012')
+        self.assertIn('old news', response.body)
+
+    def testRecentWeekIsNotSealed(self):
+        response = self.request_fetcher.get('/weekly?week=01-23-2012')
+        self.assertNotIn('max-age', response.headers.get('Cache-Control', ''))
+        self.assertEqual(0, sealedweeks.SealedWeek.all().count())
+
+    def num_sealed(self):
+        return len([w for w in sealedweeks.SealedWeek.all() if w.data])
+
+    def testEditUnseals(self):
+        self.request_fetcher.get('/weekly?week=01-09-2012')
+        self.request_fetcher.get('/update_snippet?week=01-09-2012'
+                                 '&snippet=corrected+news')
+        self.assertEqual(0, self.num_sealed())
+        response = self.request_fetcher.get('/weekly?week=01-09-2012')
+        self.assertIn('corrected news', response.body)
+        self.assertNotIn('old news', response.body)
+        self.assertEqual(1, self.num_sealed())
+
+    def testEditWhileSealingIsNotLost(self):
+        key = sealedweeks.sealed_week_key(datetime.date(2012, 1, 9))
+        # A view starts sealing, and reads the old snippet...
+        generation = db.run_in_transaction(storage._start_sealing, key)
+        data = sealedweeks.pack(snippets.Snippet.all().fetch(10),
+                                snippets.User.all().fetch(10))
+        # ...then someone edits it...
+        self.request_fetcher.get('/update_snippet?week=01-09-2012'
+                                 '&snippet=corrected+news')
+        # ...so the view's seal is not kept.
+        db.run_in_transaction(storage._finish_sealing, key, generation, data)
+        self.assertEqual(0, self.num_sealed())
+        response = self.request_fetcher.get('/weekly?week=01-09-2012')
+        self.assertIn('corrected news', response.body)
+
+    def testSealingSkipsReadsFromTheEntityCache(self):
+        # The weekly page for a recent week caches the users and
+        # snippets; sealing mustn't use that copy.
+        self.request_fetcher.get('/weekly?week=01-23-2012')
+        user = snippets.User.all().get()
+        user.category = 'sales'
+        user.put()      # behind the entity cache's back
+        response = self.request_fetcher.get('/weekly?week=01-09-2012')
+        self.assertIn('<h3> sales </h3>', response.body)
+
+    def testTooBigToSeal(self):
+        old_max = sealedweeks.MAX_PACKED_SIZE
+        sealedweeks.MAX_PACKED_SIZE = 10
+        try:
+            response = self.request_fetcher.get('/weekly?week=01-09-2012')
+        finally:
+            sealedweeks.MAX_PACKED_SIZE = old_max
+        self.assertIn('old news', response.body)
+        self.assertEqual(0, self.num_sealed())
+
+    def testJsonSummary(self):
+        response = self.request_fetcher.get(
+            '/api/weekly?week=01-09-2012&summary=1')
+        self.assertIn('max-age', response.headers['Cache-Control'])
+        result = json.loads(response.body)
+        self.assertEqual('old news',
+                         result['categories'][0]['snippets'][0]['summary'])
+
+    def testPrivateSnippetsStayPrivate(self):
+        self.request_fetcher.get('/update_snippet?week=01-09-2012'
+                                 '&snippet=secret+news&private=True')
+        self.request_fetcher.get('/weekly?week=01-09-2012')
+        self.login('other@some_other_domain.com')
+        response = self.request_fetcher.get('/weekly?week=01-09-2012')
+        self.assertNotIn('secret news', response.body)
+
+    def testSealingCanBeTurnedOff(self):
+        self.request_fetcher.extra_environ[snippets._CONFIG_ENVIRON_KEY] = (
+            _test_config(_TEST_TODAY)._replace(seal_after_weeks=0))
+        response = self.request_fetcher.get('/weekly?week=01-09-2012')
+        self.assertIn('old news', response.body)
+        self.assertNotIn('max-age', response.headers.get('Cache-Control', ''))
+        self.assertEqual(0, sealedweeks.SealedWeek.all().count())
+
+
+class CompressedTextTestCase(UserTestBase):
+    """Test that long snippets are stored compressed, and read back fine."""
+
+    def testLongSnippetIsCompressed(self):
+        long_text = 'All work and no play makes Jack a dull boy.\n' * 100
+        params = {'week': '02-20-2012', 'snippet': long_text}
+        self.request_fetcher.post('/update_snippet', params, status=200)
+
+        snippet = snippets.Snippet.all().get()
+        raw_entity = datastore.Get(snippet.key())
+        self.assertTrue(isinstance(raw_entity['text'], db.Blob))
+        self.assertTrue(len(raw_entity['text']) < len(long_text) / 10)
+        self.assertEqual(long_text, snippet.text)
+        self.assertEqual(long_text[:models.SUMMARY_LENGTH],
+                         snippet.summary)
+
+        response = self.request_fetcher.get('/')
+        self.assertIn(long_text, response.body)
+
+    def testShortSnippetIsNotCompressed(self):
+        params = {'week': '02-20-2012', 'snippet': 'short and sweet'}
+        self.request_fetcher.post('/update_snippet', params, status=200)
+        snippet = snippets.Snippet.all().get()
+        raw_entity = datastore.Get(snippet.key())
+        self.assertTrue(isinstance(raw_entity['text'], db.Text))
+
+    def _put_old_style_snippet(self, text):
+        """Store a snippet the way we did before we compressed them."""
+        entity = datastore.Entity('Snippet')
+        entity['email'] = 'user@example.com'
+        entity['week'] = datetime.datetime(2012, 2, 20)
+        entity['text'] = db.Text(text)
+        entity['private'] = False
+        datastore.Put(entity)
+        return entity.key()
+
+    def testReadUncompressedSnippet(self):
+        long_text = 'Some old text.\n' * 100
+        self._put_old_style_snippet(long_text)
+        self.request_fetcher.get('/update_settings?category=dummy')
+        response = self.request_fetcher.get('/')
+        self.assertIn(long_text, response.body)
+
+    def testMigration(self):
+        long_text = 'Some old text.\n' * 100
+        key = self._put_old_style_snippet(long_text)
+        self.request_fetcher.get('/admin/migrate_snippets')
+
+        raw_entity = datastore.Get(key)
+        self.assertTrue(isinstance(raw_entity['text'], db.Blob))
+        snippet = snippets.Snippet.get(key)
+        self.assertEqual(long_text, snippet.text)
+        self.assertEqual(long_text[:models.SUMMARY_LENGTH],
+                         snippet.summary)
+        self.assertEqual('example.com', snippet.domain)
+        self.assertEqual('(unknown)', snippet.category)
+
+    def testSummaryOnlyJson(self):
+        models.mark_migrated(models.SNIPPETS_MIGRATION)
+        long_text = 'x' * 1000
+        params = {'week': '02-20-2012', 'snippet': long_text}
+        self.request_fetcher.post('/update_snippet', params, status=200)
+        response = self.request_fetcher.get(
+            '/api/weekly?week=02-20-2012&summary=1')
+        result = json.loads(response.body)
+        snippet_json = result['categories'][0]['snippets'][0]
+        self.assertEqual('x' * models.SUMMARY_LENGTH,
+                         snippet_json['summary'])
+        self.assertNotIn('text', snippet_json)
+
+    def testMultiLineSummary(self):
+        models.mark_migrated(models.SNIPPETS_MIGRATION)
+        params = {'week': '02-20-2012', 'snippet': 'line one\nline two'}
+        self.request_fetcher.post('/update_snippet', params, status=200)
+        response = self.request_fetcher.get(
+            '/api/weekly?week=02-20-2012&summary=1')
+        result = json.loads(response.body)
+        self.assertEqual('line one\nline two',
+                         result['categories'][0]['snippets'][0]['summary'])
+
+    def testSummaryOnlyBeforeMigration(self):
+        # Until the migration finishes, a snippet without a summary
+        # still shows up.
+        self._put_old_style_snippet('Some old text.')
+        self.request_fetcher.get('/update_settings?category=dummy')
+        response = self.request_fetcher.get(
+            '/api/weekly?week=02-20-2012&summary=1')
+        result = json.loads(response.body)
+        self.assertEqual([('user@example.com', 'Some old text.')],
+                         [(s['email'], s['summary'])
+                          for c in result['categories']
+                          for s in c['snippets']])
+
+        self.request_fetcher.get('/admin/migrate_snippets')
+        self.assertTrue(models.is_migrated_async(
+            models.SNIPPETS_MIGRATION)())
+        response = self.request_fetcher.get(
+            '/api/weekly?week=02-20-2012&summary=1')
+        result = json.loads(response.body)
+        self.assertEqual('Some old text.',
+                         result['categories'][0]['snippets'][0]['summary'])
+
+
+class WeeklyStatsTestCase(UserTestBase):
+    """Test the participation totals, and the dashboard that shows them."""
+
+    def setUp(self):
+        super(WeeklyStatsTestCase, self).setUp()
+        self.request_fetcher.get('/update_settings?category=eng')
+
+    def run_stats_tasks(self):
+        return self.run_tasks(queue_names=('stats',))
+
+    def assertStats(self, category, submitted, private, total_length):
+        self.run_stats_tasks()
+        stats = weeklystats.WeeklyStats.get_by_key_name(
+            '2012-02-13:%s' % category)
+        self.assertEqual((submitted, private, total_length),
+                         (stats.num_submitted, stats.num_private,
+                          stats.total_length))
+
+    def assertNumUsers(self, category, num_users):
+        self.run_stats_tasks()
+        stats = weeklystats.CategoryStats.get_by_key_name(category)
+        self.assertEqual(num_users, stats.num_users)
+
+    def testNewUser(self):
+        self.assertNumUsers('eng', 1)
+        self.assertNumUsers('(unknown)', 0)
+
+    def testSnippetWrites(self):
+        self.request_fetcher.get('/update_snippet?week=02-13-2012&snippet=hi')
+        self.assertStats('eng', 1, 0, 2)
+        self.request_fetcher.get('/update_snippet?week=02-13-2012'
+                                 '&snippet=hello&private=True')
+        self.assertStats('eng', 1, 1, 5)
+
+        self.login('other@example.com')
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.request_fetcher.get('/update_snippet?week=02-13-2012&snippet=yo')
+        self.assertStats('eng', 2, 1, 7)
+        self.assertNumUsers('eng', 2)
+
+    def testCategoryChange(self):
+        self.request_fetcher.get('/update_snippet?week=02-13-2012&snippet=hi')
+        self.request_fetcher.get('/update_settings?category=sales')
+        self.assertStats('eng', 0, 0, 0)
+        self.assertStats('sales', 1, 0, 2)
+        self.assertNumUsers('eng', 0)
+        self.assertNumUsers('sales', 1)
+
+    def testUpdatesAreQueued(self):
+        self.run_stats_tasks()
+        self.request_fetcher.get('/update_snippet?week=02-13-2012&snippet=hi')
+        self.assertEqual(None, weeklystats.WeeklyStats.get_by_key_name(
+            '2012-02-13:eng'))
+        self.assertEqual(1, self.run_stats_tasks())
+        self.assertStats('eng', 1, 0, 2)
+
+    def testRetriedUpdateIsAppliedOnce(self):
+        self.run_stats_tasks()
+        self.request_fetcher.get('/update_snippet?week=02-13-2012&snippet=hi')
+        task = self.taskqueue_stub.GetTasks('stats')[0]
+        headers = dict((k, v) for (k, v) in task['headers']
+                       if k.lower() in _TASK_HEADERS)
+        for _ in xrange(2):
+            self.request_fetcher.post(task['url'],
+                                      base64.b64decode(task['body']),
+                                      headers=headers)
+        self.taskqueue_stub.DeleteTask('stats', task['name'])
+        self.assertStats('eng', 1, 0, 2)
+
+    def testStatsFailureDoesNotFailSave(self):
+        weeklystats._QUEUE_NAME = 'no-such-queue'
+        try:
+            self.request_fetcher.get(
+                '/update_snippet?week=02-13-2012&snippet=hi')
+        finally:
+            weeklystats._QUEUE_NAME = 'stats'
+        self.assertEqual('hi', snippets.Snippet.all().get().text)
+
+    def testBackfill(self):
+        self.request_fetcher.get('/update_snippet?week=02-13-2012&snippet=hi')
+        self.request_fetcher.get('/update_snippet?week=02-06-2012'
+                                 '&snippet=hello&private=True')
+        self.run_stats_tasks()
+        # Pretend these were written before we kept stats.
+        db.delete(weeklystats.WeeklyStats.all(keys_only=True).fetch(100))
+        db.delete(weeklystats.CategoryStats.all(keys_only=True).fetch(100))
+        # Moving them to another category takes eng's stats negative...
+        self.request_fetcher.get('/update_settings?category=sales')
+        self.assertNumUsers('eng', -1)
+        # ...until we backfill.
+        self.request_fetcher.get('/admin/backfill_stats')
+        self.run_stats_tasks()
+        self.assertStats('sales', 1, 0, 2)
+        self.assertNumUsers('sales', 1)
+        self.assertNumUsers('eng', 0)
+        self.assertEqual(None, weeklystats.WeeklyStats.get_by_key_name(
+            '2012-02-13:eng'))
+        stats = weeklystats.WeeklyStats.get_by_key_name('2012-02-06:sales')
+        self.assertEqual((1, 1, 5), (stats.num_submitted, stats.num_private,
+                                     stats.total_length))
+
+    def testDashboard(self):
+        self.request_fetcher.get('/update_snippet?week=02-13-2012&snippet=hi')
+        self.login('other@example.com')
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.run_stats_tasks()
+        self.set_is_admin()
+        response = self.request_fetcher.get('/admin/stats?weeks=4')
+        self.assertIn('eng', response.body)
+        self.assertIn('1 submitted (0 private)', response.body)
+        self.assertIn('1 missing', response.body)
+
+        dashboard = weeklystats.get_dashboard(datetime.date(2012, 2, 13), 4)
+        self.assertEqual(['eng'], [c['category'] for c in dashboard
+                                   if c['num_users']])
+        eng = [c for c in dashboard if c['category'] == 'eng'][0]
+        self.assertEqual([0, 0, 0, 0.5],
+                         [w['participation'] for w in eng['weeks']])
+
+    def testSparkline(self):
+        self.assertEqual(u'\u2581\u2585\u2588',
+                         weeklystats.sparkline([0, 0.5, 1]))
+        self.assertEqual(u'', weeklystats.sparkline([]))
+
+
+class HipChatConfigTestCase(unittest.TestCase):
+    """Test that hipchat.cfg's settings reach the HipChat requests."""
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        hipchat_cfg = os.path.join(self.root_dir, 'hipchat.cfg')
+        with open(hipchat_cfg, 'w') as f:
+            f.write('token = abc123\n'
+                    'proxy_server = proxy.example.com:3128\n'
+                    'proxy_type = https\n')
+        self.config = appconfig.load(
+            hipchat_cfg, os.path.join(self.root_dir, 'snippets.cfg'))
+        self.requests = []
+        self.urlopen = hipchatlib.urllib2.urlopen
+
+        def fake_urlopen(req):
+            self.requests.append(req)
+            return StringIO.StringIO(json.dumps(
+                {'rooms': [{'name': 'Eng', 'room_id': 7}],
+                 'status': 'sent'}))
+        hipchatlib.urllib2.urlopen = fake_urlopen
+
+    def tearDown(self):
+        hipchatlib.urllib2.urlopen = self.urlopen
+        shutil.rmtree(self.root_dir)
+
+    def testConfig(self):
+        self.assertTrue(self.config.send_to_hipchat)
+        self.assertEqual(('abc123', 'proxy.example.com:3128', 'https'),
+                         (self.config.hipchat_token,
+                          self.config.hipchat_proxy_server,
+                          self.config.hipchat_proxy_type))
+
+    def testRequests(self):
+        hipchatlib.send_to_hipchat_room(self.config, 'Eng', 'hello')
+        self.assertEqual(2, len(self.requests))
+        for req in self.requests:
+            self.assertIn('auth_token=abc123', req.get_full_url())
+            self.assertEqual('proxy.example.com:3128', req.get_host())
+        self.assertIn('room_id=7', self.requests[1].get_data())
+        self.assertIn('message=hello', self.requests[1].get_data())
+
+
+class EntityCacheTestCase(UserTestBase):
+    """Test the cache in front of the datastore, and its invalidation."""
+
+    def setUp(self):
+        super(EntityCacheTestCase, self).setUp()
+        self.request_fetcher.get('/update_settings?category=a+1st')
+        self.generation_check_seconds = entitycache._GENERATION_CHECK_SECONDS
+
+    def tearDown(self):
+        entitycache._GENERATION_CHECK_SECONDS = self.generation_check_seconds
+        super(EntityCacheTestCase, self).tearDown()
+
+    def _change_category_behind_our_back(self, category):
+        """Change the user's category without telling the cache."""
+        user = snippets.User.all().filter('email =', 'user@example.com').get()
+        user.category = category
+        db.put(user)
+
+    def testReadsAreCached(self):
+        response = self.request_fetcher.get('/weekly')
+        self.assertIn('a 1st', response.body)
+        self._change_category_behind_our_back('b 2nd')
+        response = self.request_fetcher.get('/weekly')
+        self.assertIn('a 1st', response.body)
+
+    def testWritesInvalidate(self):
+        response = self.request_fetcher.get('/weekly')
+        self.assertIn('a 1st', response.body)
+        self.request_fetcher.get('/update_settings?category=b+2nd')
+        response = self.request_fetcher.get('/weekly')
+        self.assertIn('b 2nd', response.body)
+
+        self.request_fetcher.get('/update_snippet?week=02-13-2012'
+                                 '&snippet=my+snippet')
+        response = self.request_fetcher.get('/weekly')
+        self.assertIn('my snippet', response.body)
+
+    def testOtherInstancesWritesInvalidate(self):
+        self.request_fetcher.get('/weekly')
+        self._change_category_behind_our_back('b 2nd')
+        # This is what invalidate() does, in another instance: it
+        # changes memcache but not our idea of the generation.
+        from google.appengine.api import memcache
+        memcache.incr(entitycache._GENERATION_KEY % 'User')
+        response = self.request_fetcher.get('/weekly')
+        self.assertIn('a 1st', response.body)     # we haven't checked yet
+
+        entitycache._GENERATION_CHECK_SECONDS = -1
+        response = self.request_fetcher.get('/weekly')
+        self.assertIn('b 2nd', response.body)
+
+    def testReadsRightAfterWritesAreNotCached(self):
+        entitycache._CONSISTENCY_SECONDS = 60
+        hr_policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=0)
+        self.testbed.get_stub(testbed.DATASTORE_SERVICE_NAME
+                              ).SetConsistencyPolicy(hr_policy)
+        self._change_category_behind_our_back('b 2nd')
+        entitycache.invalidate('User')
+        response = self.request_fetcher.get('/weekly')
+        self.assertIn('a 1st', response.body)     # the query is behind
+
+        user = snippets.User.all().filter('email =', 'user@example.com').get()
+        db.get(user.key())                        # now it's caught up
+        response = self.request_fetcher.get('/weekly')
+        self.assertIn('b 2nd', response.body)
+
+    def testCachedValuesAreCopies(self):
+        get_user = snippets._DEFAULT_BACKENDS.storage.get_user
+        user = get_user('user@example.com')
+        user.category = 'changed'
+        self.assertEqual('a 1st', get_user('user@example.com').category)
+
+    def testLRUCache(self):
+        cache = entitycache.LRUCache(max_bytes=10, ttl_seconds=60)
+        cache.set('a', 'A', 4)
+        cache.set('b', 'B', 4)
+        self.assertEqual('A', cache.get('a'))     # now b is least recent
+        cache.set('c', 'C', 4)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual('A', cache.get('a'))
+        self.assertEqual('C', cache.get('c'))
+        self.assertEqual(8, cache.num_bytes)
+        cache.set('huge', 'H', 11)
+        self.assertEqual(None, cache.get('huge'))
+
+        cache = entitycache.LRUCache(max_bytes=10, ttl_seconds=-1)
+        cache.set('a', 'A', 4)
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(0, cache.num_bytes)
+
+
+class AsyncQueryTestCase(UserTestBase):
+    """Test that pages start their independent queries before waiting."""
+
+    def setUp(self):
+        super(AsyncQueryTestCase, self).setUp()
+        self.request_fetcher.get('/update_settings?category=dummy')
+        entitycache.clear()
+        self.events = []
+        self.start_query = storage._start_query
+
+        def logging_start_query(q, limit):
+            kind = q._model_class.kind()
+            self.events.append(('start', kind))
+            finish_query = self.start_query(q, limit)
+
+            def logging_finish_query():
+                self.events.append(('finish', kind))
+                return finish_query()
+            return logging_finish_query
+        storage._start_query = logging_start_query
+
+    def tearDown(self):
+        storage._start_query = self.start_query
+        super(AsyncQueryTestCase, self).tearDown()
+
+    def assertStartedTogether(self):
+        self.assertEqual([('start', 'Snippet'), ('start', 'User')],
+                         sorted(self.events[:2]))
+        self.assertEqual(['finish', 'finish'], [e[0] for e in self.events[2:]])
+
+    def testSummaryPage(self):
+        response = self.request_fetcher.get('/weekly')
+        self.assertIn('dummy', response.body)
+        self.assertStartedTogether()
+
+    def testUserPage(self):
+        response = self.request_fetcher.get('/')
+        self.assertIn('user@example.com', response.body)
+        self.assertStartedTogether()
+
+
+class SQLiteStorageTestCase(UserTestBase):
+    """Test the pages work the same when we keep everything in sqlite."""
+
+    def setUp(self):
+        super(SQLiteStorageTestCase, self).setUp()
+        self.storage = sqlitestorage.SQLiteStorage(':memory:')
+        self.request_fetcher.extra_environ[snippets._BACKENDS_ENVIRON_KEY] = (
+            snippets._Backends(storage=self.storage,
+                               auth=snippets._DEFAULT_BACKENDS.auth))
+
+    def testUserAndWeeklyPages(self):
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.request_fetcher.get('/update_snippet?week=02-13-2012&snippet=hi')
+        response = self.request_fetcher.get('/?u=user@example.com')
+        self.assertInSnippet('hi', response.body, 0)
+        response = self.request_fetcher.get('/weekly?week=02-13-2012')
+        self.assertIn('eng', response.body)
+        self.assertInSnippet('hi', response.body, 0)
+        # None of it went to the datastore.
+        self.assertEqual(0, snippets.User.all().count())
+        self.assertEqual(0, snippets.Snippet.all().count())
+
+    def testCategoryTimeline(self):
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.request_fetcher.get('/update_snippet?week=02-13-2012'
+                                 '&snippet=eng+news')
+        self.login('other@example.com')
+        self.request_fetcher.get('/update_settings?category=sales')
+        self.request_fetcher.get('/update_snippet?week=02-13-2012'
+                                 '&snippet=sales+news')
+        response = self.request_fetcher.get(
+            '/category?name=eng&from=02-06-2012&to=02-13-2012')
+        self.assertIn('eng news', response.body)
+        self.assertNotIn('sales news', response.body)
+
+    def testSealedWeek(self):
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.request_fetcher.get('/update_snippet?week=01-09-2012'
+                                 '&snippet=old+news')
+        response = self.request_fetcher.get('/weekly?week=01-09-2012')
+        self.assertIn('old news', response.body)
+        self.assertNotEqual(None, self.storage.get_sealed_week_async(
+            datetime.date(2012, 1, 9))())
+        self.request_fetcher.get('/update_snippet?week=01-09-2012'
+                                 '&snippet=new+news')
+        self.assertEqual(None, self.storage.get_sealed_week_async(
+            datetime.date(2012, 1, 9))())
+        response = self.request_fetcher.get('/weekly?week=01-09-2012')
+        self.assertIn('new news', response.body)
+
+    def testCronJobReads(self):
+        week = datetime.date(2012, 2, 13)
+        self.assertEqual(None, self.storage.get_oldest_week())
+        self.storage.save_snippets('user@example.com',
+                                   [(week, 'hi', False, None)], _TEST_TODAY)
+        self.assertEqual(week, self.storage.get_oldest_week())
+        email_to_week = {'user@example.com': week,
+                         'other@example.com': week}
+        self.assertEqual(set(['user@example.com']),
+                         self.storage.get_emails_with_snippets(email_to_week))
+
+        self.storage.record_sent('view_email',
+                                 {'user@example.com': week})
+        self.assertEqual({'other@example.com': week},
+                         self.storage.get_unsent('view_email', email_to_week))
+        self.assertEqual(email_to_week,
+                         self.storage.get_unsent('reminder_email',
+                                                 email_to_week))
+        self.assertEqual(0, self.storage.forget_sent(week))
+        self.assertEqual(1, self.storage.forget_sent(
+            week + datetime.timedelta(7)))
+        self.assertEqual(email_to_week,
+                         self.storage.get_unsent('view_email', email_to_week))
+
+    def testStaleVersionIsRejected(self):
+        week = datetime.date(2012, 2, 13)
+        (saved, stale) = self.storage.save_snippets(
+            'user@example.com', [(week, 'first', False, 0)], _TEST_TODAY)
+        self.assertEqual(1, saved[0].version)
+        (saved, stale) = self.storage.save_snippets(
+            'user@example.com', [(week, 'second', False, 0)], _TEST_TODAY)
+        self.assertEqual([], saved)
+        self.assertEqual('first', stale[0].text)
+        # Saving the same text again is a no-op.
+        (saved, stale) = self.storage.save_snippets(
+            'user@example.com', [(week, 'first', False, 1)], _TEST_TODAY)
+        self.assertEqual(([], []), (saved, stale))
+
+    def testHistoryPage(self):
+        for text in ('first version', 'second version'):
+            params = {'week': '02-20-2012', 'snippet': text}
+            self.request_fetcher.post('/update_snippet', params, status=200)
+        response = self.request_fetcher.get('/history?week=02-20-2012')
+        self.assertTrue(response.body.index('second version') <
+                        response.body.index('first version'))
+
+    def testStatsDashboard(self):
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.request_fetcher.get('/update_snippet?week=02-13-2012'
+                                 '&snippet=hello&private=True')
+        self.login('other@example.com')
+        self.request_fetcher.get('/update_settings?category=eng')
+        categories = self.storage.get_stats_dashboard(
+            datetime.date(2012, 2, 13), 2)
+        self.assertEqual(['eng'], [c['category'] for c in categories])
+        self.assertEqual(2, categories[0]['num_users'])
+        latest = categories[0]['weeks'][-1]
+        self.assertEqual((1, 1, 1, 5),
+                         (latest['submitted'], latest['private'],
+                          latest['missing'], latest['average_length']))
+
+
+class StandaloneTestCase(unittest.TestCase):
+    """Test serving the pages without appengine, as standalone.py does."""
+
+    def setUp(self):
+        # With no service stubs registered, any call to the datastore,
+        # memcache or the like fails, as it would outside appengine.
+        self.orig_apiproxy = apiproxy_stub_map.apiproxy
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        os.environ['SNIPPETS_ADMINS'] = 'admin@example.com'
+        self.root_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.root_dir, 'snippets.db')
+        self.request_fetcher = webtest.TestApp(
+            standalone.make_application(self.db_path),
+            extra_environ={snippets._CONFIG_ENVIRON_KEY:
+                           _test_config(_TEST_TODAY)})
+        # The same database, as another process would see it.
+        self.storage = sqlitestorage.SQLiteStorage(self.db_path)
+
+    def tearDown(self):
+        del os.environ['SNIPPETS_ADMINS']
+        shutil.rmtree(self.root_dir)
+        apiproxy_stub_map.apiproxy = self.orig_apiproxy
+
+    def get(self, url, email, **kwargs):
+        headers = {}
+        if email:
+            headers['X-Forwarded-Email'] = email
+        return self.request_fetcher.get(url, headers=headers, **kwargs)
+
+    def testLoginRedirect(self):
+        response = self.get('/weekly', None, status=302)
+        self.assertIn('/oauth2/sign_in?rd=', response.headers['Location'])
+
+    def testUserPage(self):
+        self.get('/update_snippet?week=02-13-2012&snippet=standalone',
+                 'User@Example.com')
+        response = self.get('/', 'user@example.com')
+        self.assertIn('standalone', response.body)
+        self.assertIn('/oauth2/sign_out?rd=', response.body)
+
+    def testOnlyAdminsCanEditOthers(self):
+        self.get('/update_snippet?week=02-13-2012&snippet=hi',
+                 'user@example.com')
+        self.get('/update_settings?u=user@example.com&category=x',
+                 'other@example.com', status=500)
+        self.get('/update_settings?u=user@example.com&category=x',
+                 'admin@example.com')
+        self.assertEqual('x',
+                         self.storage.get_user('user@example.com').category)
+
+    def testWeeklyPageIsStreamed(self):
+        self.get('/update_settings?category=eng', 'user@example.com')
+        self.get('/update_snippet?week=02-13-2012&snippet=streamed',
+                 'user@example.com')
+        environ = {'PATH_INFO': '/weekly',
+                   'QUERY_STRING': 'week=02-13-2012',
+                   'HTTP_X_FORWARDED_EMAIL': 'user@example.com',
+                   snippets._CONFIG_ENVIRON_KEY: _test_config(_TEST_TODAY)}
+        wsgiref.util.setup_testing_defaults(environ)
+        statuses = []
+        chunks = list(self.request_fetcher.app(
+            environ, lambda status, headers: statuses.append(status)))
+        self.assertEqual(['200 OK'], statuses)
+        # The top of the page comes by itself, then each category.
+        self.assertIn('Snippets for the week of', chunks[0])
+        self.assertNotIn('streamed', chunks[0])
+        self.assertIn('<h3> eng </h3>', chunks[1])
+        self.assertIn('streamed', chunks[1])
+        self.assertIn('</html>', chunks[-1])
+
+    def testAppengineOnlyPagesAreNotServed(self):
+        self.get('/admin/send_view_email', 'admin@example.com', status=404)
+
+    def testConcurrentUsers(self):
+        def update_and_view(thread_number, i):
+            email = 'user%d@example.com' % thread_number
+            self.get('/update_snippet?week=02-13-2012&snippet=update+%d' % i,
+                     email)
+            response = self.get('/weekly?week=02-13-2012', email)
+            # Each thread sees its own user, and its own latest update.
+            self.assertIn('update %d' % i, response.body)
+            self.assertIn(email, response.body)
+
+        self.assertEqual([], _run_in_threads(10, 10, update_and_view))
+        snippets_for_week = self.storage.get_snippets_for_week(
+            datetime.date(2012, 2, 13))
+        self.assertEqual(10, len(snippets_for_week))
+        for snippet in snippets_for_week:
+            self.assertEqual(('update 9', 10), (snippet.text, snippet.version))
+
 
 class LoginRequiredTestCase(SnippetsTestBase):
     def testLoginRequiredForUserView(self):
@@ -273,6 +1533,153 @@ class AccessTestCase(UserTestBase):
         self.request_fetcher.get(url)
 
 
+class ConcurrencyTestCase(UserTestBase):
+    """Test many simultaneous requests, as app.yaml's threadsafe allows."""
+
+    def testUpdateAndViewSnippets(self):
+        self.request_fetcher.get('/update_settings?category=eng')
+        first_week = datetime.date(2012, 1, 2)
+
+        def update_and_view(thread_number, i):
+            # Each thread updates its own week, over and over.
+            week = (first_week + datetime.timedelta(7 * thread_number))
+            week_string = week.strftime('%m-%d-%Y')
+            params = {'week': week_string,
+                      'snippet': 'thread %d, update %d' % (thread_number, i)}
+            self.request_fetcher.post('/update_snippet', params, status=200)
+            response = self.request_fetcher.get('/weekly?week=' + week_string)
+            self.assertIn('thread %d, update' % thread_number, response.body)
+
+        self.assertEqual([], _run_in_threads(10, 10, update_and_view))
+        for thread_number in xrange(10):
+            week = first_week + datetime.timedelta(7 * thread_number)
+            snippet = snippets.Snippet.all().filter('week =', week).get()
+            self.assertEqual('thread %d, update 9' % thread_number,
+                             snippet.text)
+            self.assertEqual(10, snippet.version)
+        self.run_tasks(queue_names=('stats',))
+        stats = weeklystats.WeeklyStats.get_by_key_name('2012-01-02:eng')
+        self.assertEqual(1, stats.num_submitted)
+
+    def testTimeIsPerRequest(self):
+        # Two clocks at once: requests don't see each other's time.
+        configs = (_test_config(datetime.datetime(2012, 2, 23)),
+                   _test_config(datetime.datetime(2012, 3, 1)))
+        expected_weeks = ('February 13, 2012', 'February 20, 2012')
+
+        def view_weekly(thread_number, i):
+            config = configs[thread_number % 2]
+            expected = expected_weeks[thread_number % 2]
+            response = self.request_fetcher.get(
+                '/weekly',
+                extra_environ={snippets._CONFIG_ENVIRON_KEY: config})
+            self.assertIn(expected, response.body)
+
+        self.assertEqual([], _run_in_threads(4, 10, view_weekly))
+
+
+class MultiTenantTestCase(UserTestBase):
+    """Test partitioning users and snippets by email domain."""
+
+    def setUp(self):
+        super(MultiTenantTestCase, self).setUp()
+        self.testbed.init_mail_stub()
+        self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.request_fetcher.get('/update_snippet?week=02-13-2012'
+                                 '&snippet=example+snippet')
+        self.login('user@other.com')
+        self.request_fetcher.get('/update_settings?category=sales')
+        self.request_fetcher.get('/update_snippet?week=02-13-2012'
+                                 '&snippet=other+snippet')
+        self.login('user@example.com')
+        self.run_tasks(queue_names=('stats',))
+
+    def tearDown(self):
+        namespace_manager.set_namespace('')
+        super(MultiTenantTestCase, self).tearDown()
+
+    def set_now(self, now):
+        self.request_fetcher.extra_environ[snippets._CONFIG_ENVIRON_KEY] = (
+            _test_config(now)._replace(multitenant=True))
+
+    def testEachTenantHasItsOwnNamespace(self):
+        self.assertEqual(['example.com', 'other.com'], tenants.all_tenants())
+        self.assertEqual(0, snippets.Snippet.all().count())
+        namespace_manager.set_namespace('other.com')
+        self.assertEqual(['user@other.com'],
+                         [s.email for s in snippets.Snippet.all()])
+        self.assertEqual(1, weeklystats.CategoryStats.get_by_key_name(
+            'sales').num_users)
+
+    def testWeeklyPageShowsOnlyYourTenant(self):
+        response = self.request_fetcher.get('/weekly?week=02-13-2012')
+        self.assertIn('example snippet', response.body)
+        self.assertIn('<h3> eng </h3>', response.body)
+        self.assertNotIn('other snippet', response.body)
+        self.assertNotIn('<h3> sales </h3>', response.body)
+
+        self.login('user@other.com')
+        response = self.request_fetcher.get('/weekly?week=02-13-2012')
+        self.assertIn('other snippet', response.body)
+        self.assertNotIn('example snippet', response.body)
+
+    def testOtherTenantsUsersDontExist(self):
+        response = self.request_fetcher.get('/?u=user@other.com')
+        self.assertNotIn('other snippet', response.body)
+
+    def testAdminCanChooseTenant(self):
+        self.set_is_admin()
+        response = self.request_fetcher.get('/admin/stats?tenant=other.com')
+        self.assertIn('<td>sales</td>', response.body)
+        self.assertNotIn('<td>eng</td>', response.body)
+
+    def testCronRunsForEveryTenant(self):
+        self.set_now(datetime.datetime(2012, 2, 26, 23, 50, 0))
+        self.logout()          # as cron requests are
+        self.request_fetcher.get('/admin/send_reminder_email')
+        self.run_tasks()
+        for email in ('user@example.com', 'user@other.com'):
+            self.assertEqual(1,
+                             len(_sent_messages_to(self.mail_stub, email)))
+
+
+    def testMigrateToTenants(self):
+        # Write as if multi-tenant mode were still off.
+        self.request_fetcher.extra_environ[snippets._CONFIG_ENVIRON_KEY] = (
+            _test_config(_TEST_TODAY))
+        self.request_fetcher.get('/update_snippet?week=02-13-2012'
+                                 '&snippet=stale+snippet')
+        self.login('old@example.com')
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.request_fetcher.get('/update_snippet?week=02-06-2012'
+                                 '&snippet=old+snippet')
+        self.set_now(_TEST_TODAY)
+        response = self.request_fetcher.get('/weekly?week=02-06-2012')
+        self.assertNotIn('old snippet', response.body)
+
+        self.set_is_admin()
+        self.request_fetcher.get('/admin/migrate_to_tenants')
+        self.run_tasks()
+        response = self.request_fetcher.get('/weekly?week=02-06-2012')
+        self.assertIn('old snippet', response.body)
+        # user@example.com had started afresh in the tenant, so we
+        # didn't copy what they wrote before.
+        response = self.request_fetcher.get('/weekly?week=02-13-2012')
+        self.assertIn('example snippet', response.body)
+        self.assertNotIn('stale snippet', response.body)
+
+        # The history came too, and a second run copies nothing new.
+        self.request_fetcher.get('/admin/migrate_to_tenants')
+        self.run_tasks()
+        namespace_manager.set_namespace('example.com')
+        snippet = snippets.Snippet.all().filter('email =',
+                                                'old@example.com').get()
+        self.assertEqual(1, revisions.SnippetRevision.all().ancestor(
+            snippet).count())
+        self.assertEqual(2, snippets.User.all().count())
+
+
 class NewUserTestCase(UserTestBase):
     """Test the workflow for registering as a new user."""
 
@@ -487,7 +1894,7 @@ class ShowCorrectWeekTestCase(UserTestBase):
 
     def testMonday(self):
         # For adding new snippets, you have until Wed to add for last week.
-        snippets._TODAY_FN = lambda: datetime.datetime(2012, 2, 20)
+        self.set_now(datetime.datetime(2012, 2, 20))
         response = self.request_fetcher.get('/')
         self.assertInSnippet('February 13, 2012', response.body, 0)
         # For *viewing*'s snippets, we always show last week's snippets.
@@ -495,48 +1902,102 @@ class ShowCorrectWeekTestCase(UserTestBase):
         self.assertIn('February 13, 2012', response.body)
 
     def testTuesday(self):
-        snippets._TODAY_FN = lambda: datetime.datetime(2012, 2, 21)
+        self.set_now(datetime.datetime(2012, 2, 21))
         response = self.request_fetcher.get('/')
         self.assertInSnippet('February 13, 2012', response.body, 0)
         response = self.request_fetcher.get('/weekly')
         self.assertIn('February 13, 2012', response.body)
 
     def testWednesday(self):
-        snippets._TODAY_FN = lambda: datetime.datetime(2012, 2, 22)
+        self.set_now(datetime.datetime(2012, 2, 22))
         response = self.request_fetcher.get('/')
         self.assertInSnippet('February 13, 2012', response.body, 0)
         response = self.request_fetcher.get('/weekly')
         self.assertIn('February 13, 2012', response.body)
 
     def testThursday(self):
-        snippets._TODAY_FN = lambda: datetime.datetime(2012, 2, 23)
+        self.set_now(datetime.datetime(2012, 2, 23))
         response = self.request_fetcher.get('/')
         self.assertInSnippet('February 20, 2012', response.body, 0)
         response = self.request_fetcher.get('/weekly')
         self.assertIn('February 13, 2012', response.body)
 
     def testFriday(self):
-        snippets._TODAY_FN = lambda: datetime.datetime(2012, 2, 24)
+        self.set_now(datetime.datetime(2012, 2, 24))
         response = self.request_fetcher.get('/')
         self.assertInSnippet('February 20, 2012', response.body, 0)
         response = self.request_fetcher.get('/weekly')
         self.assertIn('February 13, 2012', response.body)
 
     def testSaturday(self):
-        snippets._TODAY_FN = lambda: datetime.datetime(2012, 2, 25)
+        self.set_now(datetime.datetime(2012, 2, 25))
         response = self.request_fetcher.get('/')
         self.assertInSnippet('February 20, 2012', response.body, 0)
         response = self.request_fetcher.get('/weekly')
         self.assertIn('February 13, 2012', response.body)
 
     def testSunday(self):
-        snippets._TODAY_FN = lambda: datetime.datetime(2012, 2, 26)
+        self.set_now(datetime.datetime(2012, 2, 26))
         response = self.request_fetcher.get('/')
         self.assertInSnippet('February 20, 2012', response.body, 0)
         response = self.request_fetcher.get('/weekly')
         self.assertIn('February 13, 2012', response.body)
 
 
+class WeekCalendarTestCase(unittest.TestCase):
+    """Test the week-boundary rules directly, without going through pages."""
+
+    def testDefaultTimezone(self):
+        calendar = weekcalendar.get_calendar()
+        self.assertEqual(weekcalendar.DEFAULT_TIMEZONE, calendar.timezone_name)
+        self.assertTrue(calendar is weekcalendar.get_calendar(None))
+
+    def testUnknownTimezoneUsesDefault(self):
+        calendar = weekcalendar.get_calendar('Not/A_Timezone')
+        self.assertTrue(calendar is weekcalendar.get_calendar())
+        self.assertFalse(weekcalendar.is_valid_timezone('Not/A_Timezone'))
+
+    def testSundayNight(self):
+        calendar = weekcalendar.get_calendar()
+        before = datetime.datetime(2012, 2, 19, 22, 59)
+        after = datetime.datetime(2012, 2, 19, 23, 0)
+        self.assertEqual(datetime.date(2012, 2, 6),
+                         calendar.existingsnippet_monday(before))
+        self.assertEqual(datetime.date(2012, 2, 13),
+                         calendar.existingsnippet_monday(after))
+        self.assertFalse(calendar.is_reminder_time(before))
+        self.assertTrue(calendar.is_reminder_time(after))
+
+    def testReminderMonday(self):
+        calendar = weekcalendar.get_calendar()
+        self.assertEqual(datetime.datetime(2012, 2, 20, 17, 0),
+                         calendar.deadline(datetime.date(2012, 2, 13)))
+        sunday_night = datetime.datetime(2012, 2, 19, 23, 50)
+        self.assertEqual(datetime.date(2012, 2, 13),
+                         calendar.reminder_monday(sunday_night, 18))
+        self.assertEqual(None, calendar.reminder_monday(sunday_night, 19))
+        saturday = datetime.datetime(2012, 2, 18, 15, 10)
+        self.assertEqual(datetime.date(2012, 2, 13),
+                         calendar.reminder_monday(saturday, 50))
+
+    def testOtherTimezone(self):
+        if not weekcalendar.is_valid_timezone('America/New_York'):
+            return      # no pytz, so no timezones but the default
+        calendar = weekcalendar.get_calendar('America/New_York')
+        # 8:50pm Sunday in California is 11:50pm in New York.
+        now = datetime.datetime(2012, 2, 19, 20, 50)
+        self.assertTrue(calendar.is_reminder_time(now))
+        self.assertFalse(weekcalendar.get_calendar().is_reminder_time(now))
+        self.assertEqual(datetime.date(2012, 2, 13),
+                         calendar.existingsnippet_monday(now))
+        # 10pm Wednesday in California is Thursday in New York.
+        now = datetime.datetime(2012, 2, 22, 22, 0)
+        self.assertEqual(datetime.date(2012, 2, 20),
+                         calendar.newsnippet_monday(now))
+        self.assertEqual(datetime.date(2012, 2, 13),
+                         weekcalendar.get_calendar().newsnippet_monday(now))
+
+
 class NosnippetGapFillingTestCase(UserTestBase):
     """Test we show correct text when folks miss a week for snippets."""
 
@@ -715,6 +2176,27 @@ class PrivateSnippetTestCase(UserTestBase):
             self.assertInSnippet('close@', response.body, i)
             self.assertNotInSnippet('whoa', response.body, i)
 
+    def testSnippetsKnowTheirDomain(self):
+        self.assertEqual(['example.com', 'example.com', 'example.com',
+                          'some_other_domain.com'],
+                         sorted(s.domain for s in snippets.Snippet.all()
+                                .filter('week =', datetime.date(2012, 2, 13))))
+
+    def testSnippetWithoutDomain(self):
+        # Snippets from before we stored the domain are still visible
+        # to their author's domain, and only to it.
+        q = snippets.Snippet.all().filter('email =', 'private@example.com')
+        for snippet in q:
+            snippet.domain = None
+            snippet.put()
+        entitycache.clear()
+        url = '/weekly?week=02-13-2012'
+        response = self.request_fetcher.get(url)
+        self.assertIn('no see um', response.body)
+        self.login('private@some_other_domain.com')
+        response = self.request_fetcher.get(url)
+        self.assertNotIn('no see um', response.body)
+
 
 class SendingEmailTestCase(UserTestBase):
     """Test we correctly send cron emails."""
@@ -723,17 +2205,9 @@ class SendingEmailTestCase(UserTestBase):
         super(SendingEmailTestCase, self).setUp()
         self.testbed.init_mail_stub()
         self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
-        # Also make sure we suppress sending to hipchat for tests.
-        snippets._SEND_TO_HIPCHAT = False
-        # The email-senders sleep 2 seconds between sends for quota
-        # reasons.  We don't want that for most tests, so we suppress
-        # it.  The quota test will redefine time.sleep itself.
-        self.sleep_fn = time.sleep
-        time.sleep = lambda sec: sec
-
         # We send out mail on Sunday nights and Monday mornings, so
         # we'll set 'today' to be Sunday right around midnight.
-        snippets._TODAY_FN = lambda: datetime.datetime(2012, 2, 19, 23, 50, 0)
+        self.set_now(datetime.datetime(2012, 2, 19, 23, 50, 0))
 
         # For our mail tests, we set up a db with a few users, some of
         # whom have snippets for this week ('this week' being 13 Feb
@@ -753,25 +2227,36 @@ class SendingEmailTestCase(UserTestBase):
 
         self.login('user@example.com')        # back to the normal user
 
-    def tearDown(self):
-        UserTestBase.tearDown(self)
-        time.sleep = self.sleep_fn
+        # Everyone has a plan, so the reminder job need only visit
+        # the plans due each hour.
+        cronshard.mark_ready('ReminderPlan')
+
+    def run_cron(self, url):
+        """Run a cron job, and all the shard and mail tasks it queues."""
+        self.request_fetcher.get(url)
+        self.run_tasks()
+
+    def put_plan(self, email, lead_hours, on_leave=False):
+        """Store a ReminderPlan for email, for the week of 02-13-2012."""
+        user = snippets._DEFAULT_BACKENDS.storage.get_user(email)
+        reminderplans.new_plan(user, lead_hours,
+                               on_leave, datetime.date(2012, 2, 13)).put()
 
     def assertEmailSentTo(self, email):
-        r = self.mail_stub.get_sent_messages(to=email)
+        r = _sent_messages_to(self.mail_stub, email)
         self.assertEqual(1, len(r), r)
 
     def assertEmailNotSentTo(self, email):
-        r = self.mail_stub.get_sent_messages(to=email)
+        r = _sent_messages_to(self.mail_stub, email)
         self.assertEqual(0, len(r), r)
 
     def assertEmailContains(self, email, text):
-        r = self.mail_stub.get_sent_messages(to=email)
+        r = _sent_messages_to(self.mail_stub, email)
         self.assertEqual(1, len(r), r)
         self.assertIn(text, r[0].body.decode())
 
     def assertEmailDoesNotContain(self, email, text):
-        r = self.mail_stub.get_sent_messages(to=email)
+        r = _sent_messages_to(self.mail_stub, email)
         self.assertEqual(1, len(r), r)
         self.assertNotIn(text, r[0].body.decode())
 
@@ -780,18 +2265,158 @@ class SendingEmailTestCase(UserTestBase):
         pass
 
     def testSendReminderEmail(self):
-        self.request_fetcher.get('/admin/send_reminder_email')
+        self.run_cron('/admin/send_reminder_email')
         self.assertEmailSentTo('does_not_have_snippet@example.com')
         self.assertEmailSentTo('has_no_snippets@example.com')
         self.assertEmailNotSentTo('has_snippet@example.com')
         self.assertEmailNotSentTo('has_many_snippets@example.com')
-        r = self.mail_stub.get_sent_messages(to='has_no_snippets@example.com')
-        self.assertEqual('has_no_snippets@example.com', r[0].to)
+        r = _sent_messages_to(self.mail_stub, 'has_no_snippets@example.com')
+        self.assertIn('has_no_snippets@example.com', r[0].bcc)
+        self.assertFalse(getattr(r[0], 'to', None))
         self.assertIn('Snippet Server', r[0].sender)
         self.assertEqual('Weekly snippets due today at 5pm', r[0].subject)
 
+    def testSendReminderEmailIsGrouped(self):
+        # Both users who need a reminder get the same one, so they
+        # share a single email.
+        self.run_cron('/admin/send_reminder_email')
+        r = self.mail_stub.get_sent_messages()
+        self.assertEqual(1, len(r), r)
+        self.assertEqual(['does_not_have_snippet@example.com',
+                          'has_no_snippets@example.com'],
+                         sorted(_recipients(r[0])))
+
+    def testSendReminderEmailOnlyAtReminderTime(self):
+        # The cron job runs hourly, but only sends on Sunday at 11pm.
+        self.set_now(datetime.datetime(2012, 2, 19, 22, 50, 0))
+        self.run_cron('/admin/send_reminder_email')
+        self.assertEmailNotSentTo('does_not_have_snippet@example.com')
+        self.assertEmailNotSentTo('has_no_snippets@example.com')
+
+    def testSendReminderEmailInUserTimezone(self):
+        if not weekcalendar.is_valid_timezone('America/New_York'):
+            return      # no pytz, so no timezones but the default
+        self.login('has_no_snippets@example.com')
+        self.request_fetcher.get('/update_settings?timezone=America/New_York')
+        self.login('user@example.com')
+
+        # 11:50pm Sunday in New York.
+        self.set_now(datetime.datetime(2012, 2, 19, 20, 50, 0))
+        self.run_cron('/admin/send_reminder_email')
+        self.assertEmailSentTo('has_no_snippets@example.com')
+        self.assertEmailNotSentTo('does_not_have_snippet@example.com')
+
+        # 11:50pm Sunday in California.
+        self.set_now(datetime.datetime(2012, 2, 19, 23, 50, 0))
+        self.run_cron('/admin/send_reminder_email')
+        self.assertEmailSentTo('has_no_snippets@example.com')   # still 1
+        self.assertEmailSentTo('does_not_have_snippet@example.com')
+
+    def testSendReminderEmailAtPlannedTime(self):
+        # 3pm Saturday is 50 hours before the deadline.
+        self.put_plan('has_no_snippets@example.com', 50)
+        self.set_now(datetime.datetime(2012, 2, 18, 15, 50, 0))
+        self.run_cron('/admin/send_reminder_email')
+        self.assertEmailSentTo('has_no_snippets@example.com')
+        self.assertEmailNotSentTo('does_not_have_snippet@example.com')
+        r = _sent_messages_to(self.mail_stub, 'has_no_snippets@example.com')
+        self.assertEqual('Weekly snippets due Monday at 5pm', r[0].subject)
+        self.assertIn('for this\nweek', r[0].body.decode())
+
+        # Everyone else still gets theirs on Sunday night.
+        self.set_now(datetime.datetime(2012, 2, 19, 23, 50, 0))
+        self.run_cron('/admin/send_reminder_email')
+        self.assertEmailSentTo('has_no_snippets@example.com')   # still 1
+        self.assertEmailSentTo('does_not_have_snippet@example.com')
+
+    def testNoReminderEmailOnLeave(self):
+        self.put_plan('has_no_snippets@example.com', 18, on_leave=True)
+        self.run_cron('/admin/send_reminder_email')
+        self.assertEmailNotSentTo('has_no_snippets@example.com')
+        self.assertEmailSentTo('does_not_have_snippet@example.com')
+
+    def testReminderEmailVisitsOnlyDuePlans(self):
+        self.put_plan('has_no_snippets@example.com', 50)
+        self.run_cron('/admin/send_reminder_email')
+        shards = cronshard.CronShard.all().fetch(100)
+        self.assertEqual(['planned_reminder_email'],
+                         list(set(shard.job for shard in shards)))
+        # has_snippet and has_many_snippets are due, but have
+        # snippets already.
+        self.assertEqual(3, sum(shard.processed for shard in shards))
+        self.assertEmailNotSentTo('has_no_snippets@example.com')
+        self.assertEmailSentTo('does_not_have_snippet@example.com')
+
+    def testReminderEmailBeforeEveryoneHasAPlan(self):
+        db.delete(cronshard._sharding_ready_key('ReminderPlan'))
+        db.delete(reminderplans.ReminderPlan.all(keys_only=True).fetch(100))
+        self.run_cron('/admin/send_reminder_email')
+        self.assertEmailSentTo('has_no_snippets@example.com')
+        self.assertEmailSentTo('does_not_have_snippet@example.com')
+
+        self.request_fetcher.get('/admin/migrate_users')
+        self.assertTrue(cronshard.is_ready('ReminderPlan'))
+        plan = reminderplans.ReminderPlan.get_by_key_name(
+            'has_no_snippets@example.com')
+        self.assertEqual(reminderplans.hour_of_week(
+            datetime.datetime(2012, 2, 19, 23, 0)), plan.remind_hour)
+
+    def testPlanReminders(self):
+        def put_snippets(email, weeks, days_after_monday, hour):
+            db.put([snippets.Snippet(
+                email=email, week=week, text='s',
+                submitted=datetime.datetime.combine(
+                    week + datetime.timedelta(days_after_monday),
+                    datetime.time(hour)))
+                    for week in weeks])
+
+        weeks = [datetime.date(2012, 1, 2) + datetime.timedelta(7 * i)
+                 for i in xrange(7)]
+        # Usually writes at noon Saturday: 53 hours before the deadline.
+        db.put(snippets.User(email='early@example.com'))
+        put_snippets('early@example.com', weeks, 5, 12)
+        put_snippets('early@example.com', [datetime.date(2011, 12, 26)],
+                     7, 9)                                 # once, late
+        # Wrote every week until a few weeks ago.
+        db.put(snippets.User(email='away@example.com'))
+        put_snippets('away@example.com', weeks[:5], 7, 10)
+
+        # The cron job runs on Tuesday, after the 02-13-2012 deadline.
+        self.set_now(datetime.datetime(2012, 2, 21, 3, 0, 0))
+        self.run_cron('/admin/plan_reminders')
+
+        plan = reminderplans.ReminderPlan.get_by_key_name('early@example.com')
+        self.assertEqual((55, False), (plan.lead_hours, plan.on_leave))
+        plan = reminderplans.ReminderPlan.get_by_key_name('away@example.com')
+        self.assertTrue(plan.on_leave)
+        plan = reminderplans.ReminderPlan.get_by_key_name(
+            'has_no_snippets@example.com')
+        self.assertEqual((reminderplans.DEFAULT_LEAD_HOURS, False),
+                         (plan.lead_hours, plan.on_leave))
+
+    def testPlanFromSavedSnippets(self):
+        # Writes at 10am Saturday: 55 hours before the deadline.
+        self.login('has_no_snippets@example.com')
+        weeks = [datetime.date(2012, 1, 30), datetime.date(2012, 2, 6),
+                 datetime.date(2012, 2, 13)]
+        for week in weeks:
+            self.set_now(datetime.datetime.combine(
+                week + datetime.timedelta(5), datetime.time(10)))
+            self.request_fetcher.get('/update_snippet?week=%s&snippet=s'
+                                     % week.strftime('%m-%d-%Y'))
+
+        user_snippets = snippets.Snippet.all().filter(
+            'email =', 'has_no_snippets@example.com').fetch(10)
+        week_to_submitted = dict((s.week, s.submitted) for s in user_snippets)
+        self.assertEqual(datetime.datetime(2012, 2, 18, 10, 0, 0),
+                         week_to_submitted[datetime.date(2012, 2, 13)])
+        self.assertEqual((57, False),
+                         reminderplans.plan_for(weekcalendar.get_calendar(),
+                                                week_to_submitted,
+                                                datetime.date(2012, 2, 13)))
+
     def testSendViewEmail(self):
-        self.request_fetcher.get('/admin/send_view_email')
+        self.run_cron('/admin/send_view_email')
         self.assertEmailSentTo('has_snippet@example.com')
         self.assertEmailSentTo('does_not_have_snippet@example.com')
         self.assertEmailSentTo('has_many_snippets@example.com')
@@ -806,6 +2431,18 @@ class SendingEmailTestCase(UserTestBase):
         self.assertEmailContains('has_no_snippets@example.com',
                                  'not too late')
 
+    def testSendViewEmailIsGrouped(self):
+        # There's one email for those with snippets, and one for those
+        # without.
+        self.run_cron('/admin/send_view_email')
+        r = self.mail_stub.get_sent_messages()
+        self.assertEqual(2, len(r), r)
+        self.assertEqual([['does_not_have_snippet@example.com',
+                           'has_no_snippets@example.com'],
+                          ['has_many_snippets@example.com',
+                           'has_snippet@example.com']],
+                         sorted(sorted(_recipients(m)) for m in r))
+
     def testViewReminderMailsSettingAndSendReminderEmail(self):
         """Tests the user config-setting for getting emails."""
         self.login('does_not_have_snippet@example.com')
@@ -815,7 +2452,7 @@ class SendingEmailTestCase(UserTestBase):
         self.login('has_no_snippets@example.com')
         self.request_fetcher.get('/update_settings?reminder_email=yes')
 
-        self.request_fetcher.get('/admin/send_reminder_email')
+        self.run_cron('/admin/send_reminder_email')
         self.assertEmailNotSentTo('does_not_have_snippet@example.com')
         self.assertEmailSentTo('has_no_snippets@example.com')
 
@@ -825,46 +2462,207 @@ class SendingEmailTestCase(UserTestBase):
         self.login('has_no_snippets@example.com')
         self.request_fetcher.get('/update_settings?reminder_email=yes')
 
-        self.request_fetcher.get('/admin/send_view_email')
+        self.run_cron('/admin/send_view_email')
         self.assertEmailSentTo('has_snippet@example.com')
         self.assertEmailNotSentTo('does_not_have_snippet@example.com')
         self.assertEmailSentTo('has_many_snippets@example.com')
         self.assertEmailSentTo('has_no_snippets@example.com')
 
+    def testRerunDoesNotResendEmail(self):
+        self.run_cron('/admin/send_view_email')
+        self.run_cron('/admin/send_view_email')
+        # assertEmailSentTo checks the email was sent exactly once.
+        self.assertEmailSentTo('has_snippet@example.com')
+        self.assertEmailSentTo('does_not_have_snippet@example.com')
+        self.assertEmailSentTo('has_many_snippets@example.com')
+        self.assertEmailSentTo('has_no_snippets@example.com')
+
+    def testRerunResumesWhereItStopped(self):
+        # Pretend a previous run got as far as these two users.
+        snippets._cron_storage().record_sent(
+            'view_email',
+            {'has_snippet@example.com': datetime.date(2012, 2, 13),
+             'has_many_snippets@example.com': datetime.date(2012, 2, 13)})
+        self.run_cron('/admin/send_view_email')
+        self.assertEmailNotSentTo('has_snippet@example.com')
+        self.assertEmailNotSentTo('has_many_snippets@example.com')
+        self.assertEmailSentTo('does_not_have_snippet@example.com')
+        self.assertEmailSentTo('has_no_snippets@example.com')
+
+    def testSentEmailLedgerIsPerJobAndWeek(self):
+        self.run_cron('/admin/send_reminder_email')
+        self.run_cron('/admin/send_view_email')
+        r = _sent_messages_to(self.mail_stub, 'has_no_snippets@example.com')
+        self.assertEqual(2, len(r), r)
+
+        # The next week, everyone gets mail again.
+        self.set_now(datetime.datetime(2012, 2, 26, 23, 50, 0))
+        self.run_cron('/admin/send_view_email')
+        r = _sent_messages_to(self.mail_stub, 'has_no_snippets@example.com')
+        self.assertEqual(3, len(r), r)
+
+    def testOldSentEmailsAreForgotten(self):
+        # It's 02-23-2012, so we keep the weeks from 01-30 on.
+        old_week = datetime.date(2012, 1, 23)
+        recent_week = datetime.date(2012, 1, 30)
+        ledger = snippets._cron_storage()
+        ledger.record_sent('view_email', {'old@example.com': old_week,
+                                          'recent@example.com': recent_week})
+        self.request_fetcher.get('/admin/forget_sent_emails')
+        self.assertEqual({'old@example.com': old_week},
+                         ledger.get_unsent('view_email',
+                                           {'old@example.com': old_week}))
+        self.assertEqual({},
+                         ledger.get_unsent('view_email',
+                                           {'recent@example.com':
+                                                recent_week}))
+
     def testEmailQuotas(self):
-        """Test that we don't send more than 32 emails a minute."""
-        self.total_sleep_seconds = 0
-        self.sleep_seconds_this_minute = 0
-        self.calls_this_minute = 0
-        self.max_calls_per_minute = 0
-
-        def count_calls_per_minute(sleep_seconds):
-            self.calls_this_minute += 1
-            self.sleep_seconds_this_minute += sleep_seconds
-            self.total_sleep_seconds += sleep_seconds
-            # Update every time through so we count the last minute too.
-            self.max_calls_per_minute = max(self.max_calls_per_minute,
-                                            self.calls_this_minute)
-            if self.sleep_seconds_this_minute > 60:  # on to the next minute
-                self.calls_this_minute = 0
-                self.sleep_seconds_this_minute %= 60
-
-        time.sleep = lambda sec: count_calls_per_minute(sec)
+        """Test we send a few grouped emails, through a rate-limited queue.
 
+        Everyone gets one of the two view emails, bcc'ed to at most
+        _MAX_RECIPIENTS_PER_MAIL people at a time, and the 'mail'
+        queue keeps us under appengine's 32 emails a minute.
+        """
         # We'll do 500 users.  Rather than go through the request
         # API, we modify the db directly; it's much faster.
         users = [snippets.User(email='snippets%d@example.com' % i)
                  for i in xrange(500)]
         db.put(users)
 
+        # Run the shards, but not the mail tasks they queue.
         self.request_fetcher.get('/admin/send_view_email')
+        self.run_tasks(queue_names=('default',))
+        self.assertEqual(0, len(self.mail_stub.get_sent_messages()))
+        # Everyone gets one of two emails, so the shards queue just a
+        # few grouped ones.
+        self.assertTrue(len(self.taskqueue_stub.GetTasks('mail')) <
+                        len(users) / 10)
+        self.run_tasks()
+        self.assertEqual(len(users) + 4,
+                         sum(len(_recipients(m))
+                             for m in self.mail_stub.get_sent_messages()))
+        self.assertTrue(all(len(_recipients(m)) <=
+                            snippets._MAX_RECIPIENTS_PER_MAIL
+                            for m in self.mail_stub.get_sent_messages()))
+
+        # The mail queue is what keeps us under quota:
         # https://developers.google.com/appengine/docs/quotas#Mail
-        self.assertTrue(self.max_calls_per_minute <= 32,
-                        '%d <= %d' % (self.max_calls_per_minute, 32))
-        # Make sure we're not too slow either: say 1/2.5 seconds on average.
-        self.assertTrue(self.total_sleep_seconds <= len(users) * 2.5,
-                        '%d <= %d' % (self.total_sleep_seconds,
-                                      len(users) * 2.5))
+        from google.appengine.api import queueinfo
+        queue_yaml = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'queue.yaml')
+        mail_queue = [q for q in queueinfo.LoadSingleQueue(
+            open(queue_yaml)).queue if q.name == 'mail'][0]
+        self.assertEqual('30/m', mail_queue.rate)
+        self.assertEqual('1', str(mail_queue.max_concurrent_requests))
+
+
+class CronShardTestCase(UserTestBase):
+    """Test splitting cron jobs into shards, and the status page."""
+
+    def setUp(self):
+        super(CronShardTestCase, self).setUp()
+        self.testbed.init_mail_stub()
+        self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        self.users = [snippets.User(email='snippets%d@example.com' % i)
+                      for i in xrange(40)]
+        db.put(self.users)
+        cronshard.mark_ready('User')
+
+    def tearDown(self):
+        snippets._CRON_SHARD_BATCH_SIZE = 100
+        super(CronShardTestCase, self).tearDown()
+
+    def put_user_without_hash_bucket(self, email):
+        """Store a User the way we did before it had a hash_bucket."""
+        raw_entity = datastore.Entity('User')
+        raw_entity['email'] = email
+        return datastore.Put(raw_entity)
+
+    def testHashBucketIsStored(self):
+        raw_entity = datastore.Get(self.users[0].key())
+        self.assertEqual(cronshard.hash_bucket('snippets0@example.com'),
+                         raw_entity['hash_bucket'])
+
+    def testUnmigratedUsersGetMailUnsharded(self):
+        db.delete(cronshard._sharding_ready_key('User'))
+        self.put_user_without_hash_bucket('old@example.com')
+        self.request_fetcher.get('/admin/send_view_email')
+        self.assertEqual(1, len(self.taskqueue_stub.GetTasks('default')))
+        self.run_tasks()
+        for email in ['old@example.com'] + [u.email for u in self.users]:
+            r = _sent_messages_to(self.mail_stub, email)
+            self.assertEqual(1, len(r), email)
+
+    def testMigrateUsersLetsUsShard(self):
+        db.delete(cronshard._sharding_ready_key('User'))
+        key = self.put_user_without_hash_bucket('old@example.com')
+        self.request_fetcher.get('/admin/migrate_users')
+        self.run_tasks()
+        self.assertEqual(cronshard.hash_bucket('old@example.com'),
+                         datastore.Get(key)['hash_bucket'])
+        self.assertTrue(cronshard.is_ready('User'))
+
+        self.request_fetcher.get('/admin/send_view_email')
+        self.assertEqual(cronshard.NUM_SHARDS,
+                         len(self.taskqueue_stub.GetTasks('default')))
+        self.run_tasks()
+        self.assertEqual(1, len(_sent_messages_to(self.mail_stub,
+                                                  'old@example.com')))
+
+    def testShardsCoverEveryUserOnce(self):
+        self.request_fetcher.get('/admin/send_view_email')
+        self.assertEqual(cronshard.NUM_SHARDS,
+                         len(self.taskqueue_stub.GetTasks('default')))
+        self.run_tasks()
+        for user in self.users:
+            r = _sent_messages_to(self.mail_stub, user.email)
+            self.assertEqual(1, len(r), user.email)
+
+        shards = cronshard.CronShard.all().fetch(100)
+        self.assertEqual(cronshard.NUM_SHARDS, len(shards))
+        self.assertTrue(all(shard.done for shard in shards))
+        self.assertEqual(len(self.users),
+                         sum(shard.processed for shard in shards))
+        # The shards are actually spread out.
+        self.assertTrue(len([s for s in shards if s.processed]) > 1)
+
+    def testPlanRemindersIsSharded(self):
+        self.request_fetcher.get('/admin/plan_reminders')
+        self.assertEqual(cronshard.NUM_SHARDS,
+                         len(self.taskqueue_stub.GetTasks('default')))
+        self.run_tasks()
+        self.assertEqual(len(self.users),
+                         reminderplans.ReminderPlan.all().count())
+
+    def testShardsResumeFromCheckpoint(self):
+        snippets._CRON_SHARD_BATCH_SIZE = 2
+        self.request_fetcher.get('/admin/send_view_email')
+        # Run just one batch of each shard.
+        for task in self.taskqueue_stub.GetTasks('default'):
+            self.taskqueue_stub.DeleteTask('default', task['name'])
+            self.request_fetcher.post(task['url'],
+                                      base64.b64decode(task['body']))
+        shards = cronshard.CronShard.all().fetch(100)
+        self.assertTrue(all(shard.batches == 1 for shard in shards))
+        self.assertTrue(sum(shard.processed for shard in shards) <
+                        len(self.users))
+
+        self.run_tasks()
+        self.assertEqual(len(self.users),
+                         sum(len(_recipients(m))
+                             for m in self.mail_stub.get_sent_messages()))
+
+    def testStatusPage(self):
+        self.set_is_admin()
+        self.request_fetcher.get('/admin/send_view_email')
+        self.run_tasks()
+        response = self.request_fetcher.get('/admin/cron_status')
+        self.assertIn('view_email', response.body)
+        self.assertIn('%d of %d shards done' % (cronshard.NUM_SHARDS,
+                                                 cronshard.NUM_SHARDS),
+                      response.body)
+        self.assertIn('40 users processed', response.body)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,359 @@
+import datetime
+import sqlite3
+import threading
+
+import models
+import sealedweeks
+import storage
+import weeklystats
+
+"""A storage backend that keeps users and snippets in sqlite.
+
+This lets us run the snippet server outside of appengine, and is
+handy for benchmarking storage strategies locally.  See storage.py
+for the interface.
+
+We return the same models.User and models.Snippet objects as the
+datastore backend, so the handlers needn't care which backend they
+have.  Those are db.Models, so the appengine SDK must be importable
+(see standalone.py), but we only use them as values: nothing here
+calls the datastore, or any other appengine service.
+
+Every snippet save keeps the full text of the new version in
+snippet_revisions, for the history page; we don't bother with the
+diffs the datastore backend uses.  Participation stats are computed
+with an aggregate query when asked for, rather than kept up to date
+as we go.
+"""
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    email TEXT PRIMARY KEY,
+    category TEXT NOT NULL,
+    wants_email INTEGER NOT NULL,
+    wants_to_view TEXT NOT NULL,
+    timezone TEXT
+);
+
+CREATE TABLE IF NOT EXISTS snippets (
+    email TEXT NOT NULL,
+    week TEXT NOT NULL,             -- the monday, as YYYY-MM-DD
+    text TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    domain TEXT,                    -- models.email_domain(email)
+    private INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (email, week)       -- also serves a user's snippets, in order
+);
+
+-- For the weekly page.  Including the summary fields means the
+-- summary-only query never has to read the table itself.
+CREATE INDEX IF NOT EXISTS snippets_by_week
+    ON snippets (week, email, private, summary);
+
+-- For /category.
+CREATE INDEX IF NOT EXISTS users_by_category ON users (category, email);
+
+-- See sealedweeks.py.
+CREATE TABLE IF NOT EXISTS sealed_weeks (
+    week TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS snippet_revisions (
+    email TEXT NOT NULL,
+    week TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    private INTEGER NOT NULL,
+    saved TEXT NOT NULL,            -- YYYY-MM-DD HH:MM:SS, in UTC
+    text TEXT NOT NULL,
+    PRIMARY KEY (email, week, version)
+);
+
+-- The cron jobs' ledger of emails sent; see Storage.get_unsent().
+CREATE TABLE IF NOT EXISTS sent_emails (
+    job TEXT NOT NULL,
+    week TEXT NOT NULL,
+    email TEXT NOT NULL,
+    PRIMARY KEY (job, week, email)
+);
+"""
+
+_USER_COLUMNS = 'email, category, wants_email, wants_to_view, timezone'
+_SNIPPET_COLUMNS = 'email, week, text, summary, domain, private, version'
+
+_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# The most emails we put in one IN clause; sqlite allows 999 variables.
+_MAX_IN_VALUES = 500
+
+
+def _week_to_sql(week):
+    return week.strftime('%Y-%m-%d')
+
+
+def _week_from_sql(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _user_from_row(row):
+    (email, category, wants_email, wants_to_view, timezone) = row
+    return models.User(email=email, category=category,
+                       wants_email=bool(wants_email),
+                       wants_to_view=wants_to_view, timezone=timezone)
+
+
+def _snippet_from_row(row):
+    (email, week, text, summary, domain, private, version) = row
+    return models.Snippet(email=email, week=_week_from_sql(week), text=text,
+                          summary=summary, domain=domain,
+                          private=bool(private), version=version)
+
+
+class _Revision(object):
+    """One row of snippet_revisions, as get_snippet_history() returns it."""
+
+    def __init__(self, version, private, saved):
+        self.version = version
+        self.private = private
+        self.saved = saved
+
+
+class SQLiteStorage(storage.Storage):
+    """Keeps users and snippets in a sqlite database.
+
+    All access goes through one connection, so we serialize it with
+    a lock.  Writes use 'BEGIN IMMEDIATE' transactions, so they're
+    safe even if several processes share the database file.
+    """
+
+    def __init__(self, path=':memory:'):
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           isolation_level=None)
+        self._lock = threading.Lock()
+        self._connection.executescript(_SCHEMA)
+
+    def _query(self, sql, args=()):
+        self._lock.acquire()
+        try:
+            return self._connection.execute(sql, args).fetchall()
+        finally:
+            self._lock.release()
+
+    def _in_transaction(self, fn, *args):
+        """Call fn(cursor, *args) in a write transaction; return its value."""
+        self._lock.acquire()
+        try:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                retval = fn(cursor, *args)
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return retval
+        finally:
+            self._lock.release()
+
+    def get_user_async(self, email):
+        rows = self._query('SELECT %s FROM users WHERE email = ?'
+                           % _USER_COLUMNS, (email,))
+        user = rows and _user_from_row(rows[0]) or None
+        return lambda: user
+
+    def get_all_users_async(self):
+        users = [_user_from_row(row)
+                 for row in self._query('SELECT %s FROM users'
+                                        % _USER_COLUMNS)]
+        return lambda: users
+
+    def save_user(self, user, now):
+        def write(cursor):
+            cursor.execute('INSERT OR REPLACE INTO users (%s)'
+                           ' VALUES (?, ?, ?, ?, ?)' % _USER_COLUMNS,
+                           (user.email, user.category, int(user.wants_email),
+                            user.wants_to_view, user.timezone))
+        self._in_transaction(write)
+
+    def get_snippets_for_user_async(self, email):
+        snippets = [_snippet_from_row(row)
+                    for row in self._query('SELECT %s FROM snippets'
+                                           ' WHERE email = ? ORDER BY week'
+                                           % _SNIPPET_COLUMNS, (email,))]
+        return lambda: snippets
+
+    def get_snippets_for_week_async(self, week, summary_only=False):
+        if summary_only:
+            rows = self._query('SELECT email, private, summary FROM snippets'
+                               ' WHERE week = ?', (_week_to_sql(week),))
+            snippets = [models.Snippet(email=email, week=week,
+                                       private=bool(private), summary=summary)
+                        for (email, private, summary) in rows]
+        else:
+            snippets = [_snippet_from_row(row)
+                        for row in self._query('SELECT %s FROM snippets'
+                                               ' WHERE week = ?'
+                                               % _SNIPPET_COLUMNS,
+                                               (_week_to_sql(week),))]
+        return lambda: snippets
+
+    def get_snippets_for_category_async(self, category, first_week,
+                                        last_week, now):
+        # Unlike the datastore, we can join to find the authors'
+        # categories, so snippets needn't keep a copy.
+        rows = self._query('SELECT %s FROM snippets'
+                           ' WHERE week >= ? AND week <= ? AND email IN'
+                           ' (SELECT email FROM users WHERE category = ?)'
+                           ' ORDER BY week'
+                           % _SNIPPET_COLUMNS,
+                           (_week_to_sql(first_week), _week_to_sql(last_week),
+                            category))
+        snippets = [_snippet_from_row(row) for row in rows]
+        return lambda: snippets
+
+    def get_snippet(self, email, week):
+        rows = self._query('SELECT %s FROM snippets'
+                           ' WHERE email = ? AND week = ?' % _SNIPPET_COLUMNS,
+                           (email, _week_to_sql(week)))
+        return rows and _snippet_from_row(rows[0]) or None
+
+    def get_snippet_history(self, snippet):
+        rows = self._query('SELECT version, private, saved, text'
+                           ' FROM snippet_revisions'
+                           ' WHERE email = ? AND week = ? ORDER BY version',
+                           (snippet.email, _week_to_sql(snippet.week)))
+        return [(_Revision(version, bool(private),
+                           datetime.datetime.strptime(saved,
+                                                      _DATETIME_FORMAT)),
+                 text)
+                for (version, private, saved, text) in rows]
+
+    def _save_snippets(self, cursor, email, edits):
+        """The body of save_snippets(), run in a transaction."""
+        weeks = [_week_to_sql(edit[0]) for edit in edits]
+        cursor.execute('SELECT %s FROM snippets'
+                       ' WHERE email = ? AND week >= ? AND week <= ?'
+                       % _SNIPPET_COLUMNS, (email, min(weeks), max(weeks)))
+        week_to_snippet = dict((snippet.week, snippet)
+                               for snippet in map(_snippet_from_row,
+                                                  cursor.fetchall()))
+        now = datetime.datetime.utcnow().strftime(_DATETIME_FORMAT)
+
+        saved = []
+        stale = []
+        for (week, text, private, version) in edits:
+            snippet = week_to_snippet.get(week)
+            if snippet and snippet.text == text and snippet.private == private:
+                continue          # a no-op: don't bother writing anything
+            current_version = snippet and snippet.version or 0
+            if version is not None and version != current_version:
+                stale.append(snippet or models.Snippet(email=email, week=week))
+                continue
+            snippet = models.Snippet(email=email, week=week, text=text,
+                                     summary=models.summarize(text),
+                                     domain=models.email_domain(email),
+                                     private=private,
+                                     version=current_version + 1)
+            cursor.execute('INSERT OR REPLACE INTO snippets (%s)'
+                           ' VALUES (?, ?, ?, ?, ?, ?, ?)' % _SNIPPET_COLUMNS,
+                           (email, _week_to_sql(week), text, snippet.summary,
+                            snippet.domain, int(private), snippet.version))
+            cursor.execute('INSERT INTO snippet_revisions'
+                           ' (email, week, version, private, saved, text)'
+                           ' VALUES (?, ?, ?, ?, ?, ?)',
+                           (email, _week_to_sql(week), snippet.version,
+                            int(private), now, text))
+            cursor.execute('DELETE FROM sealed_weeks WHERE week = ?',
+                           (_week_to_sql(week),))
+            # In case the same week is edited twice in one batch.
+            week_to_snippet[week] = snippet
+            saved.append(snippet)
+        return (saved, stale)
+
+    def save_snippets(self, email, edits, now):
+        # We don't keep when snippets were submitted; only the
+        # datastore's reminder plans (reminderplans.py) use that.
+        return self._in_transaction(self._save_snippets, email, edits)
+
+    def get_sealed_week_async(self, week):
+        rows = self._query('SELECT data FROM sealed_weeks WHERE week = ?',
+                           (_week_to_sql(week),))
+        data = rows and str(rows[0][0]) or None
+        return lambda: data
+
+    def seal_week(self, week):
+        # Reading and sealing in one transaction means no edit can
+        # come in between.
+        def read_and_seal(cursor):
+            cursor.execute('SELECT %s FROM snippets WHERE week = ?'
+                           % _SNIPPET_COLUMNS, (_week_to_sql(week),))
+            snippets = map(_snippet_from_row, cursor.fetchall())
+            cursor.execute('SELECT %s FROM users' % _USER_COLUMNS)
+            users = map(_user_from_row, cursor.fetchall())
+            cursor.execute('INSERT OR REPLACE INTO sealed_weeks (week, data)'
+                           ' VALUES (?, ?)',
+                           (_week_to_sql(week),
+                            sqlite3.Binary(sealedweeks.pack(snippets,
+                                                            users))))
+            return (snippets, users)
+        return self._in_transaction(read_and_seal)
+
+    def get_stats_dashboard(self, last_week, num_weeks):
+        weeks = weeklystats.dashboard_weeks(last_week, num_weeks)
+        rows = self._query(
+            "SELECT s.week, COALESCE(u.category, '(unknown)'), COUNT(*),"
+            "       SUM(s.private), SUM(LENGTH(s.text))"
+            " FROM snippets s LEFT JOIN users u ON u.email = s.email"
+            " WHERE s.week >= ? AND s.week <= ?"
+            " GROUP BY 1, 2",
+            (_week_to_sql(weeks[0]), _week_to_sql(weeks[-1])))
+        week_and_category_to_totals = dict(
+            ((_week_from_sql(week), category), (submitted, private, length))
+            for (week, category, submitted, private, length) in rows)
+        category_to_num_users = dict(self._query(
+            'SELECT category, COUNT(*) FROM users GROUP BY category'))
+        return weeklystats.build_dashboard(weeks, week_and_category_to_totals,
+                                           category_to_num_users)
+
+    def get_oldest_week(self):
+        rows = self._query('SELECT MIN(week) FROM snippets')
+        return rows[0][0] and _week_from_sql(rows[0][0]) or None
+
+    def _emails_in(self, table, email_to_week, where='', args=()):
+        """Return the emails in email_to_week with a row for their week."""
+        retval = set()
+        for (week, emails) in storage.group_by_week(email_to_week,
+                                                    _MAX_IN_VALUES):
+            rows = self._query('SELECT email FROM %s'
+                               ' WHERE %s week = ? AND email IN (%s)'
+                               % (table, where, ', '.join('?' * len(emails))),
+                               args + (_week_to_sql(week),) + tuple(emails))
+            retval.update(email for (email,) in rows)
+        return retval
+
+    def get_emails_with_snippets(self, email_to_week):
+        return self._emails_in('snippets', email_to_week)
+
+    def get_unsent(self, job, email_to_week):
+        sent = self._emails_in('sent_emails', email_to_week, 'job = ? AND',
+                               (job,))
+        return dict((email, week) for (email, week)
+                    in email_to_week.iteritems() if email not in sent)
+
+    def record_sent(self, job, email_to_week):
+        def write(cursor):
+            cursor.executemany('INSERT OR REPLACE INTO sent_emails'
+                               ' (job, week, email) VALUES (?, ?, ?)',
+                               [(job, _week_to_sql(week), email)
+                                for (email, week)
+                                in email_to_week.iteritems()])
+        self._in_transaction(write)
+
+    def forget_sent(self, before):
+        def delete(cursor):
+            cursor.execute('DELETE FROM sent_emails WHERE week < ?',
+                           (_week_to_sql(before),))
+            return cursor.rowcount
+        return self._in_transaction(delete)
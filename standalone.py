@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""Serve the snippet server from an ordinary WSGI server.
+
+This runs the snippet pages without the appengine runtime: users and
+snippets live in a sqlite database (see sqlitestorage.py), and a
+login proxy in front of us says who's logged in (see auth.py).  The
+cron jobs and admin pages are appengine-only, and aren't served.
+
+This does not free us of the appengine SDK, only of its services.
+We still need the SDK's google_appengine directory on $PATH, just as
+for snippets_test.py, because:
+   - the pages are webapp request handlers, rendered with the SDK's
+     django templates;
+   - sqlitestorage.py hands out models.User and models.Snippet
+     objects, which are db.Models -- though it only uses them as
+     plain values, and never saves them to the datastore;
+   - snippets.py imports modules (entitycache.py, tenants.py,
+     cronshard.py and the like) that import memcache, the datastore
+     and namespace_manager.
+But nothing we serve calls those services: the datastore, memcache,
+the users service and the task queues are never used, and need no
+stubs or credentials.  StandaloneTestCase in snippets_test.py runs
+without any service stubs, so it would catch a page that called one.
+
+To load-test locally, run
+   ./standalone.py --port 8080 --db /tmp/snippets.db
+which serves requests on a thread each, and send requests with an
+X-Forwarded-Email header.  In production, use a real WSGI server with
+several processes, e.g.
+   SNIPPETS_DB=/var/lib/snippets.db gunicorn --workers 8 --threads 4 \\
+       'standalone:make_application()'
+All the processes can share the database file.
+
+The configuration comes from the environment:
+   SNIPPETS_DB: the sqlite database to use (default snippets.db).
+   SNIPPETS_AUTH_HEADER: the header with the logged-in user's email
+      (default X-Forwarded-Email).
+   SNIPPETS_ADMINS: a comma-separated list of admins' email addresses.
+   SNIPPETS_LOGIN_URL, SNIPPETS_LOGOUT_URL: the proxy's login and
+      logout urls.
+"""
+
+
+import optparse
+import os
+import SocketServer
+import sys
+from wsgiref import simple_server
+
+sys.path.extend(os.environ['PATH'].split(':'))
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.ext import webapp
+
+import auth
+import snippets
+import sqlitestorage
+
+
+def make_application(db_path=None):
+    """Return a WSGI application serving the snippet pages.
+
+    Arguments:
+      db_path: the sqlite database to use.  If None, we use
+        $SNIPPETS_DB, or snippets.db if that's not set.
+    """
+    if db_path is None:
+        db_path = os.environ.get('SNIPPETS_DB', 'snippets.db')
+    admins = [email.strip()
+              for email in os.environ.get('SNIPPETS_ADMINS', '').split(',')
+              if email.strip()]
+    auth_provider = auth.TrustedHeaderAuth(
+        header=os.environ.get('SNIPPETS_AUTH_HEADER', 'X-Forwarded-Email'),
+        admins=admins,
+        login_url=os.environ.get('SNIPPETS_LOGIN_URL', '/oauth2/sign_in'),
+        logout_url=os.environ.get('SNIPPETS_LOGOUT_URL', '/oauth2/sign_out'))
+    webapp_application = webapp.WSGIApplication(snippets.USER_ROUTES,
+                                                debug=False)
+
+    def application(environ, start_response):
+        # Unlike appengine, we can send the weekly page as it's rendered.
+        if environ.get('PATH_INFO') == '/weekly':
+            return snippets.stream_weekly_page(environ, start_response)
+        return webapp_application(environ, start_response)
+
+    return auth_provider.wsgi_middleware(snippets.with_backends(
+        application, sqlitestorage.SQLiteStorage(db_path), auth_provider))
+
+
+class _ThreadingWSGIServer(SocketServer.ThreadingMixIn,
+                           simple_server.WSGIServer):
+    """A wsgiref server that handles each request in its own thread."""
+    daemon_threads = True
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='localhost',
+                      help='The interface to listen on (default %default).')
+    parser.add_option('--port', type='int', default=8080,
+                      help='The port to listen on (default %default).')
+    parser.add_option('--db', default=None,
+                      help='The sqlite database (default $SNIPPETS_DB).')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Unexpected arguments: %s' % ' '.join(args))
+
+    server = simple_server.make_server(options.host, options.port,
+                                       make_application(options.db),
+                                       server_class=_ThreadingWSGIServer)
+    print 'Serving snippets on http://%s:%d/' % (options.host, options.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
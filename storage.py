@@ -0,0 +1,835 @@
+import datetime
+import logging
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext import db
+
+import cronshard
+import entitycache
+import models
+import reminderplans
+import revisions
+import sealedweeks
+import tenants
+import weeklystats
+
+"""Where we keep users and snippets.
+
+The request handlers in snippets.py don't talk to the datastore
+directly; they go through a Storage, which reads and writes User and
+Snippet objects (see models.py).  DatastoreStorage, here, keeps them
+in the appengine datastore.  sqlitestorage.SQLiteStorage keeps them
+in a sqlite database, so we can run the snippet server -- and compare
+storage strategies -- outside of appengine.
+
+The cron jobs are appengine-only: cronshard.py queries the datastore
+itself to split their work into shards.  But what they read and write
+beyond that -- which snippets exist, which emails they've sent --
+goes through a Storage, as do the admin migration and stats jobs.
+
+Reads come in two flavors: foo_async() starts the read and returns a
+'future', a function taking no arguments that waits for the read to
+finish and returns its result; foo() does both at once.  This lets
+handlers overlap independent reads.
+"""
+
+
+class Storage(object):
+    """The interface to a storage backend for users and snippets."""
+
+    def get_user_async(self, email):
+        """Start looking up the user with the given email; return a future.
+
+        The future returns the User, or None if not found.
+        """
+        raise NotImplementedError()
+
+    def get_user(self, email):
+        """Return the User with the given email, or None if not found."""
+        return self.get_user_async(email)()
+
+    def get_all_users_async(self):
+        """Start fetching every User; return a future for the list."""
+        raise NotImplementedError()
+
+    def get_all_users(self):
+        """Return a list of every User."""
+        return self.get_all_users_async()()
+
+    def save_user(self, user, now):
+        """Save a new or modified User.
+
+        now is the current time, as a naive datetime in
+        weekcalendar.DEFAULT_TIMEZONE (see weekcalendar.now()).
+        """
+        raise NotImplementedError()
+
+    def get_snippets_for_user_async(self, email):
+        """Start fetching all of a user's snippets; return a future.
+
+        The future returns a list of Snippets, oldest first, including
+        private ones.  Weeks without a snippet are not filled in.
+        """
+        raise NotImplementedError()
+
+    def get_snippets_for_user(self, email):
+        return self.get_snippets_for_user_async(email)()
+
+    def get_snippets_for_week_async(self, week, summary_only=False):
+        """Start fetching every snippet for a week; return a future.
+
+        Arguments:
+          week: the monday of the week, as a datetime.date.
+          summary_only: if True, the snippets the future returns need
+            only have their email, private and summary fields, which
+            the backend may be able to read more cheaply.
+        """
+        raise NotImplementedError()
+
+    def get_snippets_for_week(self, week, summary_only=False):
+        return self.get_snippets_for_week_async(week, summary_only)()
+
+    def get_snippets_for_category_async(self, category, first_week,
+                                        last_week, now):
+        """Start fetching a category's snippets over weeks; return a future.
+
+        Arguments:
+          category: the User.category of the snippets' authors.
+          first_week, last_week: the mondays of the first and last
+            weeks to fetch, as datetime.dates.
+          now: the current time, as a naive datetime in
+            weekcalendar.DEFAULT_TIMEZONE.  The backend may cache
+            weeks well before it for longer.
+
+        The future returns a list of Snippets, oldest week first,
+        including private ones.
+        """
+        raise NotImplementedError()
+
+    def get_snippets_for_category(self, category, first_week, last_week,
+                                  now):
+        return self.get_snippets_for_category_async(category, first_week,
+                                                    last_week, now)()
+
+    def get_snippet(self, email, week):
+        """Return the user's Snippet for week, or None if there isn't one."""
+        raise NotImplementedError()
+
+    def get_snippet_history(self, snippet):
+        """Return every saved version of snippet, oldest first.
+
+        Returns:
+          A list of (revision, text) pairs, where revision has
+          version, saved (a datetime) and private fields.  Versions
+          the backend didn't keep are omitted.
+        """
+        raise NotImplementedError()
+
+    def save_snippets(self, email, edits, now):
+        """Save a batch of snippet edits for a single user.
+
+        Edits that would not change anything are skipped entirely, and
+        edits based on an out-of-date version of their snippet are
+        rejected rather than clobbering somebody else's changes.
+
+        Arguments:
+          email: the email address of the user whose snippets these are.
+          edits: a list of (week, text, private, version) tuples, where
+            week is the monday of the snippet's week, as a
+            datetime.date, and version is the version of the snippet
+            the edit is based on (see Snippet.version), or None to
+            save unconditionally.
+          now: the current time, as a naive datetime in
+            weekcalendar.DEFAULT_TIMEZONE (see weekcalendar.now()).
+            New snippets record it as when they were submitted.
+
+        Returns:
+          A pair (saved_snippets, stale_snippets).  saved_snippets
+          holds the snippets we wrote, with their new versions.
+          stale_snippets holds the current value of each snippet
+          whose edit we rejected for being based on an old version.
+        """
+        raise NotImplementedError()
+
+    def get_sealed_week_async(self, week):
+        """Start reading a sealed week; return a future.
+
+        The future returns the sealedweeks.pack()ed data for the week
+        with this monday, or None if the week isn't sealed.  See
+        sealedweeks.py.
+        """
+        raise NotImplementedError()
+
+    def seal_week(self, week):
+        """Seal the week with this monday, and return what we sealed.
+
+        We read the week's snippets, and every user, afresh, and keep
+        them pack()ed.  We may not: if they're too big, or if a
+        snippet for the week is saved while we read it.  Either way,
+        we return (snippets, users) as we read them.
+
+        save_snippets() unseals the weeks of the snippets it saves.
+        """
+        raise NotImplementedError()
+
+    def get_stats_dashboard(self, last_week, num_weeks):
+        """Return participation stats; see weeklystats.get_dashboard()."""
+        raise NotImplementedError()
+
+    def get_oldest_week(self):
+        """Return the monday of the oldest week with a snippet, or None."""
+        raise NotImplementedError()
+
+    def get_emails_with_snippets(self, email_to_week):
+        """Return the set of emails that have a snippet for their week.
+
+        email_to_week maps each email we care about to a monday.
+        """
+        raise NotImplementedError()
+
+    def get_unsent(self, job, email_to_week):
+        """Return email_to_week, less the emails job has already sent.
+
+        The cron jobs check this before sending a week's email to
+        someone, and call record_sent() after, so if a job is rerun --
+        or a shard task is retried -- nobody gets the same email twice.
+        """
+        raise NotImplementedError()
+
+    def record_sent(self, job, email_to_week):
+        """Record that job sent each email its email for the week."""
+        raise NotImplementedError()
+
+    def forget_sent(self, before):
+        """Forget the emails record_sent() recorded for weeks before this.
+
+        before is a monday.  Returns how many records we forgot.
+        """
+        raise NotImplementedError()
+
+    def migrate_snippets(self, cursor, batch_size):
+        """Rewrite a batch of snippets in the current storage format.
+
+        cursor says where the previous batch stopped, or is None to
+        start at the beginning.  Returns a pair: how many snippets we
+        rewrote, and the cursor for the next batch, or None if that
+        was the last.  Backends whose snippets are always in the
+        current format have nothing to do.
+        """
+        return (0, None)
+
+    def migrate_users(self, cursor, batch_size, now):
+        """Rewrite a batch of users in the current storage format.
+
+        Like migrate_snippets().  now is the current time, as for
+        save_user().
+        """
+        return (0, None)
+
+    def migrate_to_tenants(self, cursor, batch_size):
+        """Copy a batch of users from before multi-tenant mode to tenants.
+
+        Each user is copied, with their snippets and snippet history,
+        into their tenant (see tenants.py), unless they've already
+        started afresh there.  Like migrate_snippets(), but batch_size
+        counts users.  Backends without tenants have nothing to do.
+        """
+        return (0, None)
+
+
+# The most entity groups appengine lets us touch in one transaction.
+MAX_SNIPPETS_PER_TRANSACTION = 25
+
+# The most values the datastore allows in an IN filter.
+_MAX_IN_FILTER_VALUES = 30
+
+# The most entities the datastore deletes in one call.
+_MAX_DELETES_PER_CALL = 500
+
+
+def group_by_week(email_to_week, max_emails):
+    """Yield (week, emails) pairs covering every email in email_to_week.
+
+    Users usually share a week, so this lets backends look them up a
+    week -- and at most max_emails of them -- at a time.
+    """
+    week_to_emails = {}
+    for (email, week) in email_to_week.iteritems():
+        week_to_emails.setdefault(week, []).append(email)
+    for (week, emails) in week_to_emails.iteritems():
+        for i in xrange(0, len(emails), max_emails):
+            yield (week, emails[i:i + max_emails])
+
+
+def _start_query(q, limit):
+    """Start running q, and return a function that waits for its results.
+
+    Query.run() sends the query off and returns at once, so we can do
+    other work -- such as starting other queries -- while it runs.
+    """
+    results = q.run(limit=limit, batch_size=limit)
+    return lambda: list(results)
+
+
+# Snippets for weeks at least this old are 'finished': people have
+# long since stopped writing them, so we cache them in memcache for as
+# long as it will keep them.  The rare edit to one invalidates them.
+_FINISHED_WEEK_AGE = datetime.timedelta(days=14)
+
+
+def _last_finished_week(now):
+    """Return the monday of the newest week whose snippets are finished.
+
+    now is the current time, in weekcalendar.DEFAULT_TIMEZONE.
+    """
+    cutoff = now.date() - _FINISHED_WEEK_AGE
+    return cutoff - datetime.timedelta(cutoff.weekday())
+
+
+def _category_query(category, first_week, last_week):
+    q = models.Snippet.all()
+    q.filter('category = ', category)
+    q.filter('week >= ', first_week)
+    q.filter('week <= ', last_week)
+    q.order('week')
+    return q
+
+
+def _snippet_key_name(email, week):
+    """The key-name we give new snippets, so creating one is idempotent."""
+    return '%s/%s' % (email, week.strftime('%Y-%m-%d'))
+
+
+def _put_snippets_if_current(changes, category, now):
+    """Transactionally save snippet changes whose base version is current.
+
+    This is the 'conditional write' half of our optimistic concurrency
+    scheme: an edit that says it was based on version N of a snippet
+    is only saved if the snippet in the db is still at version N.
+
+    Arguments:
+      changes: a list of (key, email, week, text, private, version)
+        tuples.  key is the key of the snippet to update (which may
+        not exist yet), and version is the snippet version the edit
+        was based on, or None to save unconditionally.
+      category: the category of the snippets' author.
+      now: the current time; new snippets record it as submitted.
+
+    Returns:
+      A triple (saved_snippets, stale_snippets, stats_changes).
+      stale_snippets are the current db values of the snippets whose
+      edits we rejected.  stats_changes describes the saves for
+      weeklystats.record_snippet_changes().
+    """
+    saved = []
+    stale = []
+    old_texts = []
+    stats_changes = []
+    current_snippets = db.get([change[0] for change in changes])
+    for (change, snippet) in zip(changes, current_snippets):
+        (key, email, week, text, private, version) = change
+        current_version = snippet and snippet.version or 0
+        if version is not None and version != current_version:
+            stale.append(snippet or models.Snippet(email=email, week=week))
+            continue
+        if snippet:
+            old_texts.append(snippet.text)
+            stats_changes.append((week, (len(snippet.text), snippet.private),
+                                  (len(text), private)))
+            snippet.text = text   # just update the snippet text
+            snippet.private = private
+        else:
+            # add the snippet to the db
+            old_texts.append('')
+            stats_changes.append((week, None, (len(text), private)))
+            snippet = models.Snippet(key_name=key.name(), email=email,
+                                     week=week, text=text, private=private,
+                                     submitted=now)
+        snippet.summary = models.summarize(text)
+        snippet.domain = models.email_domain(email)
+        snippet.category = category
+        snippet.version = current_version + 1
+        saved.append(snippet)
+
+    # Record a revision for each save, usually as a diff against the
+    # previous revision (which is in the same entity group).
+    previous_revisions = db.get([
+        revisions.revision_key(snippet.key(), snippet.version - 1)
+        for snippet in saved])
+    new_revisions = [
+        revisions.new_revision(snippet.key(), snippet.version,
+                               old_text, snippet.text, snippet.private,
+                               previous_revision)
+        for (snippet, old_text, previous_revision)
+        in zip(saved, old_texts, previous_revisions)]
+
+    db.put(saved + new_revisions)
+    return (saved, stale, stats_changes)
+
+
+def _set_snippets_category(keys, category):
+    """Move the snippets with the given keys to category.
+
+    This is run in a transaction, and re-reads the snippets, so we
+    can't clobber a concurrent edit.  Returns the snippets we changed.
+    """
+    snippets = [snippet for snippet in db.get(keys)
+                if snippet is not None and snippet.category != category]
+    for snippet in snippets:
+        snippet.category = category
+    db.put(snippets)
+    return snippets
+
+
+def _migrate_snippets(keys, email_to_category):
+    """Rewrite the snippets with the given keys in the current format.
+
+    email_to_category maps each user's email to their User.category.
+    This is run in a transaction, so we can't clobber a concurrent edit.
+    """
+    snippets = [snippet for snippet in db.get(keys) if snippet is not None]
+    for snippet in snippets:
+        snippet.summary = models.summarize(snippet.text)
+        snippet.domain = models.email_domain(snippet.email)
+        snippet.category = email_to_category.get(
+            snippet.email, models.User.category.default)
+    # Putting the snippet compresses its text, if it's long enough.
+    db.put(snippets)
+
+
+def _migrate_users(keys):
+    """Rewrite the users with the given keys, so they have a hash_bucket.
+
+    This is run in a transaction, so we can't clobber a concurrent
+    settings change.
+    """
+    users = [user for user in db.get(keys) if user is not None]
+    # Putting the user stores its hash_bucket.
+    db.put(users)
+
+
+def _sent_email_key_name(job, week, email):
+    return '%s:%s:%s' % (job, week.isoformat(), email)
+
+
+def _in_namespace(key, namespace):
+    """Return the key with the same path as key, but in namespace."""
+    return db.Key.from_path(*key.to_path(), namespace=namespace)
+
+
+def _copy_entity_group(root_key, namespace):
+    """Copy the entity group whose root has root_key into namespace.
+
+    Run in a cross-group transaction.  If the copy of the root exists
+    already -- from an earlier run -- we leave it be.  Returns whether
+    we copied anything.
+    """
+    if db.get(_in_namespace(root_key, namespace)) is not None:
+        return False
+    copies = []
+    for entity in db.Query().ancestor(root_key).run(batch_size=1000):
+        # Setting the properties, rather than copying what's in the
+        # datastore, lets computed ones (like User.hash_bucket) work.
+        properties = dict((name, getattr(entity, name))
+                          for name in entity.properties())
+        copies.append(type(entity)(
+            key=_in_namespace(entity.key(), namespace), **properties))
+    db.put(copies)
+    return True
+
+
+def _start_sealing(key):
+    """Return the generation of the SealedWeek with this key.
+
+    Run in a transaction.  If the SealedWeek doesn't exist, we create
+    it (unsealed), so that from now on edits to the week will know to
+    unseal it; see _unseal().
+    """
+    sealed_week = db.get(key)
+    if sealed_week is None:
+        sealed_week = sealedweeks.SealedWeek(key=key)
+        sealed_week.put()
+    return sealed_week.generation
+
+
+def _finish_sealing(key, generation, data):
+    """Seal the week with data, if it hasn't been unsealed since generation.
+
+    Run in a transaction.
+    """
+    sealed_week = db.get(key)
+    if (sealed_week is not None and sealed_week.generation == generation
+            and sealed_week.data is None):
+        sealed_week.data = data
+        sealed_week.put()
+
+
+def _unseal(key):
+    """Unseal the SealedWeek with this key.  Run in a transaction."""
+    sealed_week = db.get(key)
+    if sealed_week is not None:
+        sealed_week.data = None
+        sealed_week.generation += 1
+        sealed_week.put()
+
+
+class DatastoreStorage(Storage):
+    """Keeps users and snippets in the appengine datastore.
+
+    Hot reads go through entitycache, and writes keep revision
+    history (revisions.py) and participation stats (weeklystats.py)
+    up to date.
+    """
+
+    def get_user_async(self, email):
+        def start_read_user():
+            q = models.User.all()
+            q.filter('email = ', email)
+            finish_query = _start_query(q, 1)
+            return lambda: (finish_query() or [None])[0]
+        return entitycache.get_async('User', 'email:%s' % email,
+                                     start_read_user)
+
+    def get_all_users_async(self):
+        return entitycache.get_async(
+            'User', 'all', lambda: _start_query(models.User.all(), 1000))
+
+    def save_user(self, user, now):
+        if user.is_saved():
+            old_user = db.get(user.key())
+        else:
+            old_user = None
+        db.put(user)
+        db.get(user.key())    # ensure db consistency for HRD
+        entitycache.invalidate('User')
+
+        # The reminder job finds users by when their plan says to
+        # remind them, so new users need a plan, and one in the right
+        # timezone.
+        if old_user is None or user.timezone != old_user.timezone:
+            reminderplans.set_remind_hours([user], now)
+
+        if old_user is None:
+            weeklystats.record_new_user(user.category)
+        elif user.category != old_user.category:
+            # The user's old snippets move to the new category too.
+            snippets_q = models.Snippet.all(keys_only=True)
+            snippets_q.filter('email = ', user.email)
+            keys = list(snippets_q.run(batch_size=1000))
+            moved_snippets = []
+            xg_options = db.create_transaction_options(xg=True)
+            for i in xrange(0, len(keys), MAX_SNIPPETS_PER_TRANSACTION):
+                moved_snippets.extend(db.run_in_transaction_options(
+                    xg_options, _set_snippets_category,
+                    keys[i:i + MAX_SNIPPETS_PER_TRANSACTION], user.category))
+            entitycache.invalidate('Snippet')
+            entitycache.invalidate('FinishedSnippet')
+            weeklystats.record_category_change(old_user.category,
+                                               user.category,
+                                               moved_snippets)
+
+    def get_snippets_for_user_async(self, email):
+        snippets_q = models.Snippet.all()
+        snippets_q.filter('email = ', email)
+        snippets_q.order('week')            # this puts oldest snippet first
+        return entitycache.get_async(
+            'Snippet', 'email:%s' % email,
+            lambda: _start_query(snippets_q, 1000))   # good for many years...
+
+    def get_snippets_for_week_async(self, week, summary_only=False):
+        if summary_only:
+            migrated_future = models.is_migrated_async(
+                models.SNIPPETS_MIGRATION)
+
+            def future():
+                # A projection query reads just these fields from the
+                # index.  But it skips snippets without a summary, so
+                # until they've all been migrated to have one, we read
+                # the whole snippets.
+                if migrated_future():
+                    snippets_q = db.Query(
+                        models.Snippet,
+                        projection=('email', 'private', 'summary'))
+                    snippets_q.filter('week = ', week)
+                    return _start_query(snippets_q, 1000)()
+                return self.get_snippets_for_week_async(week)()
+            return future
+        snippets_q = models.Snippet.all()
+        snippets_q.filter('week = ', week)
+        return entitycache.get_async('Snippet', 'week:%s' % week.isoformat(),
+                                     lambda: _start_query(snippets_q, 1000))
+
+    def get_snippets_for_category_async(self, category, first_week,
+                                        last_week, now):
+        # We read the finished weeks and the recent ones separately, so
+        # the finished ones can stay cached while the recent ones change.
+        last_finished_week = _last_finished_week(now)
+        futures = []
+        if first_week <= last_finished_week:
+            last_old_week = min(last_week, last_finished_week)
+            finished_q = _category_query(category, first_week, last_old_week)
+            futures.append(entitycache.get_async(
+                'FinishedSnippet',
+                'category:%s:%s:%s' % (category, first_week.isoformat(),
+                                       last_old_week.isoformat()),
+                lambda: _start_query(finished_q, 1000),
+                memcache_ttl_seconds=0))
+        if last_week > last_finished_week:
+            first_recent_week = max(first_week, last_finished_week +
+                                    datetime.timedelta(7))
+            recent_q = _category_query(category, first_recent_week,
+                                       last_week)
+            futures.append(entitycache.get_async(
+                'Snippet',
+                'category:%s:%s:%s' % (category,
+                                       first_recent_week.isoformat(),
+                                       last_week.isoformat()),
+                lambda: _start_query(recent_q, 1000)))
+        return lambda: sum((future() for future in futures), [])
+
+    def get_snippet(self, email, week):
+        q = models.Snippet.all()
+        q.filter('email = ', email)
+        q.filter('week = ', week)
+        return q.get()
+
+    def get_snippet_history(self, snippet):
+        return revisions.get_history(snippet.key(), snippet.version)
+
+    def save_snippets(self, email, edits, now):
+        weeks = [edit[0] for edit in edits]
+
+        # One query gets every existing snippet we might be updating.
+        q = models.Snippet.all()
+        q.filter('email = ', email)
+        q.filter('week >= ', min(weeks))
+        q.filter('week <= ', max(weeks))
+        week_to_snippet = dict((snippet.week, snippet) for snippet in q)
+
+        week_to_change = {}
+        for (week, text, private, version) in edits:
+            snippet = week_to_snippet.get(week)
+            if snippet and snippet.text == text and snippet.private == private:
+                week_to_change.pop(week, None)
+                continue          # a no-op: don't bother writing anything
+            if snippet:
+                key = snippet.key()
+            else:
+                key = db.Key.from_path('Snippet',
+                                       _snippet_key_name(email, week))
+            week_to_change[week] = (key, email, week, text, private, version)
+
+        changes = week_to_change.values()
+        if not changes:
+            return ([], [])
+
+        user = self.get_user(email)
+        category = user and user.category or models.User.category.default
+
+        saved = []
+        stale = []
+        stats_changes = []
+        xg_options = db.create_transaction_options(xg=True)
+        for i in xrange(0, len(changes), MAX_SNIPPETS_PER_TRANSACTION):
+            (chunk_saved, chunk_stale, chunk_stats_changes) = (
+                db.run_in_transaction_options(
+                    xg_options, _put_snippets_if_current,
+                    changes[i:i + MAX_SNIPPETS_PER_TRANSACTION], category,
+                    now))
+            saved.extend(chunk_saved)
+            stale.extend(chunk_stale)
+            stats_changes.extend(chunk_stats_changes)
+
+        if saved:
+            db.get([snippet.key() for snippet in saved])  # for HRD
+            # Only weeks that someone has started to seal have a
+            # SealedWeek; for the rest -- nearly every save -- this is
+            # just a get.  We unseal after the get above, so that
+            # anyone who starts sealing after us sees our save.
+            sealed_week_keys = set(sealedweeks.sealed_week_key(snippet.week)
+                                   for snippet in saved)
+            for sealed_week in db.get(list(sealed_week_keys)):
+                if sealed_week is not None:
+                    db.run_in_transaction(_unseal, sealed_week.key())
+            entitycache.invalidate('Snippet')
+            last_finished_week = _last_finished_week(now)
+            if any(snippet.week <= last_finished_week for snippet in saved):
+                entitycache.invalidate('FinishedSnippet')
+            weeklystats.record_snippet_changes(category, stats_changes)
+
+        return (saved, stale)
+
+    def get_sealed_week_async(self, week):
+        rpc = db.get_async(sealedweeks.sealed_week_key(week))
+
+        def future():
+            sealed_week = rpc.get_result()
+            return sealed_week and sealed_week.data or None
+        return future
+
+    def seal_week(self, week):
+        key = sealedweeks.sealed_week_key(week)
+        generation = db.run_in_transaction(_start_sealing, key)
+        # We read from the datastore itself: the entitycache's copies
+        # could predate an edit that unsealed the week.
+        snippets_q = models.Snippet.all().filter('week = ', week)
+        snippets = list(snippets_q.run(batch_size=1000))
+        users = list(models.User.all().run(batch_size=1000))
+
+        data = sealedweeks.pack(snippets, users)
+        if len(data) > sealedweeks.MAX_PACKED_SIZE:
+            logging.warning('Not sealing %s: %d bytes is too big'
+                            % (week, len(data)))
+            return (snippets, users)
+        try:
+            db.run_in_transaction(_finish_sealing, key, generation, data)
+        except db.Error:
+            # We'll try again on the next view.
+            logging.exception('Unable to seal %s' % week)
+        return (snippets, users)
+
+    def get_stats_dashboard(self, last_week, num_weeks):
+        return weeklystats.get_dashboard(last_week, num_weeks)
+
+    def get_oldest_week(self):
+        oldest_snippet = models.Snippet.all().order('week').get()
+        return oldest_snippet and oldest_snippet.week or None
+
+    def get_emails_with_snippets(self, email_to_week):
+        retval = set()
+        for (week, emails) in group_by_week(email_to_week,
+                                            _MAX_IN_FILTER_VALUES):
+            snippets_q = models.Snippet.all()
+            snippets_q.filter('week = ', week)
+            snippets_q.filter('email IN', emails)
+            retval.update(snippet.email
+                          for snippet in snippets_q.fetch(len(emails)))
+        return retval
+
+    def get_unsent(self, job, email_to_week):
+        # One batch get reads the whole ledger.
+        emails = email_to_week.keys()
+        keys = [db.Key.from_path(
+                    'SentEmail',
+                    _sent_email_key_name(job, email_to_week[email], email))
+                for email in emails]
+        return dict((email, email_to_week[email])
+                    for (email, sent_email) in zip(emails, db.get(keys))
+                    if sent_email is None)
+
+    def record_sent(self, job, email_to_week):
+        db.put([models.SentEmail(
+                    key_name=_sent_email_key_name(job, week, email),
+                    week=week)
+                for (email, week) in email_to_week.iteritems()])
+
+    def forget_sent(self, before):
+        num_forgotten = 0
+        while True:
+            q = models.SentEmail.all(keys_only=True)
+            q.filter('week < ', before)
+            keys = q.fetch(_MAX_DELETES_PER_CALL)
+            db.delete(keys)
+            num_forgotten += len(keys)
+            if len(keys) < _MAX_DELETES_PER_CALL:
+                return num_forgotten
+
+    def _migrate(self, kind, cursor, batch_size, migrate_batch, *args):
+        """Run migrate_batch(keys, *args) on a batch of entities of kind.
+
+        Returns what migrate_snippets() does, and the keys we visited.
+        """
+        q = db.Query(kind, keys_only=True)
+        if cursor:
+            q.with_cursor(cursor)
+        keys = q.fetch(batch_size)
+        xg_options = db.create_transaction_options(xg=True)
+        for i in xrange(0, len(keys), MAX_SNIPPETS_PER_TRANSACTION):
+            db.run_in_transaction_options(
+                xg_options, migrate_batch,
+                keys[i:i + MAX_SNIPPETS_PER_TRANSACTION], *args)
+        if len(keys) == batch_size:    # there may be more
+            return (len(keys), q.cursor(), keys)
+        return (len(keys), None, keys)
+
+    def migrate_snippets(self, cursor, batch_size):
+        email_to_category = dict((user.email, user.category)
+                                 for user in self.get_all_users())
+        (num_migrated, next_cursor, _) = self._migrate(
+            models.Snippet, cursor, batch_size, _migrate_snippets,
+            email_to_category)
+        entitycache.invalidate('Snippet')
+        entitycache.invalidate('FinishedSnippet')
+        if next_cursor is None:
+            models.mark_migrated(models.SNIPPETS_MIGRATION)
+        return (num_migrated, next_cursor)
+
+    def migrate_users(self, cursor, batch_size, now):
+        (num_migrated, next_cursor, keys) = self._migrate(
+            models.User, cursor, batch_size, _migrate_users)
+        entitycache.invalidate('User')
+        # Plans are in their own entity groups, so we can't update
+        # them in the transactions; but this is safe to redo.
+        reminderplans.set_remind_hours(
+            [user for user in db.get(keys) if user is not None], now)
+        if next_cursor is None:
+            # The cron jobs can shard users, and find them by their
+            # plans, from now on.
+            cronshard.mark_ready('User')
+            cronshard.mark_ready('ReminderPlan')
+        return (num_migrated, next_cursor)
+
+    def migrate_to_tenants(self, cursor, batch_size):
+        # Data from before multi-tenant mode is in the default
+        # namespace, whatever namespace this request is in.
+        q = db.Query(models.User, namespace='')
+        if cursor:
+            q.with_cursor(cursor)
+        users = q.fetch(batch_size)
+        xg_options = db.create_transaction_options(xg=True)
+        tenant_to_weeks = {}
+        for user in users:
+            tenant = tenants.tenant_for_email(user.email)
+            if tenant is None:
+                logging.warning('%s cannot be a tenant; leaving them in'
+                                ' the default namespace' % user.email)
+                continue
+            # A user with a different key is one who has started
+            # afresh in the tenant; copying would give them two of
+            # everything.
+            tenant_user_q = db.Query(models.User, namespace=tenant)
+            tenant_user = tenant_user_q.filter('email = ', user.email).get()
+            if (tenant_user is not None and
+                    tenant_user.key() != _in_namespace(user.key(), tenant)):
+                logging.warning('%s already has data in %s; not copying'
+                                % (user.email, tenant))
+                continue
+            weeks = tenant_to_weeks.setdefault(tenant, set())
+            db.run_in_transaction_options(xg_options, _copy_entity_group,
+                                          user.key(), tenant)
+            snippets_q = db.Query(models.Snippet, namespace='')
+            snippets_q.filter('email = ', user.email)
+            for snippet in snippets_q.run(batch_size=1000):
+                if db.run_in_transaction_options(xg_options,
+                                                 _copy_entity_group,
+                                                 snippet.key(), tenant):
+                    weeks.add(snippet.week)
+
+        # The weeks we copied snippets into may have been sealed, and
+        # users and snippets cached, without them.
+        original_namespace = namespace_manager.get_namespace()
+        try:
+            for (tenant, weeks) in tenant_to_weeks.iteritems():
+                namespace_manager.set_namespace(tenant)
+                for week in weeks:
+                    db.run_in_transaction(_unseal,
+                                          sealedweeks.sealed_week_key(week))
+                entitycache.invalidate('User')
+                entitycache.invalidate('Snippet')
+                entitycache.invalidate('FinishedSnippet')
+        finally:
+            namespace_manager.set_namespace(original_namespace)
+
+        if len(users) == batch_size:    # there may be more
+            return (len(users), q.cursor())
+        return (len(users), None)
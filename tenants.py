@@ -0,0 +1,106 @@
+import cgi
+import logging
+import re
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext.db import metadata
+
+import models
+
+"""Multi-tenant mode: a separate snippet server for each email domain.
+
+When this is turned on (see appconfig.py), every email domain is a
+'tenant', with its own appengine namespace named after the domain.
+Users, snippets, stats, cron-job bookkeeping and cached values all
+live in their tenant's namespace, so a tenant's weekly page only
+reads its own users and snippets, and one big tenant doesn't slow
+down the others' queries.  People only ever see their own tenant.
+
+wsgi_middleware() sets the namespace for each request: from the task
+that queued it, if any; else the tenant an admin asked for with a
+'tenant' url parameter; else the logged-in user's domain.  Requests
+from cron run in the default namespace, and call for_each_tenant() to
+do their work in every tenant.
+
+Data written before multi-tenant mode was turned on stays in the
+default namespace, where nobody will see it, until an admin visits
+/admin/migrate_to_tenants to copy it into the tenants.
+"""
+
+
+# The WSGI environ name of the header saying which namespace a task
+# was queued in.  Appengine strips X-AppEngine headers from requests
+# that come from outside, so we can trust it.
+_TASK_NAMESPACE_ENVIRON_KEY = 'HTTP_X_APPENGINE_CURRENT_NAMESPACE'
+
+# What appengine allows in a namespace name.
+_NAMESPACE_RE = re.compile(r'^[0-9A-Za-z._-]{1,100}$')
+
+
+def tenant_for_email(email):
+    """Return the tenant the user with this email belongs to, or None.
+
+    None means the email's domain can't be a tenant.
+    """
+    domain = models.email_domain(email)
+    if domain is None or not _NAMESPACE_RE.match(domain):
+        return None
+    return domain
+
+
+def all_tenants():
+    """Return every tenant that has any data, in alphabetical order."""
+    return [namespace for namespace in metadata.get_namespaces()
+            if namespace]     # the default namespace isn't a tenant
+
+
+def for_each_tenant(fn):
+    """Call fn(tenant) in each tenant's namespace."""
+    original_namespace = namespace_manager.get_namespace()
+    try:
+        for tenant in all_tenants():
+            namespace_manager.set_namespace(tenant)
+            fn(tenant)
+    finally:
+        namespace_manager.set_namespace(original_namespace)
+
+
+def _tenant_for_request(environ, auth_provider):
+    """Return the namespace to handle the request with environ in."""
+    if environ.get(_TASK_NAMESPACE_ENVIRON_KEY):
+        return environ[_TASK_NAMESPACE_ENVIRON_KEY]
+    if auth_provider.is_current_user_admin():
+        params = cgi.parse_qs(environ.get('QUERY_STRING', ''))
+        tenant = params.get('tenant', [''])[0].lower()
+        if _NAMESPACE_RE.match(tenant):
+            return tenant
+    email = auth_provider.get_current_user_email()
+    if email:
+        tenant = tenant_for_email(email)
+        if tenant is None:
+            logging.warning('%s cannot be a tenant; using the default'
+                            ' namespace' % email)
+        return tenant or ''
+    return ''     # not logged in: they can't see any data anyway
+
+
+def wsgi_middleware(application, auth_provider, is_multitenant):
+    """Return a WSGI application that serves application in tenants.
+
+    Arguments:
+      application: the WSGI application to wrap.
+      auth_provider: the auth.AuthProvider that says who's logged in.
+      is_multitenant: a function taking the WSGI environ and returning
+        whether to partition that request by tenant.
+    """
+    def wrapped_application(environ, start_response):
+        if not is_multitenant(environ):
+            return application(environ, start_response)
+        original_namespace = namespace_manager.get_namespace()
+        namespace_manager.set_namespace(
+            _tenant_for_request(environ, auth_provider))
+        try:
+            return application(environ, start_response)
+        finally:
+            namespace_manager.set_namespace(original_namespace)
+    return wrapped_application
@@ -0,0 +1,216 @@
+import datetime
+import logging
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+"""Figuring out which week a snippet is for, in a given timezone.
+
+Snippets are due Monday, for the week before.  The rules are:
+   1) When writing snippets, up through wednesday you are writing for
+      the previous week.  Starting on thursday, you write for this week.
+   2) When viewing snippets, we show the previous week's.  For this
+      purpose a week starts on Sunday at 11pm rather than Monday,
+      since that's when we send the reminder email.
+These rules are evaluated in each user's own timezone.
+
+The snippet server's clock (snippets._now()) runs in
+DEFAULT_TIMEZONE, the timezone cron.yaml uses, and all times passed
+in to this module are naive datetimes in that timezone.  A WeekCalendar
+converts them to its own timezone before applying the rules.
+
+pytz is in app.yaml's libraries, so appengine always has it.  If it
+isn't available -- say, in a standalone server without it installed
+-- every calendar uses DEFAULT_TIMEZONE, and we take the machine's
+local time to be in DEFAULT_TIMEZONE, which had better be right.
+"""
+
+
+# The timezone of the server clock, and of users who haven't set one.
+DEFAULT_TIMEZONE = 'US/Pacific'
+
+if pytz is None:
+    logging.warning('pytz is not installed: ignoring users\' timezones,'
+                    ' and assuming the local clock is %s' % DEFAULT_TIMEZONE)
+
+# Snippets for a week are due at this hour of this day, local time,
+# the week after.
+DEADLINE_WEEKDAY = 0          # monday == 0, sunday == 6
+DEADLINE_HOUR = 17
+
+# Unless reminderplans.py knows better, we send the reminder email
+# during this hour of this day, local time.
+REMINDER_WEEKDAY = 6
+REMINDER_HOUR = 23
+
+# How many days of week-boundaries each calendar remembers.
+_MAX_CACHED_DAYS = 16
+
+
+def now():
+    """Return the current time as a naive datetime in DEFAULT_TIMEZONE."""
+    if pytz is None:
+        return datetime.datetime.now()   # see the module docstring
+    utc_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    return utc_now.astimezone(
+        pytz.timezone(DEFAULT_TIMEZONE)).replace(tzinfo=None)
+
+
+def is_valid_timezone(timezone_name):
+    """True if we can make a WeekCalendar for the named timezone."""
+    if pytz is None:
+        return timezone_name == DEFAULT_TIMEZONE
+    try:
+        pytz.timezone(timezone_name)
+        return True
+    except (pytz.UnknownTimeZoneError, AttributeError):
+        return False
+
+
+class WeekCalendar(object):
+    """The snippet-week rules for a particular timezone.
+
+    Computing the mondays is cheap, but we do it a lot, so each
+    calendar remembers the answers for the last few days it was asked
+    about.  Use get_calendar() rather than making these yourself, so
+    the memoized answers are shared.
+    """
+
+    def __init__(self, timezone_name):
+        self.timezone_name = timezone_name
+        self._tzinfo = None
+        if pytz is not None and timezone_name != DEFAULT_TIMEZONE:
+            self._tzinfo = pytz.timezone(timezone_name)
+        # Map from local date to (newsnippet_monday,
+        # existingsnippet_monday before 11pm, ... at or after 11pm).
+        self._mondays_for_day = {}
+
+    def local_time(self, now):
+        """Convert now, a naive datetime in DEFAULT_TIMEZONE, to ours."""
+        if self._tzinfo is None:
+            return now
+        default_tzinfo = pytz.timezone(DEFAULT_TIMEZONE)
+        return default_tzinfo.localize(now).astimezone(
+            self._tzinfo).replace(tzinfo=None)
+
+    def server_time(self, local):
+        """Convert local, a naive datetime in our timezone, to the default."""
+        if self._tzinfo is None:
+            return local
+        default_tzinfo = pytz.timezone(DEFAULT_TIMEZONE)
+        return self._tzinfo.localize(local).astimezone(
+            default_tzinfo).replace(tzinfo=None)
+
+    def _mondays(self, local_day):
+        """Return the week boundaries for local_day, a datetime.date."""
+        mondays = self._mondays_for_day.get(local_day)
+        if mondays is None:
+            weekday = local_day.weekday()     # monday == 0, sunday == 6
+            this_monday = local_day - datetime.timedelta(weekday)
+            last_monday = this_monday - datetime.timedelta(7)
+            if weekday <= 2:                  # wed or before
+                newsnippet_monday = last_monday
+            else:
+                newsnippet_monday = this_monday
+            if weekday == 6:                  # sunday, 11pm and after
+                late_existingsnippet_monday = this_monday
+            else:
+                late_existingsnippet_monday = last_monday
+            mondays = (newsnippet_monday, last_monday,
+                       late_existingsnippet_monday)
+            if len(self._mondays_for_day) >= _MAX_CACHED_DAYS:
+                self._mondays_for_day.clear()
+            self._mondays_for_day[local_day] = mondays
+        return mondays
+
+    def newsnippet_monday(self, now):
+        """Return the monday we are accepting new snippets for, by default.
+
+        The rule is that up through wednesday, all snippets are assumed to
+        be for the previous week.  Starting on thursday, by default you
+        start putting in snippets for this week.
+
+        Arguments:
+           now: the current time, as a naive datetime.datetime in
+              DEFAULT_TIMEZONE.
+
+        Returns:
+           The Monday, as a datetime.date (not datetime.datetime) object.
+        """
+        return self._mondays(self.local_time(now).date())[0]
+
+    def existingsnippet_monday(self, now):
+        """Return the monday of the week whose snippets we show, by default.
+
+        The rule is that we show the snippets for the previous week.  We
+        declare a week starts on Monday...well, actually, Sunday at 11pm.
+        The reason for this is that (for quota reasons) we sent out a
+        reminder email Sunday at 11:50pm rather than Monday morning, and
+        we want that to count as 'Monday' anyway...
+
+        Arguments:
+           now: the current time, as a naive datetime.datetime in
+              DEFAULT_TIMEZONE.
+
+        Returns:
+           The Monday, as a datetime.date (not datetime.datetime) object.
+        """
+        local_now = self.local_time(now)
+        mondays = self._mondays(local_now.date())
+        if local_now.hour >= 23:
+            return mondays[2]
+        return mondays[1]
+
+    def deadline(self, week):
+        """Return when the snippets for week are due, as a local datetime.
+
+        week is the monday of the week, as a datetime.date.
+        """
+        return datetime.datetime.combine(
+            week + datetime.timedelta(7 + DEADLINE_WEEKDAY),
+            datetime.time(DEADLINE_HOUR))
+
+    def reminder_monday(self, now, lead_hours):
+        """Return the monday of the week to remind about now, or None.
+
+        That's the week whose deadline is lead_hours after the start
+        of the current hour, local time, if there is one.  So someone
+        who should be reminded lead_hours before the deadline is
+        reminded during the hour this returns a monday for.
+        """
+        hour_start = self.local_time(now).replace(minute=0, second=0,
+                                                  microsecond=0)
+        deadline = hour_start + datetime.timedelta(hours=lead_hours)
+        if (deadline.weekday() != DEADLINE_WEEKDAY or
+                deadline.hour != DEADLINE_HOUR):
+            return None
+        return deadline.date() - datetime.timedelta(7 + DEADLINE_WEEKDAY)
+
+    def is_reminder_time(self, now):
+        """True if now is during the hour we send reminders, local time."""
+        local_now = self.local_time(now)
+        return (local_now.weekday() == REMINDER_WEEKDAY and
+                local_now.hour == REMINDER_HOUR)
+
+
+_CALENDARS = {}
+
+
+def get_calendar(timezone_name=None):
+    """Return the (shared) WeekCalendar for the named timezone.
+
+    If timezone_name is None or not a timezone we know, we return the
+    calendar for DEFAULT_TIMEZONE.
+    """
+    timezone_name = timezone_name or DEFAULT_TIMEZONE
+    calendar = _CALENDARS.get(timezone_name)
+    if calendar is None:
+        if not is_valid_timezone(timezone_name):
+            logging.warning('Unknown timezone %s; using %s'
+                            % (timezone_name, DEFAULT_TIMEZONE))
+            return get_calendar(DEFAULT_TIMEZONE)
+        calendar = WeekCalendar(timezone_name)
+        _CALENDARS[timezone_name] = calendar
+    return calendar
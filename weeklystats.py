@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+
+from google.appengine.ext import db
+
+import models
+
+try:
+    import json
+except ImportError:      # python 2.5
+    from django.utils import simplejson as json
+
+"""Participation statistics, per week and category.
+
+Working out (say) what fraction of each category wrote snippets each
+week, for the last few months, would mean reading every snippet in
+those weeks.  Instead we keep running totals, which we update every
+time a snippet is saved or a user changes category, and the stats
+dashboard reads only those.
+
+We keep a WeeklyStats entity for each week and category, holding the
+number of snippets (and private snippets) that the users in that
+category wrote that week, and their total length.  We keep a
+CategoryStats entity for each category, holding how many users are
+in it.  The number of users missing a snippet for a week is the
+second minus the first -- which, like the weekly snippets page, counts
+everyone who's in the category now.
+
+A handful of stats entities get updated by every save, so rather than
+update them in the request that saves -- where contention on them
+could fail a save that has already happened -- we queue each update
+on the 'stats' task queue, which applies one at a time (see
+queue.yaml and apply_queued_update()).  If we can't even queue it,
+we log that and move on: stats are a nicety, and backfill_week() and
+backfill_categories() can put them right.  The backfill also counts
+the snippets and users from before we kept stats at all; until it's
+been run, the totals are off.  See snippets.BackfillStats.
+"""
+
+
+# The most entities we update in one cross-group transaction.
+_MAX_ENTITIES_PER_TRANSACTION = 25
+
+# The task queue, and the url, that apply stats updates.
+_QUEUE_NAME = 'stats'
+UPDATE_URL = '/admin/update_stats'
+
+# Characters for sparklines, from lowest to highest.
+_SPARK_CHARS = u'▁▂▃▄▅▆▇█'
+
+
+class WeeklyStats(db.Model):
+    """Totals for the snippets written by one category in one week.
+
+    The key-name is week:category (see _weekly_stats_key_name()).
+    """
+    week = db.DateProperty(required=True)
+    category = db.StringProperty(required=True)
+    num_submitted = db.IntegerProperty(default=0)
+    num_private = db.IntegerProperty(default=0)
+    total_length = db.IntegerProperty(default=0)   # in characters
+
+
+class CategoryStats(db.Model):
+    """How many users are in a category.  The key-name is the category."""
+    num_users = db.IntegerProperty(default=0)
+
+
+class AppliedUpdate(db.Model):
+    """Says we've applied part of a queued update, so a retry skips it.
+
+    The key-name is task-name:chunk; see _update().
+    """
+    applied = db.DateTimeProperty(auto_now_add=True)
+
+
+def _weekly_stats_key_name(week, category):
+    return '%s:%s' % (week.isoformat(), category)
+
+
+# A 'delta' is a pair ((week, category), {property: amount}), saying
+# how much to add to each property of the WeeklyStats for that week
+# and category, or of the CategoryStats for the category if week is
+# None.
+
+def _stats_key(week, category):
+    if week is None:
+        return db.Key.from_path('CategoryStats', category)
+    return db.Key.from_path('WeeklyStats',
+                            _weekly_stats_key_name(week, category))
+
+
+def _apply_deltas(deltas, applied_key):
+    """Add deltas to the stats entities, creating them if need be.
+
+    This is run in a transaction.  If applied_key isn't None, it's the
+    key of the AppliedUpdate that says we've done this already, and
+    we store one with it.
+    """
+    if applied_key is not None and db.get(applied_key) is not None:
+        return         # a retried task; we did this the first time
+    keys = [_stats_key(week, category) for ((week, category), _) in deltas]
+    entities = db.get(keys)
+    for (i, ((week, category), delta)) in enumerate(deltas):
+        if entities[i] is None:
+            if week is None:
+                entities[i] = CategoryStats(key=keys[i])
+            else:
+                entities[i] = WeeklyStats(key=keys[i], week=week,
+                                          category=category)
+        for (prop, amount) in delta.iteritems():
+            setattr(entities[i], prop, getattr(entities[i], prop) + amount)
+    if applied_key is not None:
+        entities.append(AppliedUpdate(key=applied_key))
+    db.put(entities)
+
+
+def _merge(deltas):
+    """Merge deltas that touch the same entity, dropping ones that are 0."""
+    merged = {}
+    for (week_and_category, delta) in deltas:
+        merged_delta = merged.setdefault(week_and_category, {})
+        for (prop, amount) in delta.iteritems():
+            merged_delta[prop] = merged_delta.get(prop, 0) + amount
+    return [(week_and_category, delta)
+            for (week_and_category, delta) in sorted(merged.iteritems())
+            if any(delta.itervalues())]
+
+
+def _update(deltas, task_name=None):
+    """Apply deltas, a chunk per transaction.
+
+    If task_name is given, we record each chunk we apply, so that if
+    the task is retried we don't apply it twice.
+    """
+    deltas = _merge(deltas)
+    # Leave room in each transaction for the AppliedUpdate.
+    chunk_size = _MAX_ENTITIES_PER_TRANSACTION - 1
+    xg_options = db.create_transaction_options(xg=True)
+    for i in xrange(0, len(deltas), chunk_size):
+        applied_key = None
+        if task_name:
+            applied_key = db.Key.from_path('AppliedUpdate',
+                                           '%s:%d' % (task_name, i))
+        db.run_in_transaction_options(
+            xg_options, _apply_deltas, deltas[i:i + chunk_size], applied_key)
+
+
+def _queue_update(deltas):
+    """Queue a task to apply deltas; see apply_queued_update().
+
+    This never raises: failing to update the stats mustn't fail the
+    request that changed what they count.
+    """
+    deltas = _merge(deltas)
+    if not deltas:
+        return
+    payload = json.dumps([[week and week.isoformat(), category, delta]
+                          for ((week, category), delta) in deltas])
+    try:
+        from google.appengine.api import taskqueue
+        taskqueue.add(queue_name=_QUEUE_NAME, url=UPDATE_URL,
+                      payload=payload)
+    except Exception:
+        logging.exception('Unable to queue a stats update; the stats are'
+                          ' off until they are backfilled')
+
+
+def apply_queued_update(payload, task_name):
+    """Apply an update that _queue_update() queued.
+
+    Arguments:
+      payload: the body of the task.
+      task_name: the name of the task, so that if it's retried we don't
+        apply the update twice.
+    """
+    deltas = []
+    for (week, category, delta) in json.loads(payload):
+        if week is not None:
+            week = datetime.datetime.strptime(week, '%Y-%m-%d').date()
+        deltas.append(((week, category),
+                       dict((str(prop), amount)
+                            for (prop, amount) in delta.iteritems())))
+    _update(deltas, task_name)
+
+
+def _snippet_deltas(category, week, old, new):
+    """The WeeklyStats delta for one snippet changing from old to new.
+
+    old and new are (length, private) pairs, or None if the snippet
+    doesn't exist (before, or after, the change).
+    """
+    delta = {'num_submitted': 0, 'num_private': 0, 'total_length': 0}
+    for (state, sign) in ((old, -1), (new, 1)):
+        if state is not None:
+            (length, private) = state
+            delta['num_submitted'] += sign
+            delta['num_private'] += sign * int(private)
+            delta['total_length'] += sign * length
+    return ((week, category), delta)
+
+
+def _category_delta(category, num_users):
+    return ((None, category), {'num_users': num_users})
+
+
+def record_snippet_changes(category, changes):
+    """Update the stats for snippets saved by a user in the given category.
+
+    The update is queued, and applied soon after.
+
+    Arguments:
+      category: the category of the user who owns the snippets.
+      changes: a list of (week, old, new) triples, where old and new
+        are (length, private) pairs for the snippet before and after
+        the save, or old is None if the snippet is new.
+    """
+    _queue_update([_snippet_deltas(category, week, old, new)
+                   for (week, old, new) in changes])
+
+
+def record_new_user(category):
+    """Update the stats for a user who's been added to category.
+
+    The update is queued, and applied soon after.
+    """
+    _queue_update([_category_delta(category, 1)])
+
+
+def record_category_change(old_category, new_category, snippets):
+    """Update the stats for a user who's moved from one category to another.
+
+    The update is queued, and applied soon after.
+
+    Arguments:
+      old_category: the category the user was in.
+      new_category: the category the user is in now.
+      snippets: every Snippet the user has written, so we can move
+        them from the old category's stats to the new one's.
+    """
+    if old_category == new_category:
+        return
+    deltas = [_category_delta(old_category, -1),
+              _category_delta(new_category, 1)]
+    for snippet in snippets:
+        state = (len(snippet.text), snippet.private)
+        deltas.append(_snippet_deltas(old_category, snippet.week, state, None))
+        deltas.append(_snippet_deltas(new_category, snippet.week, None, state))
+    _queue_update(deltas)
+
+
+def backfill_week(week, email_to_category):
+    """Recount the WeeklyStats for the week with this monday from scratch.
+
+    Unlike the updates, which add to the totals, this sets them, from
+    the week's snippets.  email_to_category maps each user's email to
+    their User.category.
+    """
+    totals = {}
+    snippets_q = models.Snippet.all().filter('week = ', week)
+    for snippet in snippets_q.run(batch_size=1000):
+        category = email_to_category.get(snippet.email,
+                                         models.User.category.default)
+        (submitted, private, total_length) = totals.get(category, (0, 0, 0))
+        totals[category] = (submitted + 1, private + int(snippet.private),
+                            total_length + len(snippet.text))
+    entities = [WeeklyStats(key_name=_weekly_stats_key_name(week, category),
+                            week=week, category=category,
+                            num_submitted=submitted, num_private=private,
+                            total_length=total_length)
+                for (category, (submitted, private, total_length))
+                in totals.iteritems()]
+    db.put(entities)
+    stale_q = WeeklyStats.all().filter('week = ', week)
+    db.delete([stats.key() for stats in stale_q.run(batch_size=1000)
+               if stats.category not in totals])
+
+
+def backfill_categories(users):
+    """Recount the CategoryStats from scratch, from every User."""
+    category_to_num_users = dict((stats.key().name(), 0)
+                                 for stats in CategoryStats.all())
+    for user in users:
+        category_to_num_users[user.category] = (
+            category_to_num_users.get(user.category, 0) + 1)
+    db.put([CategoryStats(key_name=category, num_users=num_users)
+            for (category, num_users) in category_to_num_users.iteritems()])
+
+
+def sparkline(values):
+    """Return a unicode string that graphs the values, one char per value."""
+    if not values:
+        return u''
+    (low, high) = (min(values), max(values))
+    retval = []
+    for value in values:
+        if high == low:
+            level = len(_SPARK_CHARS) - 1
+        else:
+            level = int((value - low) * (len(_SPARK_CHARS) - 1) /
+                        float(high - low) + 0.5)
+        retval.append(_SPARK_CHARS[level])
+    return u''.join(retval)
+
+
+def dashboard_weeks(last_week, num_weeks):
+    """Return the mondays of the num_weeks ending last_week, oldest first."""
+    return [last_week - datetime.timedelta(7 * i)
+            for i in xrange(num_weeks - 1, -1, -1)]
+
+
+def build_dashboard(weeks, week_and_category_to_totals,
+                    category_to_num_users):
+    """Turn per-week, per-category totals into what get_dashboard() returns.
+
+    Arguments:
+      weeks: the mondays to include, oldest first; see dashboard_weeks().
+      week_and_category_to_totals: a map from (week, category) to a
+        (num_submitted, num_private, total_length) triple.  Missing
+        entries mean no snippets.
+      category_to_num_users: a map from category to how many users
+        are in it.
+    """
+    categories = set(category_to_num_users)
+    categories.update(c for (_, c) in week_and_category_to_totals)
+
+    retval = []
+    for category in sorted(categories):
+        num_users = category_to_num_users.get(category, 0)
+        category_weeks = []
+        for week in weeks:
+            (submitted, private, total_length) = (
+                week_and_category_to_totals.get((week, category), (0, 0, 0)))
+            category_weeks.append({
+                'week': week,
+                'submitted': submitted,
+                'private': private,
+                'missing': max(num_users - submitted, 0),
+                'average_length': submitted and total_length // submitted,
+                'participation': (num_users and
+                                  min(submitted / float(num_users), 1.0)),
+                })
+        retval.append({
+            'category': category,
+            'num_users': num_users,
+            'weeks': category_weeks,
+            'participation_sparkline': sparkline(
+                [w['participation'] for w in category_weeks]),
+            'length_sparkline': sparkline(
+                [w['average_length'] for w in category_weeks]),
+            })
+    return retval
+
+
+def get_dashboard(last_week, num_weeks):
+    """Return the stats for each category, for the num_weeks ending last_week.
+
+    This reads only WeeklyStats and CategoryStats entities.
+
+    Arguments:
+      last_week: the monday of the latest week to include, as a
+        datetime.date.
+      num_weeks: how many weeks to include.
+
+    Returns:
+      A list of dicts, one per category, sorted by category.  Each
+      has 'category', 'num_users', 'weeks' -- a list of dicts with
+      'week', 'submitted', 'private', 'missing', 'average_length' and
+      'participation' (a fraction), oldest week first -- and
+      'participation_sparkline' and 'length_sparkline'.
+    """
+    weeks = dashboard_weeks(last_week, num_weeks)
+    q = WeeklyStats.all()
+    q.filter('week >= ', weeks[0])
+    q.filter('week <= ', weeks[-1])
+    week_and_category_to_totals = dict(
+        ((s.week, s.category), (s.num_submitted, s.num_private,
+                                s.total_length))
+        for s in q)
+    category_to_num_users = dict((c.key().name(), c.num_users)
+                                 for c in CategoryStats.all())
+    return build_dashboard(weeks, week_and_category_to_totals,
+                           category_to_num_users)